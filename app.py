@@ -1,10 +1,34 @@
+import base64
+import csv
+import datetime
+import hashlib
+import io
+import json
 import os
 import sys
-from flask import Flask, request, abort, jsonify, render_template
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import wraps
+from flask import Flask, request, abort, render_template, current_app
+from flask import Response, stream_with_context, make_response
+from werkzeug.exceptions import HTTPException
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import Date, tuple_, select, and_
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from models import Actor, Movie, db_drop_and_create_all, setup_db, db
-from auth import AuthError, requires_auth
+from models import Actor, Movie, Casting, db_drop_and_create_all, setup_db, db
+from models import count_rows, create_row, create_rows, get_versions
+from models import update_rows, delete_rows, TooManyRowsError
+from models import COUNT_STRATEGIES, pool_metrics, read_bind
+from auth import AuthError, requires_auth, jwks_store
+from cache import cached, invalidates
+from replicas import reads_replica, records_write
+from group_commit import GroupCommitQueue, QueueFullError, GROUP_COMMIT
+from changes import ChangeFeed, TooManySubscribersError, change_tables
+from changes import get_last_event_id, stream
+from metrics import start_request, observe_request
+from metrics import render_metrics, DB_POOL_IN_USE, DB_POOL_CAPACITY
+from metrics import DB_DEBUG_HEADERS
+from encoding import APIJSONEncoder, dumps, json_default, jsonify
 
 
 class Already_Exists_Error(Exception):
@@ -12,23 +36,928 @@ class Already_Exists_Error(Exception):
         self.error = error
         self.status_code = status_code
 
+
 ITEMS_PER_PAGE = 10
+MAX_ITEMS_PER_PAGE = int(os.environ.get('MAX_ITEMS_PER_PAGE', 100))
+
+
+# cursors are opaque to clients, they wrap the id of the last item of a page
+# (with its sort value when the page isn't sorted by id)
+def encode_cursor(value):
+    return base64.urlsafe_b64encode(
+        json.dumps(value, default=json_default).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        abort(400)
+
+
+# the filter applied to the rows after the cursor
+def after_cursor(cursor, id_column, sort_column, descending):
+    if sort_column is None:
+        if not isinstance(cursor, int):
+            abort(400)
+        if descending:
+            return id_column < cursor
+        return id_column > cursor
+    if not isinstance(cursor, list) or len(cursor) != 2 or \
+            not isinstance(cursor[1], int):
+        abort(400)
+    value = cursor[0]
+    if isinstance(sort_column.expression.type, Date):
+        value = parse_date(value)
+        if value is None:
+            abort(400)
+    if descending:
+        return tuple_(sort_column, id_column) < tuple_(value, cursor[1])
+    return tuple_(sort_column, id_column) > tuple_(value, cursor[1])
 
 
 # defining a function to paginate items for a page
-def paginate_items(request, selection):
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * ITEMS_PER_PAGE
-    end = start + ITEMS_PER_PAGE
-    items = [item.format() for item in selection]
-    return items[start:end]
+# the page is selected in the database with LIMIT/OFFSET (?page=N)
+# or with a keyset cursor (?after=<cursor>) so deep pages stay cheap
+# ?sort=<column> (or -<column> for descending) orders by one of
+# sort_columns, with the id to break ties
+# selection is a select() of the table, run with session (db.session)
+# and format_item turns a row into a dict
+def paginate_items(request, selection, id_column, format_item,
+                   sort_columns={}, session=None,
+                   default_limit=ITEMS_PER_PAGE):
+    session = session or db.session
+    limit = request.args.get('limit', default_limit, type=int)
+    if limit < 1:
+        abort(400)
+    limit = min(limit, MAX_ITEMS_PER_PAGE)
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+    sort_column = None
+    if sort != 'id':
+        if sort not in sort_columns:
+            abort(400)
+        sort_column = sort_columns[sort]
+        # the cursor needs the sort value, even if ?fields= left it out
+        if sort_column.key not in selection.selected_columns.keys():
+            selection = selection.add_columns(sort_column)
+    order = [id_column] if sort_column is None else [sort_column, id_column]
+    if descending:
+        order = [column.desc() for column in order]
+    selection = selection.order_by(*order)
+    after = request.args.get('after')
+    if after is not None:
+        selection = selection.filter(after_cursor(
+            decode_cursor(after), id_column, sort_column, descending))
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            abort(400)
+        selection = selection.offset((page - 1) * limit)
+    # fetch one extra row to know if there is a next page
+    rows = session.execute(selection.limit(limit + 1)).all()
+    items = [format_item(item) for item in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        if sort_column is None:
+            next_cursor = encode_cursor(last.id)
+        else:
+            next_cursor = encode_cursor(
+                [getattr(last, sort_column.key), last.id])
+    return items, next_cursor
+
+
+# Filters
+
+ACTOR_FILTERS = (
+    'ids', 'name', 'name_prefix', 'gender', 'min_age', 'max_age')
+MOVIE_FILTERS = (
+    'ids', 'title', 'title_prefix', 'min_release_date', 'max_release_date')
+ACTOR_SORTS = {'name': Actor.name, 'age': Actor.age, 'gender': Actor.gender}
+MOVIE_SORTS = {'title': Movie.title, 'release_date': Movie.release_date}
+
+
+# reads an optional query argument, a value that doesn't convert is a 400
+def get_arg(request, name, convert=str):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        abort(400)
+
+
+def date_arg(value):
+    date = parse_date(value)
+    if date is None:
+        raise ValueError(value)
+    return date
+
+
+# ?ids=1,5,9, without repeats
+def id_list(value):
+    return list(dict.fromkeys(int(id) for id in value.split(',')))
+
+
+# with ?ids= a page holds all the ids (up to MAX_ITEMS_PER_PAGE)
+def ids_limit(request):
+    ids = get_arg(request, 'ids', id_list)
+    return ITEMS_PER_PAGE if ids is None else len(ids)
+
+
+# escapes the LIKE wildcards in a search text
+def escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# name/title searches are case insensitive and use the trigram indexes,
+# the other filters use the btree indexes
+def filter_actors(request, selection):
+    ids = get_arg(request, 'ids', id_list)
+    name = get_arg(request, 'name')
+    name_prefix = get_arg(request, 'name_prefix')
+    gender = get_arg(request, 'gender')
+    min_age = get_arg(request, 'min_age', int)
+    max_age = get_arg(request, 'max_age', int)
+    # the ids are found in one IN query
+    if ids is not None:
+        selection = selection.filter(Actor.id.in_(ids))
+    if name:
+        selection = selection.filter(
+            Actor.name.ilike('%' + escape_like(name) + '%', escape='\\'))
+    if name_prefix:
+        selection = selection.filter(
+            Actor.name.ilike(escape_like(name_prefix) + '%', escape='\\'))
+    if gender:
+        selection = selection.filter(Actor.gender == gender)
+    if min_age is not None:
+        selection = selection.filter(Actor.age >= min_age)
+    if max_age is not None:
+        selection = selection.filter(Actor.age <= max_age)
+    return selection
+
+
+def filter_movies(request, selection):
+    ids = get_arg(request, 'ids', id_list)
+    title = get_arg(request, 'title')
+    title_prefix = get_arg(request, 'title_prefix')
+    min_release_date = get_arg(request, 'min_release_date', date_arg)
+    max_release_date = get_arg(request, 'max_release_date', date_arg)
+    if ids is not None:
+        selection = selection.filter(Movie.id.in_(ids))
+    if title:
+        selection = selection.filter(
+            Movie.title.ilike('%' + escape_like(title) + '%', escape='\\'))
+    if title_prefix:
+        selection = selection.filter(
+            Movie.title.ilike(escape_like(title_prefix) + '%', escape='\\'))
+    if min_release_date is not None:
+        selection = selection.filter(Movie.release_date >= min_release_date)
+    if max_release_date is not None:
+        selection = selection.filter(Movie.release_date <= max_release_date)
+    return selection
+
+
+# empty filters (i.e. ?name=) are ignored, like in the filter functions
+def is_filtered(request, filters):
+    return any(request.args.get(name) for name in filters)
+
+
+# the count strategy is picked by the client with ?count=
+def get_count_strategy(request):
+    strategy = request.args.get('count', 'auto')
+    if strategy not in COUNT_STRATEGIES:
+        abort(400)
+    return strategy
+
+
+# Read handlers
+
+'''
+the bodies of the GET handlers, shared by the Flask views and the ASGI app
+(asgi.py), so they take the request (anything with werkzeug style .args)
+and the session to run the queries with (db.session by default)
+they return the response data, or abort
+
+they select only the columns they return with Core statements, so the
+rows come back as plain tuples (no ORM instances, no identity map)
+and are turned into dicts directly
+'''
+actors_table = Actor.__table__
+movies_table = Movie.__table__
+castings_table = Casting.__table__
+
+
+def actor_row(row):
+    return {
+        "id": row.id,
+        "name": row.name,
+        "age": row.age,
+        "gender": row.gender
+    }
+
+
+# release dates are ISO-8601 dates (YYYY-MM-DD)
+def movie_row(row):
+    return {
+        "id": row.id,
+        "title": row.title,
+        "release_date": row.release_date.isoformat()
+    }
+
+
+# the movies of each actor in actor_ids, in one query
+def movies_of_actors(session, actor_ids):
+    rows = session.execute(
+        select(castings_table.c.actor_id, movies_table)
+        .join(movies_table, movies_table.c.id == castings_table.c.movie_id)
+        .where(castings_table.c.actor_id.in_(actor_ids))
+        .order_by(movies_table.c.id))
+    movies = {actor_id: [] for actor_id in actor_ids}
+    for row in rows:
+        movies[row.actor_id].append(movie_row(row))
+    return movies
+
+
+# the actors of each movie in movie_ids, in one query
+def actors_of_movies(session, movie_ids):
+    rows = session.execute(
+        select(castings_table.c.movie_id, actors_table)
+        .join(actors_table, actors_table.c.id == castings_table.c.actor_id)
+        .where(castings_table.c.movie_id.in_(movie_ids))
+        .order_by(actors_table.c.id))
+    actors = {movie_id: [] for movie_id in movie_ids}
+    for row in rows:
+        actors[row.movie_id].append(actor_row(row))
+    return actors
+
+
+# Sparse fieldsets
+
+'''
+select_fields(request, table, format_row) method
+    ?fields=name,age selects (and returns) only these columns of table,
+    the id is always returned
+    returns the select of the columns and the function turning a row
+    into a dict (format_row when there is no ?fields=)
+    only the fields of format_row can be selected (not the internal
+    version column), any other field is a 400
+'''
+PUBLIC_FIELDS = {
+    'actors': ('id', 'name', 'age', 'gender'),
+    'movies': ('id', 'title', 'release_date')
+}
+
+
+def select_fields(request, table, format_row):
+    fields = get_arg(request, 'fields')
+    if fields is None:
+        return select(table), format_row
+    names = list(dict.fromkeys(fields.split(',')))
+    if any(name not in PUBLIC_FIELDS[table.name] for name in names):
+        abort(400)
+    columns = [table.c.id] + [
+        table.c[name] for name in names if name != 'id']
+    keys = [column.key for column in columns]
+
+    # dates are encoded as ISO-8601 by the JSON encoder
+    def format_fields(row):
+        return {key: getattr(row, key) for key in keys}
+
+    return select(*columns), format_fields
+
+
+def list_actors(request, session=None):
+    session = session or db.session
+    # get a page of actors and return them formatted
+    selection, format_item = select_fields(request, actors_table, actor_row)
+    selection = filter_actors(request, selection)
+    # a filtered request counts the matching actors
+    actors_count, count_type = count_rows(
+        Actor, get_count_strategy(request),
+        selection if is_filtered(request, ACTOR_FILTERS) else None, session)
+    actors, next_cursor = paginate_items(
+        request, selection, actors_table.c.id, format_item, ACTOR_SORTS,
+        session, ids_limit(request))
+    # with ?include=movies the movies of the whole page are loaded
+    # in one extra query
+    if request.args.get('include') == 'movies' and actors:
+        movies = movies_of_actors(
+            session, [actor["id"] for actor in actors])
+        for actor in actors:
+            actor["movies"] = movies[actor["id"]]
+    return {
+        "success": True,
+        "actors": actors,
+        "actors_count": actors_count,
+        "actors_count_type": count_type,
+        "next_cursor": next_cursor
+    }
+
+
+def list_movies(request, session=None):
+    session = session or db.session
+    # get a page of movies and return them formatted
+    selection, format_item = select_fields(request, movies_table, movie_row)
+    selection = filter_movies(request, selection)
+    # a filtered request counts the matching movies
+    movies_count, count_type = count_rows(
+        Movie, get_count_strategy(request),
+        selection if is_filtered(request, MOVIE_FILTERS) else None, session)
+    movies, next_cursor = paginate_items(
+        request, selection, movies_table.c.id, format_item, MOVIE_SORTS,
+        session, ids_limit(request))
+    # with ?include=actors the casts of the whole page are loaded
+    # in one extra query
+    if request.args.get('include') == 'actors' and movies:
+        actors = actors_of_movies(
+            session, [movie["id"] for movie in movies])
+        for movie in movies:
+            movie["actors"] = actors[movie["id"]]
+    return {
+        "success": True,
+        "movies": movies,
+        "movies_count": movies_count,
+        "movies_count_type": count_type,
+        "next_cursor": next_cursor
+    }
+
+
+# a single actor (with ?fields= and ?include=movies)
+def actor_detail(actor_id, request, session=None):
+    session = session or db.session
+    selection, format_item = select_fields(request, actors_table, actor_row)
+    row = session.execute(
+        selection.where(actors_table.c.id == actor_id)).first()
+    if row is None:
+        abort(404)
+    actor = format_item(row)
+    if request.args.get('include') == 'movies':
+        actor["movies"] = movies_of_actors(session, [actor_id])[actor_id]
+    return {
+        "success": True,
+        "actor": actor
+    }
+
+
+# a single movie (with ?fields= and ?include=actors)
+def movie_detail(movie_id, request, session=None):
+    session = session or db.session
+    selection, format_item = select_fields(request, movies_table, movie_row)
+    row = session.execute(
+        selection.where(movies_table.c.id == movie_id)).first()
+    if row is None:
+        abort(404)
+    movie = format_item(row)
+    if request.args.get('include') == 'actors':
+        movie["actors"] = actors_of_movies(session, [movie_id])[movie_id]
+    return {
+        "success": True,
+        "movie": movie
+    }
+
+
+def movie_actors(movie_id, session=None):
+    session = session or db.session
+    # the movie and its cast in one query, a movie without actors
+    # still gets one row (with no actor)
+    rows = session.execute(
+        select(movies_table.c.id.label('movie_id'), actors_table)
+        .select_from(movies_table)
+        .outerjoin(castings_table,
+                   castings_table.c.movie_id == movies_table.c.id)
+        .outerjoin(actors_table,
+                   actors_table.c.id == castings_table.c.actor_id)
+        .where(movies_table.c.id == movie_id)
+        .order_by(actors_table.c.id)).all()
+    if not rows:
+        abort(404)
+    return {
+        "success": True,
+        "movie_id": movie_id,
+        "actors": [actor_row(row) for row in rows if row.id is not None]
+    }
+
+
+def actor_movies(actor_id, session=None):
+    session = session or db.session
+    # the actor and their movies in one query
+    rows = session.execute(
+        select(actors_table.c.id.label('actor_id'), movies_table)
+        .select_from(actors_table)
+        .outerjoin(castings_table,
+                   castings_table.c.actor_id == actors_table.c.id)
+        .outerjoin(movies_table,
+                   movies_table.c.id == castings_table.c.movie_id)
+        .where(actors_table.c.id == actor_id)
+        .order_by(movies_table.c.id)).all()
+    if not rows:
+        abort(404)
+    return {
+        "success": True,
+        "actor_id": actor_id,
+        "movies": [movie_row(row) for row in rows if row.id is not None]
+    }
+
+
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 50000))
+
+
+# parses a date like 2020-8-12, returns None if it isn't one
+def parse_date(value):
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+
+# inserts one row, through the group commit queue when it is on
+# returns the new id, or None if unique_column already has the value
+# a sync worker (one request at a time) has nothing to batch with, its
+# rows are committed directly
+def create_item(model, values, unique_column):
+    write_queue = current_app.extensions.get('group_commit')
+    if write_queue is None:
+        return create_row(model, values, unique_column)
+    if not request.environ.get('wsgi.multithread'):
+        if not write_queue.sync_warned:
+            write_queue.sync_warned = True
+            print('GROUP_COMMIT needs threaded or ASGI workers '
+                  '(gunicorn -k gthread --threads N, or uvicorn asgi:app), '
+                  'this sync worker commits each row')
+        return create_row(model, values, unique_column)
+    # a 503 is only sent for a row that isn't (and won't be) inserted
+    try:
+        return write_queue.create(model, values, unique_column)
+    except (QueueFullError, FutureTimeoutError) as e:
+        print(e)
+        abort(503)
+
+
+# the validate functions return the values to insert, or None if invalid
+def validate_actor(item):
+    if not isinstance(item, dict):
+        return None
+    name = item.get('name')
+    age = item.get('age')
+    gender = item.get('gender')
+    if not isinstance(name, str) or not name.strip():
+        return None
+    if not isinstance(age, int) or isinstance(age, bool):
+        return None
+    if not isinstance(gender, str) or not gender.strip():
+        return None
+    return {"name": name, "age": age, "gender": gender}
+
+
+def validate_movie(item):
+    if not isinstance(item, dict):
+        return None
+    title = item.get('title')
+    release_date = parse_date(item.get('release_date'))
+    if not isinstance(title, str) or not title.strip():
+        return None
+    if release_date is None:
+        return None
+    return {"title": title, "release_date": release_date}
+
+
+# the validate_update functions return the values to set (at least one),
+# or None if invalid
+def validate_actor_update(item):
+    if not isinstance(item, dict):
+        return None
+    values = {}
+    name = item.get('name')
+    age = item.get('age')
+    gender = item.get('gender')
+    if name is not None:
+        if not isinstance(name, str) or not name.strip():
+            return None
+        values['name'] = name
+    if age is not None:
+        if not isinstance(age, int) or isinstance(age, bool):
+            return None
+        values['age'] = age
+    if gender is not None:
+        if not isinstance(gender, str) or not gender.strip():
+            return None
+        values['gender'] = gender
+    return values or None
+
+
+def validate_movie_update(item):
+    if not isinstance(item, dict):
+        return None
+    values = {}
+    title = item.get('title')
+    release_date = item.get('release_date')
+    if title is not None:
+        if not isinstance(title, str) or not title.strip():
+            return None
+        values['title'] = title
+    if release_date is not None:
+        values['release_date'] = parse_date(release_date)
+        if values['release_date'] is None:
+            return None
+    return values or None
+
+
+# the values of a single row PATCH, checked like the bulk PATCH (a body
+# that isn't an object or has an invalid field is a 422), a body without
+# any of the fields updates nothing
+def item_update_values(data, validate, fields):
+    if not isinstance(data, dict):
+        abort(422)
+    if all(data.get(field) is None for field in fields):
+        return {}
+    values = validate(data)
+    if values is None:
+        abort(422)
+    return values
+
+
+# reads NDJSON one line at a time, lines that aren't JSON become None
+def read_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+# the items of a bulk request are a JSON array or NDJSON (one per line)
+def read_bulk_items(request):
+    if request.mimetype == 'application/x-ndjson':
+        return read_ndjson(request.stream)
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        abort(400)
+    return data
+
+
+# inserts the items of a bulk request in one transaction
+# and reports created/conflict/invalid for each item by its index
+def bulk_create(request, model, unique_column, validate):
+    invalid = set()
+
+    def rows():
+        for index, item in enumerate(read_bulk_items(request)):
+            if index >= BULK_MAX_ITEMS:
+                abort(413)
+            row = validate(item)
+            if row is None:
+                invalid.add(index)
+            yield row
+
+    try:
+        ids = create_rows(model, rows(), unique_column)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(e)
+        abort(422)
+
+    results = []
+    for index, new_id in enumerate(ids):
+        if index in invalid:
+            results.append({"index": index, "status": "invalid"})
+        elif new_id is None:
+            results.append({"index": index, "status": "conflict"})
+        else:
+            results.append({"index": index, "status": "created", "id": new_id})
+    return jsonify({
+        "success": True,
+        "created": len([r for r in results if r["status"] == "created"]),
+        "conflicts": len([r for r in results if r["status"] == "conflict"]),
+        "invalid": len(invalid),
+        "results": results
+    })
+
+
+# Bulk updates and deletes
+
+'''
+the rows of a bulk PATCH or DELETE are picked with the filters of the
+GET handlers (i.e. ?ids=1,5,9 or ?gender=male&min_age=60), or with an
+"ids" array in the JSON body, as a request line only holds a few hundred
+ids, at least one (non empty) filter is required so a request can't
+change a whole table by mistake
+they are changed with set-based statements in one transaction, and the
+results are reported by id (in the order of the ids when given)
+'''
+
+
+# the "ids" of the JSON body, None without it, not a list of at most
+# BULK_MAX_ITEMS ids (or with ?ids= too) is a 400
+def body_ids(request):
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'ids' not in data:
+        return None
+    ids = data['ids']
+    if 'ids' in request.args or not isinstance(ids, list) or not ids or \
+            len(ids) > BULK_MAX_ITEMS or \
+            not all(isinstance(id, int) and not isinstance(id, bool)
+                    for id in ids):
+        abort(400)
+    return list(dict.fromkeys(ids))
+
+
+def bulk_where(request, filter_items, filters, table):
+    ids = body_ids(request)
+    if ids is None and not is_filtered(request, filters):
+        abort(400)
+    selection = filter_items(request, select(table.c.id))
+    if ids is not None:
+        selection = selection.filter(table.c.id.in_(ids))
+    return selection.whereclause
+
+
+# found maps the ids of the changed rows to their item (added under key),
+# the requested ids that don't exist or don't match the other filters
+# are not_found
+def bulk_results(request, found, status, key=None):
+    requested = body_ids(request)
+    if requested is None:
+        requested = get_arg(request, 'ids', id_list)
+    results = []
+    for id in (found if requested is None else requested):
+        if id not in found:
+            results.append({"id": id, "status": "not_found"})
+            continue
+        result = {"id": id, "status": status}
+        if key is not None:
+            result[key] = found[id]
+        results.append(result)
+    return results
+
+
+def bulk_update(request, model, filter_items, filters, validate, key,
+                format_row):
+    table = model.__table__
+    where = bulk_where(request, filter_items, filters, table)
+    data = request.get_json(silent=True)
+    if data is None:
+        abort(400)
+    values = validate(data)
+    if values is None:
+        abort(422)
+    try:
+        rows = update_rows(model, where, values, BULK_MAX_ITEMS)
+    except TooManyRowsError as e:
+        print(e)
+        abort(413)
+    except Exception as e:
+        print(e)
+        abort(422)
+    results = bulk_results(
+        request, {row.id: format_row(row) for row in rows}, "updated", key)
+    return jsonify({
+        "success": True,
+        "updated": len(rows),
+        "not_found": len(results) - len(rows),
+        "results": results
+    })
+
+
+def bulk_delete(request, model, filter_items, filters, casting_column):
+    table = model.__table__
+    where = bulk_where(request, filter_items, filters, table)
+    try:
+        ids = delete_rows(model, where, casting_column, BULK_MAX_ITEMS)
+    except TooManyRowsError as e:
+        print(e)
+        abort(413)
+    except Exception as e:
+        print(e)
+        abort(422)
+    results = bulk_results(request, dict.fromkeys(ids), "deleted")
+    return jsonify({
+        "success": True,
+        "deleted": len(ids),
+        "not_found": len(results) - len(ids),
+        "results": results
+    })
+
+
+# Single row updates and deletes
+
+'''
+optimistic concurrency: a PATCH or DELETE with an If-Match header only
+applies to the versions of the row it names (the ETags of the row), the
+version is checked in the UPDATE/DELETE itself, so a stale write changes
+no row and is a 412, without a lock or an extra SELECT
+'''
+
+
+# the If-Match ETags of the request, None without the header
+def get_if_match(request):
+    if 'If-Match' not in request.headers:
+        return None
+    return request.if_match
+
+
+# the row with item_id, and one of the If-Match versions
+def item_condition(table, item_id, if_match):
+    condition = table.c.id == item_id
+    if if_match is not None and not if_match.star_tag:
+        versions = [int(tag) for tag in if_match.as_set() if tag.isdigit()]
+        condition = and_(condition, table.c.version.in_(versions))
+    return condition
+
+
+'''
+update_item(model, item_id, values, if_match) method
+    sets values on the row with item_id, with one UPDATE ... RETURNING
+    on postgres (see update_rows), and returns the updated row
+    a row that doesn't exist is a 404 (a 412 with If-Match, as is a
+    stale version), a failed update a 422
+'''
+
+
+def update_item(model, item_id, values, if_match=None):
+    table = model.__table__
+    condition = item_condition(table, item_id, if_match)
+    try:
+        if values:
+            rows = update_rows(model, condition, values)
+        else:
+            # nothing to set, the row as it is
+            rows = db.session.execute(select(table).where(condition)).all()
+    except Exception as e:
+        print(e)
+        abort(422)
+    if not rows:
+        abort(404 if if_match is None else 412)
+    return rows[0]
+
+
+# deletes the row with item_id and its castings, with one
+# DELETE ... RETURNING id on postgres (see delete_rows)
+def delete_item(model, item_id, casting_column, if_match=None):
+    table = model.__table__
+    try:
+        ids = delete_rows(
+            model, item_condition(table, item_id, if_match), casting_column)
+    except Exception as e:
+        print(e)
+        abort(422)
+    if not ids:
+        abort(404 if if_match is None else 412)
+
+
+# a response for a single row, with the version of the row as its ETag
+def item_response(key, row, format_row):
+    response = jsonify({
+        "success": True,
+        key: format_row(row)
+    })
+    response.set_etag(str(row.version))
+    return response
+
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+
+
+# yields the rows of a table in chunks of EXPORT_CHUNK_SIZE
+# using a server-side cursor so memory stays constant for any table size
+# bind is the read replica of the request (the rows are read after the
+# handler returned)
+def export_rows(table, export_format, bind=None):
+    # the row versions are left out, they are not data
+    columns = [column for column in table.c if column.key != 'version']
+    statement = select(*columns).order_by(table.c.id) \
+        .execution_options(stream_results=True)
+    token = read_bind.set(bind)
+    try:
+        result = db.session.execute(statement)
+    finally:
+        read_bind.reset(token)
+    try:
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(columns)
+        for rows in result.partitions(EXPORT_CHUNK_SIZE):
+            for row in rows:
+                if export_format == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(dumps(dict(zip(columns, row))).decode())
+                    buffer.write('\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # the csv header of an empty table
+        if buffer.tell():
+            yield buffer.getvalue()
+    finally:
+        result.close()
+
+
+# streams a whole table as NDJSON (default) or CSV (?format=csv)
+def export_table(request, table):
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
+    response = Response(
+        stream_with_context(
+            export_rows(table, export_format, read_bind.get())),
+        mimetype=EXPORT_FORMATS[export_format])
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={table.name}.{export_format}'
+    return response
+
+
+# Conditional GET
+
+'''
+@conditional(*table_names, include, item) decorator method
+    the ETag of a response is derived from the url and the versions of
+    the tables it reads (include adds the related table and castings
+    when the request has ?include=<include>)
+    item is (table, name of the id view argument) for a single row
+    response, its ETag is the version of the row (without ?include=),
+    the one a PATCH/DELETE takes in If-Match
+    a request with a matching If-None-Match gets a 304 without running
+    the handler, so no rows are read or serialized
+    the versions are read before the rows, so a concurrent write can
+    only make the ETag older than the data (one extra refetch), never newer
+'''
+
+
+# the tables a response reads, by the query args
+def read_tables(table_names, include, args):
+    tables = list(table_names)
+    if include is not None and args.get('include') == include:
+        tables += [include, 'castings']
+    return tables
+
+
+def make_etag(full_path, versions):
+    return hashlib.sha1(json.dumps(
+        [full_path, sorted(versions.items())]).encode()).hexdigest()
+
+
+# the ETag of a response, item is (table, id) for a single row,
+# None if that row doesn't exist (the handler answers with a 404)
+def response_etag(full_path, table_names, include, args, item=None,
+                  session=None):
+    session = session or db.session
+    if item is not None and args.get('include') != include:
+        table, item_id = item
+        version = session.execute(
+            select(table.c.version).where(table.c.id == item_id)).scalar()
+        return None if version is None else str(version)
+    tables = read_tables(table_names, include, args)
+    return make_etag(full_path, get_versions(*tables, session=session))
+
+
+def conditional(*table_names, include=None, item=None):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = response_etag(
+                request.full_path, table_names, include, request.args,
+                item and (item[0], kwargs[item[1]]))
+            if etag is not None and request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and etag is not None:
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
 
 
 # create and configure the app
 def create_app(test_config=None):
     app = Flask(__name__)
+    app.json_encoder = APIJSONEncoder
+    app.config['DB_DEBUG_HEADERS'] = DB_DEBUG_HEADERS
     setup_db(app)
     CORS(app, resources={r"/api/*": {"origins": "*"}})
+    # POST /actors and POST /movies commit in batches (see group_commit.py)
+    if GROUP_COMMIT:
+        app.extensions['group_commit'] = GroupCommitQueue(app)
+    # the listener of GET /changes (see changes.py)
+    app.extensions['changes'] = ChangeFeed(app)
 
     '''
     uncomment the following line to initialize the database
@@ -37,6 +966,14 @@ def create_app(test_config=None):
     '''
     #db_drop_and_create_all(db)
 
+    # fetch the Auth0 signing keys at boot instead of on the first request
+    if os.environ.get('JWKS_PRELOAD'):
+        jwks_store.preload()
+
+    @app.before_request
+    def before_request():
+        start_request(request.endpoint)
+
     @app.after_request
     def after_request(response):
         response.headers.add(
@@ -45,8 +982,22 @@ def create_app(test_config=None):
         response.headers.add(
             'Access-Control-Allow-Headers',
             'GET, POST, PATCH, DELETE, OPTIONS')
+        # request count, status code and latency of the route
+        stats = observe_request(request.method, response.status_code)
+        if stats is not None and app.config['DB_DEBUG_HEADERS']:
+            response.headers.extend(stats.debug_headers())
+        # the pool gauges of this worker
+        stats = pool_metrics.stats()
+        DB_POOL_IN_USE.set(stats['in_use'])
+        DB_POOL_CAPACITY.set(stats['capacity'])
         return response
 
+    # prometheus metrics of the app (of all the workers)
+    @app.route("/metrics")
+    def metrics():
+        body, content_type = render_metrics()
+        return Response(body, content_type=content_type)
+
     # login
     @app.route("/login")
     def login():
@@ -59,34 +1010,162 @@ def create_app(test_config=None):
     # get all actors
     @app.route("/actors")
     @requires_auth("get:actors")
+    @reads_replica
+    @cached("actors", include="movies")
+    @conditional("actors", include="movies")
     def get_actors(payload):
-        # get all actors and return them formatted
-        selection = Actor.query.order_by(Actor.id).all()
-        actors = paginate_items(request, selection)
-        actors_count = Actor.query.count()
-        return jsonify({
-            "success": True,
-            "actors": actors,
-            "actors_count": actors_count
-        })
+        return jsonify(list_actors(request))
 
     # get all movies
     @app.route("/movies")
     @requires_auth("get:movies")
+    @reads_replica
+    @cached("movies", include="actors")
+    @conditional("movies", include="actors")
     def get_movies(payload):
-        # get all movies and return them formatted
-        selection = Movie.query.order_by(Movie.id).all()
-        movies = paginate_items(request, selection)
-        movies_count = Movie.query.count()
+        return jsonify(list_movies(request))
+
+    # get an actor
+    @app.route("/actors/<int:actor_id>")
+    @requires_auth("get:actors")
+    @reads_replica
+    @cached("actors", include="movies")
+    @conditional("actors", include="movies",
+                 item=(actors_table, "actor_id"))
+    def get_actor(payload, actor_id):
+        return jsonify(actor_detail(actor_id, request))
+
+    # get a movie
+    @app.route("/movies/<int:movie_id>")
+    @requires_auth("get:movies")
+    @reads_replica
+    @cached("movies", include="actors")
+    @conditional("movies", include="actors",
+                 item=(movies_table, "movie_id"))
+    def get_movie(payload, movie_id):
+        return jsonify(movie_detail(movie_id, request))
+
+    # export all actors
+    @app.route("/actors/export")
+    @requires_auth("get:actors")
+    @reads_replica
+    @conditional("actors")
+    def export_actors(payload):
+        return export_table(request, Actor.__table__)
+
+    # export all movies
+    @app.route("/movies/export")
+    @requires_auth("get:movies")
+    @reads_replica
+    @conditional("movies")
+    def export_movies(payload):
+        return export_table(request, Movie.__table__)
+
+    # stream the changes of actors, movies and castings (Server-Sent Events)
+    # the permissions are checked per table (see change_tables)
+    # a stream holds its thread until the token expires: a sync worker
+    # (one request at a time) would serve nothing else, a threaded one
+    # serves CHANGES_FLASK_MAX_STREAMS at most (see ChangeFeed.subscribe),
+    # the ASGI app serves them on its event loop
+    @app.route("/changes")
+    @requires_auth(None)
+    def stream_changes(payload):
+        if not request.environ.get('wsgi.multithread'):
+            abort(503)
+        tables = change_tables(request.args.get('tables'), payload)
+        last_event_id = get_last_event_id(
+            request.headers.get('Last-Event-ID'),
+            request.args.get('last_event_id'))
+        feed = app.extensions['changes']
+        try:
+            subscriber = feed.subscribe(tables)
+        except TooManySubscribersError as e:
+            print(e)
+            abort(503)
+        response = Response(
+            stream_with_context(stream(
+                feed, subscriber, last_event_id, payload.get('exp'))),
+            mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # no buffering behind nginx
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    # get the cast of a movie
+    @app.route("/movies/<int:movie_id>/actors")
+    @requires_auth("get:actors")
+    @reads_replica
+    @cached("movies", "actors", "castings")
+    @conditional("movies", "actors", "castings")
+    def get_movie_actors(payload, movie_id):
+        return jsonify(movie_actors(movie_id))
+
+    # get the movies an actor is cast in
+    @app.route("/actors/<int:actor_id>/movies")
+    @requires_auth("get:movies")
+    @reads_replica
+    @cached("actors", "movies", "castings")
+    @conditional("actors", "movies", "castings")
+    def get_actor_movies(payload, actor_id):
+        return jsonify(actor_movies(actor_id))
+
+    # cast an actor in a movie
+    @app.route("/movies/<int:movie_id>/actors", methods=['POST'])
+    @requires_auth("patch:movies")
+    @records_write
+    @invalidates("castings")
+    def add_casting(payload, movie_id):
+        # get the request data
+        data = request.get_json()
+        if data is None:
+            abort(400)
+        actor_id = data.get('actor_id')
+        if not isinstance(actor_id, int) or isinstance(actor_id, bool):
+            abort(422)
+        # check that the movie and the actor exist
+        if Movie.query.get(movie_id) is None or \
+                Actor.query.get(actor_id) is None:
+            abort(404)
+        try:
+            casting = Casting(actor_id=actor_id, movie_id=movie_id)
+            casting.insert()
+        except IntegrityError as e:
+            print(e)
+            db.session.rollback()
+            raise Already_Exists_Error({
+                "code": "Conflict",
+                "description": "actor is already cast in this movie"
+            }, 409)
         return jsonify({
             "success": True,
-            "movies": movies,
-            "movies_count": movies_count
+            "created": casting.format()
         })
 
+    # remove an actor from the cast of a movie
+    @app.route(
+        "/movies/<int:movie_id>/actors/<int:actor_id>", methods=['DELETE'])
+    @requires_auth("patch:movies")
+    @records_write
+    @invalidates("castings")
+    def delete_casting(payload, movie_id, actor_id):
+        casting = Casting.query.get((actor_id, movie_id))
+        if casting is None:
+            abort(404)
+        try:
+            casting.delete()
+            return jsonify({
+                "success": True,
+                "deleted": {"actor_id": actor_id, "movie_id": movie_id}
+            })
+        except Exception as e:
+            print(e)
+            abort(422)
+
     # post a new actor
     @app.route("/actors", methods=['POST'])
     @requires_auth("post:actors")
+    @records_write
+    @invalidates("actors")
     def add_actor(payload):
         # get the request data
         data = request.get_json()
@@ -96,38 +1175,32 @@ def create_app(test_config=None):
             name = data['name']
             age = data.get('age')
             gender = data.get('gender')
-            # check if actor already exists in database
-            the_actor = Actor.query.filter(Actor.name == name).one_or_none()
-            if the_actor is not None:
-                raise Already_Exists_Error({
-                    "code": "Conflict",
-                    "description": "actor already exists in database"
-                }, 409)
-            # insert the actor to the database
-            actor = Actor(name=name, age=age, gender=gender)
-            actor.insert()
-            # return success with the added actor data
-            the_actor = Actor.query.filter(
-                Actor.name == actor.name).one_or_none()
-            actor_id = the_actor.id
-            return jsonify({
-                "success": True,
-                "created": actor_id
-            })
-
+            # insert the actor to the database in one statement
+            # it returns None if the actor already exists in database
+            actor_id = create_item(
+                Actor, {"name": name, "age": age, "gender": gender},
+                Actor.name)
+        except HTTPException:
+            raise
         except Exception as e:
             print(e)
-            if isinstance(e, Already_Exists_Error):
-                raise Already_Exists_Error({
-                    "code": "Conflict",
-                    "description": "actor already exists in database"
-                }, 409)
-            else:
-                abort(422)
+            abort(422)
+        if actor_id is None:
+            raise Already_Exists_Error({
+                "code": "Conflict",
+                "description": "actor already exists in database"
+            }, 409)
+        # return success with the added actor id
+        return jsonify({
+            "success": True,
+            "created": actor_id
+        })
 
     # post a new movie
     @app.route('/movies', methods=['POST'])
     @requires_auth("post:movies")
+    @records_write
+    @invalidates("movies")
     def add_movie(payload):
         # get the request data
         data = request.get_json()
@@ -135,137 +1208,153 @@ def create_app(test_config=None):
             abort(400)
         try:
             title = data['title']
-            release_date = data.get('release_date')
-            the_movie = Movie.query.filter(Movie.title == title).one_or_none()
-            # check if movie already exists in database
-            if the_movie is not None:
-                raise Already_Exists_Error({
-                    "code": "Conflict",
-                    "description": "movie already exists in database"
-                }, 409)
-            # insert the movie to the database
-            movie = Movie(title=title, release_date=release_date)
-            movie.insert()
-            # return success with the added movie data
-            the_movie = Movie.query.filter(Movie.title == title).one_or_none()
-            movie_id = the_movie.id
-            return jsonify({
-                "success": True,
-                "created": movie_id
-            })
-
+            # a YYYY-MM-DD date is parsed here so every database takes it
+            release_date = parse_date(data.get('release_date')) or \
+                data.get('release_date')
+            # insert the movie to the database in one statement
+            # it returns None if the movie already exists in database
+            movie_id = create_item(
+                Movie, {"title": title, "release_date": release_date},
+                Movie.title)
+        except HTTPException:
+            raise
         except Exception as e:
             print(e)
-            if isinstance(e, Already_Exists_Error):
-                raise Already_Exists_Error({
-                    "code": "Conflict",
-                    "description": "movie already exists in database"
-                }, 409)
-            else:
-                abort(422)
+            abort(422)
+        if movie_id is None:
+            raise Already_Exists_Error({
+                "code": "Conflict",
+                "description": "movie already exists in database"
+            }, 409)
+        # return success with the added movie id
+        return jsonify({
+            "success": True,
+            "created": movie_id
+        })
+
+    # post many actors at once
+    @app.route("/actors/bulk", methods=['POST'])
+    @requires_auth("post:actors")
+    @records_write
+    @invalidates("actors")
+    def add_actors_bulk(payload):
+        return bulk_create(request, Actor, Actor.name, validate_actor)
+
+    # post many movies at once
+    @app.route("/movies/bulk", methods=['POST'])
+    @requires_auth("post:movies")
+    @records_write
+    @invalidates("movies")
+    def add_movies_bulk(payload):
+        return bulk_create(request, Movie, Movie.title, validate_movie)
+
+    # update many actors at once
+    @app.route("/actors", methods=['PATCH'])
+    @requires_auth("patch:actors")
+    @records_write
+    @invalidates("actors")
+    def update_actors_bulk(payload):
+        return bulk_update(
+            request, Actor, filter_actors, ACTOR_FILTERS,
+            validate_actor_update, "actor", actor_row)
+
+    # update many movies at once
+    @app.route("/movies", methods=['PATCH'])
+    @requires_auth("patch:movies")
+    @records_write
+    @invalidates("movies")
+    def update_movies_bulk(payload):
+        return bulk_update(
+            request, Movie, filter_movies, MOVIE_FILTERS,
+            validate_movie_update, "movie", movie_row)
+
+    # delete many actors at once
+    @app.route("/actors", methods=['DELETE'])
+    @requires_auth("delete:actors")
+    @records_write
+    @invalidates("actors", "castings")
+    def delete_actors_bulk(payload):
+        return bulk_delete(
+            request, Actor, filter_actors, ACTOR_FILTERS,
+            Casting.__table__.c.actor_id)
+
+    # delete many movies at once
+    @app.route("/movies", methods=['DELETE'])
+    @requires_auth("delete:movies")
+    @records_write
+    @invalidates("movies", "castings")
+    def delete_movies_bulk(payload):
+        return bulk_delete(
+            request, Movie, filter_movies, MOVIE_FILTERS,
+            Casting.__table__.c.movie_id)
 
     # update an existing actor data
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth("patch:actors")
+    @records_write
+    @invalidates("actors")
     def update_actor(payload, actor_id):
-        # check if the requested actor exists
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-        if actor is None:
-            abort(404)
         # get the request data
         data = request.get_json()
         if data is None:
             abort(400)
-        try:
-            name = data.get('name')
-            age = data.get('age')
-            gender = data.get('gender')
-            # update the actor information
-            if name is not None:
-                actor.name = name
-            if age is not None:
-                actor.age = age
-            if gender is not None:
-                actor.gender = gender
-            actor.update()
-            updated_actor = Actor.query.filter(
-                Actor.id == actor_id).one_or_none()
-            return jsonify({
-                "success": True,
-                "actor": updated_actor.format()
-            })
-        except Exception as e:
-            print(e)
-            abort(422)
+        # the fields to update
+        values = item_update_values(
+            data, validate_actor_update, ('name', 'age', 'gender'))
+        # update the actor in one statement, 404 if it doesn't exist,
+        # 412 if it isn't the version in If-Match
+        row = update_item(Actor, actor_id, values, get_if_match(request))
+        return item_response("actor", row, actor_row)
 
     # update an existing movie data
     @app.route("/movies/<int:movie_id>", methods=['PATCH'])
     @requires_auth("patch:movies")
+    @records_write
+    @invalidates("movies")
     def update_movie(payload, movie_id):
         # get the request data
         data = request.get_json()
         if data is None:
             abort(400)
-        # check if the requested movie exists
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-        if movie is None:
-            abort(404)
-        try:
-            title = data.get('title')
-            release_date = data.get('release_date')
-            # update the movie information
-            if title is not None:
-                movie.title = title
-            if release_date is not None:
-                movie.release_date = release_date
-            movie.update()
-            updated_movie = Movie.query.filter(
-                Movie.id == movie_id).one_or_none()
-            return jsonify({
-                "success": True,
-                "movie": updated_movie.format()
-            })
-        except Exception as e:
-            print(e)
-            abort(422)
+        # the fields to update
+        values = item_update_values(
+            data, validate_movie_update, ('title', 'release_date'))
+        # update the movie in one statement, 404 if it doesn't exist,
+        # 412 if it isn't the version in If-Match
+        row = update_item(Movie, movie_id, values, get_if_match(request))
+        return item_response("movie", row, movie_row)
 
     # delete an actor
     @app.route("/actors/<int:actor_id>", methods=['DELETE'])
     @requires_auth("delete:actors")
+    @records_write
+    @invalidates("actors", "castings")
     def delete_actor(payload, actor_id):
-        # check if the actor exists in the database
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
-        if actor is None:
-            abort(404)
-        try:
-            # delete actor from database
-            actor.delete()
-            return jsonify({
-                "success": True,
-                "deleted": actor.id
-            })
-        except Exception as e:
-            print(e)
-            abort(e)
+        # delete the actor (and its castings), 404 if it doesn't exist,
+        # 412 if it isn't the version in If-Match
+        delete_item(
+            Actor, actor_id, Casting.__table__.c.actor_id,
+            get_if_match(request))
+        return jsonify({
+            "success": True,
+            "deleted": actor_id
+        })
 
     # delete a movie
     @app.route("/movies/<int:movie_id>", methods=['DELETE'])
     @requires_auth("delete:movies")
+    @records_write
+    @invalidates("movies", "castings")
     def delete_movie(payload, movie_id):
-        # check if the movie exists in the database
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
-        if movie is None:
-            abort(404)
-        try:
-            # delete movie from database
-            movie.delete()
-            return jsonify({
-                "success": True,
-                "deleted": movie_id
-            })
-        except Exception as e:
-            print(e)
-            abort(e)
+        # delete the movie (and its castings), 404 if it doesn't exist,
+        # 412 if it isn't the version in If-Match
+        delete_item(
+            Movie, movie_id, Casting.__table__.c.movie_id,
+            get_if_match(request))
+        return jsonify({
+            "success": True,
+            "deleted": movie_id
+        })
 
     # Error Handling
 
@@ -293,6 +1382,30 @@ def create_app(test_config=None):
             "message": "method not allowed"
         }), 405
 
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": "payload too large"
+        }), 413
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        }), 503
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return jsonify({
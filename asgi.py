@@ -0,0 +1,316 @@
+import asyncio
+from types import SimpleNamespace
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_etags
+from app import app as flask_app
+from app import list_actors, list_movies, movie_actors, actor_movies
+from app import actor_detail, movie_detail, actors_table, movies_table
+from app import read_tables, response_etag
+from auth import AuthError, authenticate_async
+from cache import LocalBackend, response_cache, request_key
+from models import engine_options
+from replicas import ReplicaSet, DATABASE_READ_URLS, REPLICA_ERRORS
+from replicas import recent_writes
+from metrics import start_request, observe_request
+from encoding import dumps
+from changes import TooManySubscribersError, change_tables
+from changes import get_last_event_id, stream_async
+
+
+'''
+ASGI app
+    serves the read endpoints (GET /actors, /movies, /actors/<id>,
+    /movies/<id>, /movies/<id>/actors and /actors/<id>/movies) and the
+    change feed (GET /changes) with async
+    handlers on an async engine
+    (asyncpg on postgres), so a worker keeps serving other requests while
+    one waits on the database or on Auth0
+    every other route is the Flask app, run in a thread pool
+
+    run it with:
+        uvicorn asgi:app
+        gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+'''
+
+# the async driver of each database backend
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+# the same messages as the Flask error handlers
+ERROR_MESSAGES = {
+    400: "bad request",
+    404: "resource not found",
+    405: "method not allowed",
+    412: "precondition failed",
+    413: "payload too large",
+    422: "unprocessable",
+    500: "internal server error",
+    503: "service unavailable"
+}
+
+
+def async_database_url(database_url):
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise RuntimeError(f'no async driver for {backend} databases')
+    return url.set(drivername=ASYNC_DRIVERS[backend])
+
+
+# a blocking cache backend (redis) is called from a worker thread
+async def call_backend(backend, f, *args):
+    if isinstance(backend, LocalBackend):
+        return f(*args)
+    return await run_in_threadpool(f, *args)
+
+
+async def call_cache(f, *args):
+    return await call_backend(response_cache.backend, f, *args)
+
+
+def create_async_engine_for(database_path):
+    return create_async_engine(
+        async_database_url(database_path),
+        **engine_options(database_path, async_engine=True))
+
+
+# read_urls are the read replicas (DATABASE_READ_URLS by default)
+def create_asgi_app(flask_app, read_urls=DATABASE_READ_URLS):
+    database_path = flask_app.config['SQLALCHEMY_DATABASE_URI']
+    engine = create_async_engine_for(database_path)
+    async_session = sessionmaker(
+        engine, class_=AsyncSession, expire_on_commit=False)
+    read_replicas = ReplicaSet(
+        [create_async_engine_for(url) for url in read_urls])
+
+    def add_cors_headers(response):
+        # like the Flask after_request
+        response.headers.append(
+            'Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        response.headers.append(
+            'Access-Control-Allow-Headers',
+            'GET, POST, PATCH, DELETE, OPTIONS')
+        return response
+
+    def json_response(data, status_code):
+        body = dumps(data, flask_app.config['JSON_SORT_KEYS']) + b'\n'
+        return Response(body, status_code, media_type='application/json')
+
+    def error_response(status_code, message):
+        return add_cors_headers(json_response({
+            "success": False,
+            "error": status_code,
+            "message": message
+        }, status_code))
+
+    '''
+    read_endpoint(route, permission, tables, include, read, item) method
+        the async version of @requires_auth, @cached and @conditional
+        route is the name of the Flask view, for the request metrics
+        item is (table, name of the id path param) like for @conditional
+        read(request, session) returns the response data, it is one of
+        the read handlers of app.py and runs on the async session
+        (through run_sync, so it stays on the event loop)
+        the reads go to the replicas like with @reads_replica
+    '''
+
+    def read_endpoint(route, permission, table_names, include, read,
+                      item=None):
+        async def endpoint(request):
+            start_request(route)
+            response = await handle(request)
+            stats = observe_request(request.method, response.status_code)
+            if flask_app.config['DB_DEBUG_HEADERS']:
+                response.headers.update(stats.debug_headers())
+            return response
+
+        async def handle(request):
+            try:
+                payload = await authenticate_async(
+                    request.headers.get('Authorization'), permission)
+                args = MultiDict(request.query_params.multi_items())
+                tables = read_tables(table_names, include, args)
+                if_none_match = parse_etags(
+                    request.headers.get('If-None-Match'))
+                # a client reading its own writes reads from the
+                # primary, without the response cache
+                read_your_writes = bool(read_replicas.engines) and \
+                    await call_backend(
+                        recent_writes.backend, recent_writes.contains,
+                        payload)
+
+                key = None
+                if response_cache.enabled and not read_your_writes:
+                    key = await call_cache(
+                        request_key, request.url.path, args, payload, tables)
+                    entry = await call_cache(response_cache.get, key)
+                    if entry is not None:
+                        if entry['etag'] and \
+                                if_none_match.contains_weak(entry['etag']):
+                            response = Response(status_code=304)
+                        else:
+                            response = Response(
+                                entry['body'], 200,
+                                media_type=entry['mimetype'])
+                        if entry['etag']:
+                            response.headers['ETag'] = \
+                                '"%s"' % entry['etag']
+                        return add_cors_headers(response)
+
+                full_path = request.url.path + '?' + \
+                    request.scope['query_string'].decode('latin-1')
+                shim = SimpleNamespace(
+                    args=args, path_params=request.path_params)
+                item_key = item and (item[0], request.path_params[item[1]])
+
+                # the ETag and, unless it matches, the response data
+                async def read_from(bind):
+                    async with async_session(bind=bind) as session:
+                        etag = await session.run_sync(
+                            lambda sync_session: response_etag(
+                                full_path, table_names, include, args,
+                                item_key, sync_session))
+                        if etag is not None and \
+                                if_none_match.contains_weak(etag):
+                            return etag, None
+                        return etag, await session.run_sync(
+                            lambda sync_session: read(shim, sync_session))
+
+                replica = None
+                if read_replicas.engines and not read_your_writes:
+                    replica = await read_replicas.choose_async()
+                try:
+                    etag, data = await read_from(replica or engine)
+                except REPLICA_ERRORS as e:
+                    if replica is None:
+                        raise
+                    # the replica failed, read from the primary
+                    print(e)
+                    read_replicas.mark_failed(replica)
+                    etag, data = await read_from(engine)
+                if data is None:
+                    response = Response(status_code=304)
+                    response.headers['ETag'] = '"%s"' % etag
+                    return add_cors_headers(response)
+
+                response = json_response(data, 200)
+                if etag is not None:
+                    response.headers['ETag'] = '"%s"' % etag
+                if key is not None:
+                    await call_cache(response_cache.set, key, {
+                        'body': response.body.decode(),
+                        'mimetype': 'application/json',
+                        'etag': etag
+                    })
+                return add_cors_headers(response)
+            except AuthError as e:
+                return error_response(e.status_code, e.error)
+            except HTTPException as e:
+                return error_response(
+                    e.code, ERROR_MESSAGES.get(e.code, e.name.lower()))
+            except Exception as e:
+                print(e)
+                return error_response(500, ERROR_MESSAGES[500])
+
+        return endpoint
+
+    # GET /changes, the streams share the listener of the Flask app
+    change_feed = flask_app.extensions['changes']
+
+    async def stream_changes(request):
+        try:
+            payload = await authenticate_async(
+                request.headers.get('Authorization'), None)
+            tables = change_tables(request.query_params.get('tables'), payload)
+            last_event_id = get_last_event_id(
+                request.headers.get('Last-Event-ID'),
+                request.query_params.get('last_event_id'))
+            # the first subscribe waits for the listener to start
+            subscriber = await run_in_threadpool(
+                change_feed.subscribe, tables, asyncio.get_running_loop())
+        except AuthError as e:
+            return error_response(e.status_code, e.error)
+        except HTTPException as e:
+            return error_response(e.code, ERROR_MESSAGES[e.code])
+        except TooManySubscribersError as e:
+            print(e)
+            return error_response(503, ERROR_MESSAGES[503])
+        response = StreamingResponse(
+            stream_async(change_feed, subscriber, last_event_id,
+                         async_session, payload.get('exp')),
+            media_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        return add_cors_headers(response)
+
+    routes = [
+        Route("/actors", read_endpoint(
+            "get_actors", "get:actors", ["actors"], "movies", list_actors),
+            methods=['GET']),
+        Route("/movies", read_endpoint(
+            "get_movies", "get:movies", ["movies"], "actors", list_movies),
+            methods=['GET']),
+        Route("/actors/{actor_id:int}", read_endpoint(
+            "get_actor", "get:actors", ["actors"], "movies",
+            lambda request, session: actor_detail(
+                request.path_params['actor_id'], request, session),
+            (actors_table, 'actor_id')),
+            methods=['GET']),
+        Route("/movies/{movie_id:int}", read_endpoint(
+            "get_movie", "get:movies", ["movies"], "actors",
+            lambda request, session: movie_detail(
+                request.path_params['movie_id'], request, session),
+            (movies_table, 'movie_id')),
+            methods=['GET']),
+        Route("/movies/{movie_id:int}/actors", read_endpoint(
+            "get_movie_actors", "get:actors",
+            ["movies", "actors", "castings"], None,
+            lambda request, session: movie_actors(
+                request.path_params['movie_id'], session)),
+            methods=['GET']),
+        Route("/actors/{actor_id:int}/movies", read_endpoint(
+            "get_actor_movies", "get:movies",
+            ["actors", "movies", "castings"], None,
+            lambda request, session: actor_movies(
+                request.path_params['actor_id'], session)),
+            methods=['GET']),
+        Route("/changes", stream_changes, methods=['GET']),
+        # everything else (writes, exports, login pages) is the Flask app
+        Mount("", app=WSGIMiddleware(flask_app))
+    ]
+
+    # the first connection runs the engine's first_connect hooks under a
+    # thread lock, two requests racing for it on the event loop deadlock,
+    # so it is made before serving
+    # (the replicas are checked, which connects them, each choose_async
+    # checks the next one)
+    async def connect_engine():
+        async with engine.connect():
+            pass
+        for index in range(len(read_replicas.engines)):
+            await read_replicas.choose_async()
+
+    async def dispose_engine():
+        await engine.dispose()
+        for replica in read_replicas.engines:
+            await replica.dispose()
+
+    asgi_app = Starlette(
+        routes=routes, on_startup=[connect_engine],
+        on_shutdown=[dispose_engine])
+    asgi_app.state.engine = engine
+    asgi_app.state.read_replicas = read_replicas
+    return asgi_app
+
+
+app = create_asgi_app(flask_app)
@@ -1,15 +1,31 @@
+import asyncio
+import hashlib
 import json
 import os
+import threading
+import time
+from collections import OrderedDict
 from flask import request
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
+from metrics import timed_phase, TOKEN_CACHE_LOOKUPS
 
 
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
 ALGORITHMS = os.environ['ALGORITHMS']
 API_AUDIENCE = os.environ['API_AUDIENCE']
 
+# JWKS settings, JWKS_URL can point at a local file (file:///...)
+# or a stub server to run without an Auth0 tenant
+JWKS_URL = os.environ.get(
+    'JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_TTL = int(os.environ.get('JWKS_TTL', 600))
+JWKS_REFETCH_INTERVAL = int(os.environ.get('JWKS_REFETCH_INTERVAL', 30))
+JWKS_TIMEOUT = float(os.environ.get('JWKS_TIMEOUT', 5))
+# max number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -23,11 +39,194 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# JWKS key store
+
+'''
+JWKSStore class
+    keeps the signing keys from the JWKS url in memory by key id (kid)
+    the first lookup fetches the keys (blocking)
+    once the keys are older than ttl seconds they are still used while
+    a background thread refetches them (stale-while-revalidate)
+    an unknown kid forces a refetch, at most once every
+    refetch_interval seconds so garbage tokens can't hammer Auth0
+'''
+
+
+class JWKSStore:
+    def __init__(self, url, ttl=JWKS_TTL,
+                 refetch_interval=JWKS_REFETCH_INTERVAL,
+                 timeout=JWKS_TIMEOUT):
+        self.url = url
+        self.ttl = ttl
+        self.refetch_interval = refetch_interval
+        self.timeout = timeout
+        self.keys = {}
+        self.fetched_at = None
+        self.last_refetch = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def fetch(self):
+        # download the JWKS and replace the stored keys
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+        keys = {}
+        for key in jwks['keys']:
+            if 'kid' not in key:
+                continue
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        self.keys = keys
+        self.fetched_at = time.monotonic()
+        return keys
+
+    def preload(self):
+        # fetch the keys up front, i.e. at worker boot
+        with self.lock:
+            self.fetch()
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.background_refresh, daemon=True).start()
+
+    def background_refresh(self):
+        try:
+            self.fetch()
+        except Exception as e:
+            # keep serving the stale keys, retry on a later lookup
+            print(e)
+        finally:
+            self.refreshing = False
+
+    def can_refetch(self, now):
+        if self.last_refetch is not None and \
+                now - self.last_refetch < self.refetch_interval:
+            return False
+        self.last_refetch = now
+        return True
+
+    def get_key(self, kid):
+        try:
+            if self.fetched_at is None:
+                with self.lock:
+                    # another request may have fetched while we waited
+                    if self.fetched_at is None:
+                        self.fetch()
+                        self.last_refetch = time.monotonic()
+            elif time.monotonic() - self.fetched_at > self.ttl:
+                self.refresh_in_background()
+
+            key = self.keys.get(kid)
+            if key is None:
+                with self.lock:
+                    key = self.keys.get(kid)
+                    if key is None and self.can_refetch(time.monotonic()):
+                        key = self.fetch().get(kid)
+        except Exception as e:
+            print(e)
+            raise AuthError({
+                'code': 'jwks_unavailable',
+                'description': 'Unable to fetch the signing keys.'
+            }, 503)
+        return key
+
+    async def get_key_async(self, kid):
+        # fresh known keys don't need any io, the others are looked up
+        # in a worker thread so the event loop never blocks on a fetch
+        key = self.keys.get(kid)
+        if key is not None and self.fetched_at is not None:
+            if time.monotonic() - self.fetched_at > self.ttl:
+                self.refresh_in_background()
+            return key
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.get_key, kid)
+
+
+jwks_store = JWKSStore(JWKS_URL)
+
+
+# Verified token cache
+
+'''
+TokenCache class
+    a bounded LRU of already verified token payloads
+    keyed by the sha256 digest of the token (the raw token isn't stored)
+    an entry is dropped once the token's exp has passed
+    tokens without an exp claim are never cached
+    hits and misses are counted to check how well it works
+'''
+
+
+class TokenCache:
+    def __init__(self, max_size=TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= time.time():
+                # the token expired, it has to be verified (and rejected)
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                TOKEN_CACHE_LOOKUPS.labels('miss').inc()
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            TOKEN_CACHE_LOOKUPS.labels('hit').inc()
+            return entry[0]
+
+    def set(self, token, payload):
+        exp = payload.get('exp')
+        if self.max_size <= 0 or not isinstance(exp, (int, float)):
+            return
+        key = self.digest(token)
+        with self.lock:
+            self.entries[key] = (payload, exp)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self.entries),
+            'max_size': self.max_size
+        }
+
+
+token_cache = TokenCache()
+
+
 # Auth Header
 
 '''
-get_token_auth_header() method
+get_token_auth_header(header) method
     it attempts to get the header from the request
+    (or uses the given header value, i.e. outside of flask)
         it raises an AuthError if no header is present
     it attempts to split bearer and the token
         it raises an AuthError if the header is malformed
@@ -35,9 +234,10 @@ get_token_auth_header() method
 '''
 
 
-def get_token_auth_header():
+def get_token_auth_header(header=None):
     # getting the request authorization header
-    header = request.headers.get('Authorization', None)
+    if header is None:
+        header = request.headers.get('Authorization', None)
     if not header:
         raise AuthError({
             "code": "authorization_header_missing",
@@ -95,7 +295,8 @@ def check_permissions(permission, payload):
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it verifys the token using Auth0 /.well-known/jwks.json
+    it verifys the token using the key from jwks_store
+    (cached from Auth0 /.well-known/jwks.json)
     it decodes the payload from the token
     it validates the claims
     returns the decoded payload
@@ -105,26 +306,17 @@ def check_permissions(permission, payload):
 '''
 
 
-def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+def get_unverified_kid(token):
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+
+def decode_jwt(token, rsa_key):
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -160,13 +352,26 @@ def verify_decode_jwt(token):
             }, 400)
 
 
+def verify_decode_jwt(token):
+    rsa_key = jwks_store.get_key(get_unverified_kid(token))
+    return decode_jwt(token, rsa_key)
+
+
+# the same, without blocking the event loop on a key fetch
+async def verify_decode_jwt_async(token):
+    rsa_key = await jwks_store.get_key_async(get_unverified_kid(token))
+    return decode_jwt(token, rsa_key)
+
+
 '''
 @requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'), None only
+        verifies the token (the handler checks the permissions)
 
     it uses the get_token_auth_header method to get the token
-    it uses the verify_decode_jwt method to decode the jwt
+    it uses the payload from token_cache if the token was already verified
+    otherwise it uses the verify_decode_jwt method to decode the jwt
 
     it uses the check_permissions method validate
     claims and check the requested permission
@@ -183,9 +388,33 @@ def requires_auth(permission=''):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
+            payload = token_cache.get(token)
+            if payload is None:
+                with timed_phase('auth'):
+                    payload = verify_decode_jwt(token)
+                token_cache.set(token, payload)
+            if permission is not None:
+                check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
+
+
+'''
+authenticate_async(header, permission) method
+    the requires_auth steps for the async (ASGI) handlers
+    returns the decoded payload
+'''
+
+
+async def authenticate_async(header, permission=''):
+    token = get_token_auth_header(header or '')
+    payload = token_cache.get(token)
+    if payload is None:
+        with timed_phase('auth'):
+            payload = await verify_decode_jwt_async(token)
+        token_cache.set(token, payload)
+    if permission is not None:
+        check_permissions(permission, payload)
+    return payload
@@ -0,0 +1,174 @@
+'''
+group commit benchmark
+    inserts actors with POST /actors through real gunicorn workers over
+    HTTP, from concurrent clients, in three setups:
+    - sync: sync workers, one request at a time per worker, each row is
+      committed by its own request (the Procfile)
+    - gthread: threaded workers, still one commit per row
+    - gthread_group_commit: threaded workers with GROUP_COMMIT, the rows
+      of the concurrent requests of a worker share one commit
+    uses the local JWKS and tokens of load_test.py
+
+    usage:
+        python benchmarks/group_commit_benchmark.py [--clients 32]
+            [--workers 2] [--threads 16] [--duration 10]
+            [--database-url postgresql://localhost/CA_bench]
+            [--max-batch 100] [--max-wait-ms 5] [--setups sync,gthread]
+
+    prints one JSON object per setup with the rows per second, the errors,
+    the p50/p99 latency of one POST (in ms) and, with GROUP_COMMIT, the
+    mean number of rows per batch (from /metrics)
+'''
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from load_test import AUTH0_DOMAIN, API_AUDIENCE  # noqa: E402
+from load_test import make_keys, make_token, serve_jwks  # noqa: E402
+from load_test import free_port, percentile, Worker  # noqa: E402
+
+SETUPS = {
+    'sync': ['-k', 'sync'],
+    'gthread': ['-k', 'gthread'],
+    'gthread_group_commit': ['-k', 'gthread']
+}
+
+
+def start_gunicorn(setup, args, env):
+    port = free_port()
+    command = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '-b', f'127.0.0.1:{port}', '-w', str(args.workers)] + SETUPS[setup]
+    if setup != 'sync':
+        command += ['--threads', str(args.threads)]
+    env = dict(env, PROMETHEUS_MULTIPROC_DIR=tempfile.mkdtemp(),
+               GROUP_COMMIT=str(setup == 'gthread_group_commit').lower())
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            metrics(port)
+            return server, port
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f'gunicorn did not start on port {port}')
+
+
+def metrics(port):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        connection.request('GET', '/metrics')
+        return connection.getresponse().read().decode()
+    finally:
+        connection.close()
+
+
+# the mean of group_commit_batch_rows from the text of /metrics
+def rows_per_batch(text):
+    values = {}
+    for line in text.splitlines():
+        name, _, value = line.partition(' ')
+        if name in ('group_commit_batch_rows_sum',
+                    'group_commit_batch_rows_count'):
+            values[name] = float(value)
+    count = values.get('group_commit_batch_rows_count')
+    if not count:
+        return None
+    return round(values['group_commit_batch_rows_sum'] / count, 2)
+
+
+def run(setup, args, env, token):
+    prefix = f'group commit benchmark {setup} {time.time()}'
+
+    def add_actor(worker, n):
+        return 'POST', '/actors', {
+            'name': f'{prefix} {worker.index} {n}',
+            'age': 18 + n % 70,
+            'gender': 'female' if n % 2 else 'male'
+        }, (200,)
+
+    server, port = start_gunicorn(setup, args, env)
+    try:
+        start = time.monotonic()
+        workers = [
+            Worker(index, port, token, {'add_actor': add_actor},
+                   start + args.duration)
+            for index in range(args.clients)]
+        threads = [threading.Thread(target=worker.run) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.monotonic() - start
+        text = metrics(port)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = sorted(
+        value for worker in workers for value in worker.latencies['add_actor'])
+    result = {
+        'setup': setup,
+        'workers': args.workers,
+        'threads': 1 if setup == 'sync' else args.threads,
+        'clients': args.clients,
+        'rows_per_second': round(len(latencies) / duration, 2),
+        'errors': sum(worker.errors['add_actor'] for worker in workers),
+        'p50_ms': percentile(latencies, 50),
+        'p99_ms': percentile(latencies, 99)
+    }
+    if setup == 'gthread_group_commit':
+        result['rows_per_batch'] = rows_per_batch(text)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--database-url')
+    parser.add_argument('--max-batch', type=int, default=100)
+    parser.add_argument('--max-wait-ms', type=float, default=5)
+    parser.add_argument('--setups', help='comma separated setup names')
+    args = parser.parse_args()
+
+    private_key, jwks = make_keys()
+    env = dict(
+        os.environ,
+        DATABASE_URL=args.database_url or 'sqlite:///' + os.path.join(
+            tempfile.mkdtemp(), 'group_commit.db'),
+        AUTH0_DOMAIN=AUTH0_DOMAIN,
+        ALGORITHMS='RS256',
+        API_AUDIENCE=API_AUDIENCE,
+        JWKS_URL=serve_jwks(jwks),
+        GROUP_COMMIT_MAX_BATCH=str(args.max_batch),
+        GROUP_COMMIT_MAX_WAIT_MS=str(args.max_wait_ms),
+        # the inserts waiting on the database lock aren't slow queries
+        SLOW_QUERY_MS=os.environ.get('SLOW_QUERY_MS', '0'))
+    # the app reads its settings when it is imported
+    os.environ.update(env)
+    from app import app
+    from models import db
+
+    with app.app_context():
+        db.create_all()
+    token = make_token(private_key)
+    setups = args.setups.split(',') if args.setups else list(SETUPS)
+    for setup in setups:
+        print(json.dumps(run(setup, args, env, token)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+JSON encoding microbenchmark
+    encodes typical response bodies (pages of actors and movies, with and
+    without the related rows, and export rows with date objects)
+    with every JSON encoder of encoding.py, and with Flask's default
+    encoder (what jsonify used before)
+
+    usage:
+        python benchmarks/json_benchmark.py [--number 2000]
+
+    prints one JSON object per payload and encoder with the
+    encodes per second and the size of the body
+'''
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flask.json import JSONEncoder  # noqa: E402
+from encoding import ENCODERS, orjson  # noqa: E402
+
+
+def actor(n):
+    return {"id": n, "name": f"actor {n}", "age": 18 + n % 70,
+            "gender": "female" if n % 2 else "male"}
+
+
+def movie(n, release_date=None):
+    return {"id": n, "title": f"movie {n}",
+            "release_date": release_date or
+            datetime.date(1950 + n % 75, 1 + n % 12, 1 + n % 28).isoformat()}
+
+
+def page(key, items):
+    return {"success": True, key: items, f"{key}_count": 100000,
+            f"{key}_count_type": "exact",
+            "next_cursor": "WzEwMF0="}
+
+
+PAYLOADS = {
+    'actors_page': page('actors', [actor(n) for n in range(100)]),
+    'movies_page': page('movies', [movie(n) for n in range(100)]),
+    'actors_page_include_movies': page('actors', [
+        dict(actor(n), movies=[movie(n * 5 + i) for i in range(5)])
+        for n in range(100)]),
+    'movies_page_include_actors': page('movies', [
+        dict(movie(n), actors=[actor(n * 5 + i) for i in range(5)])
+        for n in range(100)]),
+    # export rows keep the dates as date objects
+    'export_movies': [
+        movie(n, datetime.date(2000, 1, 1 + n % 28)) for n in range(1000)],
+}
+
+
+def flask_default(data, sort_keys=True):
+    return json.dumps(
+        data, cls=JSONEncoder, sort_keys=sort_keys,
+        separators=(',', ':')).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+
+    encoders = {'flask_default': flask_default}
+    encoders.update(ENCODERS)
+    if orjson is None:
+        del encoders['orjson']
+    for payload_name, payload in PAYLOADS.items():
+        for encoder_name, encode in encoders.items():
+            seconds = timeit.timeit(
+                lambda: encode(payload, True), number=args.number)
+            print(json.dumps({
+                'payload': payload_name,
+                'encoder': encoder_name,
+                'encodes_per_second': round(args.number / seconds, 1),
+                'bytes': len(encode(payload, True))
+            }))
+
+
+if __name__ == '__main__':
+    main()
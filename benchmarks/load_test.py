@@ -0,0 +1,466 @@
+'''
+load test
+    measures the throughput of every route without an Auth0 tenant or a
+    production database:
+    - makes an RSA keypair, serves its JWKS on a local port and signs
+      RS256 tokens with it (JWKS_URL points the app at the local JWKS)
+    - seeds the database (a temporary sqlite file by default, or a local
+      postgres with --database-url) with --actors, --movies and --castings
+    - starts the app (Flask or the ASGI app) on a local port and drives
+      every route from --concurrency threads for --duration seconds
+
+    usage:
+        python benchmarks/load_test.py [--server flask|asgi]
+            [--database-url postgresql://localhost/CA_bench]
+            [--actors 10000] [--movies 10000] [--castings 50000]
+            [--concurrency 16] [--duration 10] [--output results.jsonl]
+
+    prints one JSON object per route with its requests per second, errors
+    and p50/p95/p99 latency (in ms), then one for all the routes
+    with the commit and settings, so runs can be compared between commits
+'''
+import argparse
+import base64
+import datetime
+import http.client
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwt
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+AUTH0_DOMAIN = 'load-test.local'
+API_AUDIENCE = 'load-test'
+KID = 'load-test'
+PERMISSIONS = [
+    'get:actors', 'get:movies', 'post:actors', 'post:movies',
+    'patch:actors', 'patch:movies', 'delete:actors', 'delete:movies'
+]
+SEED_BATCH_SIZE = 10000
+BULK_ITEMS = 100
+
+
+# Local Auth0
+
+def b64_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def make_keys():
+    public_key, private_key = rsa.newkeys(2048)
+    jwks = {'keys': [{
+        'kty': 'RSA',
+        'kid': KID,
+        'use': 'sig',
+        'n': b64_int(public_key.n),
+        'e': b64_int(public_key.e)
+    }]}
+    return private_key.save_pkcs1().decode(), jwks
+
+
+def make_token(private_key, permissions=PERMISSIONS):
+    now = int(time.time())
+    return jwt.encode({
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'aud': API_AUDIENCE,
+        'sub': 'load-test',
+        'iat': now,
+        'exp': now + 86400,
+        'permissions': permissions
+    }, private_key, algorithm='RS256', headers={'kid': KID})
+
+
+def serve_jwks(jwks):
+    body = json.dumps(jwks).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}/.well-known/jwks.json'
+
+
+# Seeding
+
+def insert_rows(db, table, rows):
+    for start in range(0, len(rows), SEED_BATCH_SIZE):
+        db.session.execute(table.insert(), rows[start:start + SEED_BATCH_SIZE])
+    db.session.commit()
+
+
+def seed(args):
+    from models import db, Actor, Movie, Casting
+
+    db.create_all()
+    count = Actor.query.count()
+    insert_rows(db, Actor.__table__, [{
+        'name': f'load test actor {n}',
+        'age': 18 + n % 70,
+        'gender': 'female' if n % 2 else 'male'
+    } for n in range(count, args.actors)])
+    count = Movie.query.count()
+    insert_rows(db, Movie.__table__, [{
+        'title': f'load test movie {n}',
+        'release_date': datetime.date(1950 + n % 75, 1 + n % 12, 1 + n % 28)
+    } for n in range(count, args.movies)])
+
+    actor_ids = [row.id for row in db.session.query(Actor.id)]
+    movie_ids = [row.id for row in db.session.query(Movie.id)]
+    existing = set(db.session.query(Casting.actor_id, Casting.movie_id))
+    wanted = min(args.castings, len(actor_ids) * len(movie_ids))
+    rng = random.Random(0)
+    castings = set()
+    while len(existing) + len(castings) < wanted:
+        pair = (rng.choice(actor_ids), rng.choice(movie_ids))
+        if pair not in existing:
+            castings.add(pair)
+    insert_rows(db, Casting.__table__, [
+        {'actor_id': actor_id, 'movie_id': movie_id}
+        for actor_id, movie_id in castings])
+    return actor_ids, movie_ids
+
+
+# Servers
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(kind, flask_app):
+    port = free_port()
+    if kind == 'asgi':
+        import uvicorn
+        from asgi import create_asgi_app
+        server = uvicorn.Server(uvicorn.Config(
+            create_asgi_app(flask_app), host='127.0.0.1', port=port,
+            log_level='warning'))
+        # the server runs in a thread, the main thread keeps the signals
+        server.install_signal_handlers = lambda: None
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+    else:
+        from werkzeug.serving import make_server, WSGIRequestHandler
+
+        class QuietRequestHandler(WSGIRequestHandler):
+            def log_request(self, *args):
+                pass
+
+        server = make_server(
+            '127.0.0.1', port, flask_app, threaded=True,
+            request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return port
+
+
+# Routes
+
+'''
+every route is a function of the worker and a counter that returns
+(method, path, json body, the statuses that count as a success)
+a route may send untimed requests first, i.e. to create the row it deletes
+'''
+
+
+def make_routes(actor_ids, movie_ids):
+    def unique(worker, n):
+        return f'{worker.index}-{n}-{time.time_ns()}'
+
+    def create(worker, path, body):
+        status, data = worker.send('POST', path, body)
+        return json.loads(data)['created'] if status == 200 else 0
+
+    def create_bulk(worker, path, rows):
+        status, data = worker.send('POST', path, rows)
+        if status != 200:
+            return [0]
+        return [result['id'] for result in json.loads(data)['results']]
+
+    return {
+        'get_actors': lambda worker, n: (
+            'GET', '/actors', None, (200,)),
+        'get_actors_page': lambda worker, n: (
+            'GET', f'/actors?page={1 + n % 50}&count=none', None, (200,)),
+        'get_actors_include_movies': lambda worker, n: (
+            'GET', '/actors?include=movies&limit=50', None, (200,)),
+        'get_actors_filtered': lambda worker, n: (
+            'GET', '/actors?gender=female&min_age=30&max_age=40&sort=-age',
+            None, (200,)),
+        'get_movies': lambda worker, n: (
+            'GET', '/movies', None, (200,)),
+        'get_movies_include_actors': lambda worker, n: (
+            'GET', '/movies?include=actors&limit=50', None, (200,)),
+        'get_movies_filtered': lambda worker, n: (
+            'GET', '/movies?min_release_date=2000-1-1&sort=release_date',
+            None, (200,)),
+        'get_actor': lambda worker, n: (
+            'GET', f'/actors/{worker.rng.choice(actor_ids)}', None, (200,)),
+        'get_actor_include_movies': lambda worker, n: (
+            'GET', f'/actors/{worker.rng.choice(actor_ids)}?include=movies',
+            None, (200,)),
+        'get_movie': lambda worker, n: (
+            'GET', f'/movies/{worker.rng.choice(movie_ids)}', None, (200,)),
+        'get_actors_by_ids': lambda worker, n: (
+            'GET', '/actors?count=none&ids=' + ','.join(
+                str(actor_id) for actor_id in
+                worker.rng.sample(actor_ids, min(50, len(actor_ids)))),
+            None, (200,)),
+        'get_movies_fields': lambda worker, n: (
+            'GET', '/movies?fields=title&limit=100&count=none', None, (200,)),
+        'export_actors': lambda worker, n: (
+            'GET', '/actors/export', None, (200,)),
+        'export_movies': lambda worker, n: (
+            'GET', '/movies/export?format=csv', None, (200,)),
+        'get_movie_actors': lambda worker, n: (
+            'GET', f'/movies/{worker.rng.choice(movie_ids)}/actors',
+            None, (200,)),
+        'get_actor_movies': lambda worker, n: (
+            'GET', f'/actors/{worker.rng.choice(actor_ids)}/movies',
+            None, (200,)),
+        'add_casting': lambda worker, n: (
+            'POST', f'/movies/{worker.rng.choice(movie_ids)}/actors',
+            {'actor_id': worker.rng.choice(actor_ids)}, (200, 409)),
+        'delete_casting': lambda worker, n: (
+            'DELETE', f'/movies/{worker.rng.choice(movie_ids)}/actors/'
+            f'{worker.rng.choice(actor_ids)}', None, (200, 404)),
+        'add_actor': lambda worker, n: (
+            'POST', '/actors', {
+                'name': 'actor ' + unique(worker, n), 'age': 30,
+                'gender': 'female'}, (200,)),
+        'add_movie': lambda worker, n: (
+            'POST', '/movies', {
+                'title': 'movie ' + unique(worker, n),
+                'release_date': '2020-1-1'}, (200,)),
+        'add_actors_bulk': lambda worker, n: (
+            'POST', '/actors/bulk', [{
+                'name': f'bulk actor {unique(worker, n)}-{i}', 'age': 30,
+                'gender': 'male'} for i in range(BULK_ITEMS)], (200,)),
+        'add_movies_bulk': lambda worker, n: (
+            'POST', '/movies/bulk', [{
+                'title': f'bulk movie {unique(worker, n)}-{i}',
+                'release_date': '2020-1-1'} for i in range(BULK_ITEMS)],
+            (200,)),
+        'update_actor': lambda worker, n: (
+            'PATCH', f'/actors/{worker.rng.choice(actor_ids)}',
+            {'age': 18 + n % 70}, (200,)),
+        'update_movie': lambda worker, n: (
+            'PATCH', f'/movies/{worker.rng.choice(movie_ids)}',
+            {'title': 'movie ' + unique(worker, n)}, (200,)),
+        'update_actors_bulk': lambda worker, n: (
+            'PATCH', '/actors', {
+                'ids': worker.rng.sample(
+                    actor_ids, min(BULK_ITEMS, len(actor_ids))),
+                'age': 18 + n % 70}, (200,)),
+        'update_movies_bulk': lambda worker, n: (
+            'PATCH', '/movies', {
+                'ids': worker.rng.sample(
+                    movie_ids, min(BULK_ITEMS, len(movie_ids))),
+                'release_date': '2020-1-1'}, (200,)),
+        'delete_actors_bulk': lambda worker, n: (
+            'DELETE', '/actors', {'ids': create_bulk(
+                worker, '/actors/bulk', [{
+                    'name': f'deleted bulk actor {unique(worker, n)}-{i}',
+                    'age': 30, 'gender': 'male'}
+                    for i in range(BULK_ITEMS)])}, (200,)),
+        'delete_movies_bulk': lambda worker, n: (
+            'DELETE', '/movies', {'ids': create_bulk(
+                worker, '/movies/bulk', [{
+                    'title': f'deleted bulk movie {unique(worker, n)}-{i}',
+                    'release_date': '2020-1-1'}
+                    for i in range(BULK_ITEMS)])}, (200,)),
+        'delete_actor': lambda worker, n: (
+            'DELETE', '/actors/%s' % create(worker, '/actors', {
+                'name': 'deleted actor ' + unique(worker, n), 'age': 30,
+                'gender': 'male'}), None, (200,)),
+        'delete_movie': lambda worker, n: (
+            'DELETE', '/movies/%s' % create(worker, '/movies', {
+                'title': 'deleted movie ' + unique(worker, n),
+                'release_date': '2020-1-1'}), None, (200,)),
+        'metrics': lambda worker, n: (
+            'GET', '/metrics', None, (200,)),
+        'login': lambda worker, n: (
+            'GET', '/login', None, (200,)),
+    }
+
+
+# Load
+
+class Worker:
+    def __init__(self, index, port, token, routes, deadline):
+        self.index = index
+        self.port = port
+        self.headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        self.routes = routes
+        self.deadline = deadline
+        self.rng = random.Random(index)
+        self.connection = http.client.HTTPConnection('127.0.0.1', port)
+        self.latencies = {name: [] for name in routes}
+        self.errors = dict.fromkeys(routes, 0)
+
+    def send(self, method, path, body=None):
+        try:
+            self.connection.request(
+                method, path,
+                body=None if body is None else json.dumps(body),
+                headers=self.headers)
+            response = self.connection.getresponse()
+            return response.status, response.read()
+        except (http.client.HTTPException, OSError):
+            # the server closed the connection, open a new one next time
+            self.connection.close()
+            raise
+
+    def run(self):
+        names = list(self.routes)
+        n = self.index
+        while time.monotonic() < self.deadline:
+            name = names[n % len(names)]
+            n += 1
+            try:
+                method, path, body, ok = self.routes[name](self, n)
+                start = time.perf_counter()
+                status, _ = self.send(method, path, body)
+                elapsed = time.perf_counter() - start
+            except Exception:
+                self.errors[name] += 1
+                continue
+            self.latencies[name].append(elapsed)
+            if status not in ok:
+                self.errors[name] += 1
+
+
+def percentile(values, p):
+    # nearest-rank percentile of sorted values, in ms
+    if not values:
+        return None
+    return round(values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+                 * 1000, 3)
+
+
+def summary(route, latencies, errors, duration):
+    latencies = sorted(latencies)
+    return {
+        'route': route,
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / duration, 2),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99)
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask')
+    parser.add_argument('--database-url')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--castings', type=int, default=50000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--routes', help='comma separated route names')
+    parser.add_argument('--output', help='also write the results here')
+    args = parser.parse_args()
+
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'load_test.db')
+    private_key, jwks = make_keys()
+    # the app reads its settings when it is imported
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['AUTH0_DOMAIN'] = AUTH0_DOMAIN
+    os.environ['ALGORITHMS'] = 'RS256'
+    os.environ['API_AUDIENCE'] = API_AUDIENCE
+    os.environ['JWKS_URL'] = serve_jwks(jwks)
+
+    from app import app
+
+    with app.app_context():
+        actor_ids, movie_ids = seed(args)
+    routes = make_routes(actor_ids, movie_ids)
+    if args.routes:
+        routes = {name: routes[name] for name in args.routes.split(',')}
+    port = start_server(args.server, app)
+    token = make_token(private_key)
+
+    start = time.monotonic()
+    workers = [
+        Worker(index, port, token, routes, start + args.duration)
+        for index in range(args.concurrency)]
+    threads = [threading.Thread(target=worker.run) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+
+    results = []
+    for name in routes:
+        results.append(summary(
+            name,
+            [value for worker in workers for value in worker.latencies[name]],
+            sum(worker.errors[name] for worker in workers),
+            duration))
+    total = summary(
+        'total',
+        [value for worker in workers
+         for values in worker.latencies.values() for value in values],
+        sum(sum(worker.errors.values()) for worker in workers),
+        duration)
+    total.update({
+        'commit': git_commit(),
+        'server': args.server,
+        'database': database_url.split(':')[0],
+        'actors': args.actors,
+        'movies': args.movies,
+        'castings': args.castings,
+        'concurrency': args.concurrency,
+        'duration': round(duration, 2)
+    })
+    results.append(total)
+
+    lines = [json.dumps(result) for result in results]
+    print('\n'.join(lines))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+if __name__ == '__main__':
+    main()
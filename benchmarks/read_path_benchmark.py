@@ -0,0 +1,111 @@
+'''
+read path benchmark
+    compares the Core read handlers of GET /actors and GET /movies
+    (list_actors/list_movies, plain rows turned into dicts) with the ORM
+    path they replaced (ORM instances loaded with selectinload and
+    turned into dicts with format())
+
+    usage:
+        python benchmarks/read_path_benchmark.py [--pages 200]
+            [--database-url postgresql://localhost/CA_bench]
+            [--actors 10000] [--movies 10000] [--castings 50000]
+
+    prints one JSON object per page url with the pages per second of
+    each path (handler and JSON encoding, a new session per page)
+'''
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+CASES = [
+    '/actors?limit=100&count=none',
+    '/actors?limit=100&count=none&include=movies',
+    '/movies?limit=100&count=none',
+    '/movies?limit=100&count=none&include=actors',
+]
+
+
+def orm_list(request, session, model, include, format_item,
+             format_with_include):
+    # the ORM read path of GET /actors and GET /movies before the Core one
+    from sqlalchemy import select
+    from sqlalchemy.orm import selectinload
+
+    selection = select(model).order_by(model.id).limit(
+        request.args.get('limit', type=int))
+    if request.args.get('include') == include:
+        selection = selection.options(
+            selectinload(getattr(model, include)))
+        format_item = format_with_include
+    return [format_item(item)
+            for item in session.execute(selection).scalars().all()]
+
+
+def run(app, db, handler, url, pages):
+    from flask import json as flask_json, request
+
+    start = time.perf_counter()
+    for _ in range(pages):
+        with app.test_request_context(url):
+            flask_json.dumps(handler(request, db.session))
+            db.session.remove()
+    return pages / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--database-url')
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=10000)
+    parser.add_argument('--castings', type=int, default=50000)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'read_path.db')
+    os.environ.setdefault('AUTH0_DOMAIN', 'benchmark.local')
+    os.environ.setdefault('ALGORITHMS', 'RS256')
+    os.environ.setdefault('API_AUDIENCE', 'benchmark')
+
+    from app import app, list_actors, list_movies
+    from models import db, Actor, Movie
+    from load_test import seed
+
+    paths = {
+        'actors': {
+            'core': list_actors,
+            'orm': lambda request, session: orm_list(
+                request, session, Actor, 'movies', Actor.format,
+                Actor.format_with_movies)
+        },
+        'movies': {
+            'core': list_movies,
+            'orm': lambda request, session: orm_list(
+                request, session, Movie, 'actors', Movie.format,
+                Movie.format_with_actors)
+        }
+    }
+    with app.app_context():
+        seed(args)
+        for url in CASES:
+            handlers = paths[url.split('?')[0].strip('/')]
+            # warm up the connection and the statement caches
+            for handler in handlers.values():
+                run(app, db, handler, url, 5)
+            orm = run(app, db, handlers['orm'], url, args.pages)
+            core = run(app, db, handlers['core'], url, args.pages)
+            print(json.dumps({
+                'url': url,
+                'orm_pages_per_second': round(orm, 2),
+                'core_pages_per_second': round(core, 2),
+                'speedup': round(core / orm, 2)
+            }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+'''
+search benchmark
+    seeds a postgres database with a million actors and movies (by default)
+    and runs EXPLAIN ANALYZE on the queries built by the actors/movies
+    filters, to check they stay index-backed (no sequential scans)
+
+    usage:
+        BENCHMARK_DATABASE_URL=postgresql://localhost/CA_bench \
+            python benchmarks/search_benchmark.py [--rows 1000000]
+
+    prints one JSON object per query and exits with 1 if any query
+    does a sequential scan on actors or movies
+'''
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+DATABASE_URL = os.environ['BENCHMARK_DATABASE_URL']
+os.environ['DATABASE_URL'] = DATABASE_URL
+os.environ.setdefault('AUTH0_DOMAIN', 'benchmark.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'benchmark')
+
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.dialects import postgresql  # noqa: E402
+from app import app, filter_actors, filter_movies  # noqa: E402
+from models import db, Actor, Movie  # noqa: E402
+from flask import request  # noqa: E402
+
+
+CASES = [
+    ('actors', '/actors?gender=female&min_age=30&max_age=40'),
+    ('actors', '/actors?min_age=30&max_age=31'),
+    ('actors', '/actors?name=actor 12345'),
+    ('actors', '/actors?name_prefix=actor 99999'),
+    ('movies',
+     '/movies?min_release_date=2020-1-1&max_release_date=2020-12-31'),
+    ('movies', '/movies?title=movie 4242'),
+]
+
+
+def seed(rows):
+    count = db.session.execute(text('SELECT count(*) FROM actors')).scalar()
+    if count < rows:
+        db.session.execute(text(
+            "INSERT INTO actors (name, age, gender) "
+            "SELECT 'actor ' || n, 18 + n % 70, "
+            "CASE WHEN n % 2 = 0 THEN 'female' ELSE 'male' END "
+            "FROM generate_series(:start, :stop) AS n "
+            "ON CONFLICT DO NOTHING"), {'start': count + 1, 'stop': rows})
+    count = db.session.execute(text('SELECT count(*) FROM movies')).scalar()
+    if count < rows:
+        db.session.execute(text(
+            "INSERT INTO movies (title, release_date) "
+            "SELECT 'movie ' || n, DATE '1950-01-01' + n % 27000 "
+            "FROM generate_series(:start, :stop) AS n "
+            "ON CONFLICT DO NOTHING"), {'start': count + 1, 'stop': rows})
+    db.session.commit()
+    db.session.execute(text('ANALYZE actors'))
+    db.session.execute(text('ANALYZE movies'))
+    db.session.commit()
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def explain(query):
+    compiled = query.statement.compile(dialect=postgresql.dialect())
+    result = db.session.connection().exec_driver_sql(
+        'EXPLAIN (ANALYZE, FORMAT JSON) ' + str(compiled), compiled.params)
+    return result.scalar()[0]
+
+
+def run_case(table, url):
+    model = Actor if table == 'actors' else Movie
+    with app.test_request_context(url):
+        if table == 'actors':
+            selection = filter_actors(request, Actor.query)
+        else:
+            selection = filter_movies(request, Movie.query)
+        results = []
+        # the filtered count and a first page, like GET /actors does
+        for name, query in [
+                ('count', selection.with_entities(db.func.count(model.id))),
+                ('page', selection.order_by(model.id).limit(10))]:
+            plan = explain(query)
+            nodes = list(plan_nodes(plan['Plan']))
+            results.append({
+                'url': url,
+                'query': name,
+                'execution_ms': plan['Execution Time'],
+                'nodes': sorted({node['Node Type'] for node in nodes}),
+                'index_backed': not any(
+                    node['Node Type'] == 'Seq Scan' and
+                    node.get('Relation Name') in ('actors', 'movies')
+                    for node in nodes)
+            })
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parser.parse_args()
+    with app.app_context():
+        db.create_all()
+        seed(args.rows)
+        ok = True
+        for table, url in CASES:
+            for result in run_case(table, url):
+                ok = ok and result['index_backed']
+                print(json.dumps(result))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
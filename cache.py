@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request, Response, make_response
+from functools import wraps
+from metrics import RESPONSE_CACHE_LOOKUPS, RESPONSE_CACHE_INVALIDATIONS
+
+
+# max number of cached responses per worker, 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 1024))
+# seconds a cached response is served for
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 10))
+# optional redis url, shares the cache and its invalidations between workers
+RESPONSE_CACHE_REDIS_URL = os.environ.get('RESPONSE_CACHE_REDIS_URL')
+
+
+# Backends
+
+'''
+a backend stores the cached entries (with a ttl) and the invalidation
+counters of each tag, it has to implement:
+    get(key), set(key, value, ttl), incr(key), get_counters(keys)
+'''
+
+'''
+LocalBackend class
+    an in-process LRU with a ttl on each entry
+    it is the default backend, and stands in for a shared backend in tests
+    (two caches using the same LocalBackend behave like two workers)
+'''
+
+
+class LocalBackend:
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        # counters are kept apart so they are never evicted
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def get_counters(self, keys):
+        with self.lock:
+            return [self.counters.get(key, 0) for key in keys]
+
+
+'''
+RedisBackend class
+    stores the entries and counters in redis, so every worker sees
+    the same entries and invalidations
+    needs the redis package (pip install redis)
+'''
+
+
+class RedisBackend:
+    def __init__(self, url, prefix='response-cache:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError(
+                'RESPONSE_CACHE_REDIS_URL is set but redis is not installed')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value, ttl):
+        self.client.set(
+            self.prefix + key, json.dumps(value), px=int(ttl * 1000))
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def get_counters(self, keys):
+        values = self.client.mget([self.prefix + key for key in keys])
+        return [int(value or 0) for value in values]
+
+
+# Response cache
+
+'''
+ResponseCache class
+    caches responses by key, where a key is made from the request parts
+    and the current counter of every tag the response depends on
+    invalidate(tag) bumps the tag counter, so all the keys built with the
+    old counter are never looked up again (and expire with their ttl)
+    hits, misses and invalidations are counted
+'''
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL, enabled=True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def key(self, parts, tags):
+        counters = self.backend.get_counters(
+            ['tag:' + tag for tag in tags])
+        return hashlib.sha1(json.dumps(
+            [parts, list(zip(tags, counters))]).encode()).hexdigest()
+
+    # called by @cached (and the ASGI read endpoints)
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            RESPONSE_CACHE_LOOKUPS.labels('miss').inc()
+        else:
+            self.hits += 1
+            RESPONSE_CACHE_LOOKUPS.labels('hit').inc()
+        return entry
+
+    def set(self, key, entry):
+        self.backend.set(key, entry, self.ttl)
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.incr('tag:' + tag)
+            self.invalidations += 1
+            RESPONSE_CACHE_INVALIDATIONS.inc()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+
+def make_backend():
+    if RESPONSE_CACHE_REDIS_URL:
+        return RedisBackend(RESPONSE_CACHE_REDIS_URL)
+    return LocalBackend()
+
+
+response_cache = ResponseCache(
+    make_backend(), enabled=RESPONSE_CACHE_SIZE > 0)
+
+
+'''
+@cached(*tags, include) decorator method
+    to be used under @requires_auth, it gets the decoded payload
+
+    the key is the path, the query args and the permissions of the token
+    include adds the related table and castings tags when the request
+    has ?include=<include>
+    only 200 responses are cached, with their ETag, so a cached response
+    also answers If-None-Match with a 304
+'''
+
+
+# the key of a request, args is a werkzeug MultiDict
+def request_key(path, args, payload, tags):
+    return response_cache.key([
+        path,
+        sorted(args.items(multi=True)),
+        sorted(payload.get('permissions', []))
+    ], tags)
+
+
+def cached(*tags, include=None):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(payload, *args, **kwargs):
+            # a client reading its own writes (see replicas.py) skips it
+            if not response_cache.enabled or g.get('read_your_writes'):
+                return f(payload, *args, **kwargs)
+            entry_tags = list(tags)
+            if include is not None and \
+                    request.args.get('include') == include:
+                entry_tags += [include, 'castings']
+            # the key is built before the handler reads any rows, so a
+            # concurrent write can't be cached under the new counters
+            key = request_key(request.path, request.args, payload, entry_tags)
+            entry = response_cache.get(key)
+            if entry is not None:
+                if entry['etag'] and \
+                        request.if_none_match.contains_weak(entry['etag']):
+                    response = Response(status=304)
+                else:
+                    response = Response(
+                        entry['body'], status=200,
+                        mimetype=entry['mimetype'])
+                if entry['etag']:
+                    response.set_etag(entry['etag'])
+                return response
+            response = make_response(f(payload, *args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response_cache.set(key, {
+                    'body': response.get_data(as_text=True),
+                    'mimetype': response.mimetype,
+                    'etag': response.get_etag()[0]
+                })
+            return response
+
+        return wrapper
+    return cached_decorator
+
+
+'''
+@invalidates(*tags) decorator method
+    invalidates the cached responses with any of the tags
+    after the decorated write handler succeeds
+'''
+
+
+def invalidates(*tags):
+    def invalidates_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            response = make_response(f(*args, **kwargs))
+            if response.status_code < 400:
+                response_cache.invalidate(*tags)
+            return response
+
+        return wrapper
+    return invalidates_decorator
@@ -0,0 +1,442 @@
+import asyncio
+import os
+import queue
+import select as selectors
+import threading
+import time
+from flask import abort
+from sqlalchemy import select, func
+from auth import check_permissions
+from encoding import dumps
+from models import db, Change, CHANGES_CHANNEL
+
+
+'''
+Change feed
+    GET /changes streams the created, updated and deleted actors, movies
+    and castings as Server-Sent Events, from the changes table that every
+    write adds to (see record_write in models.py)
+    each worker has one listener thread (and on postgres one LISTEN
+    connection) that reads the new changes once and hands them to all the
+    streams of the worker
+    a client resumes from the last event it got with the Last-Event-ID
+    header (EventSource sends it when it reconnects) or ?last_event_id=
+    a stream ends when its token expires, the client reconnects with a
+    new one
+'''
+# seconds between two reads of the changes without a NOTIFY (the only
+# wake up on databases without LISTEN/NOTIFY)
+CHANGES_POLL_INTERVAL = float(os.environ.get('CHANGES_POLL_INTERVAL', 1))
+# seconds between two keepalive comments of an idle stream
+CHANGES_KEEPALIVE = float(os.environ.get('CHANGES_KEEPALIVE', 15))
+# max streams per worker, the next ones get a 503
+CHANGES_MAX_SUBSCRIBERS = int(os.environ.get('CHANGES_MAX_SUBSCRIBERS', 1000))
+# max streams of the Flask app per worker, each holds one of its threads
+# until the token expires, keep it a small fraction of gunicorn --threads
+CHANGES_FLASK_MAX_STREAMS = int(
+    os.environ.get('CHANGES_FLASK_MAX_STREAMS', 2))
+# max events waiting for a slow stream, it is closed when it has more
+# (the client reconnects and resumes from the changes table)
+CHANGES_BACKLOG = int(os.environ.get('CHANGES_BACKLOG', 1000))
+# the reconnection delay sent to the clients, in ms
+CHANGES_RETRY_MS = int(os.environ.get('CHANGES_RETRY_MS', 2000))
+# seconds the feed waits for a missing change id to commit before it
+# skips it (a rolled back write leaves a hole in the ids for good), must
+# be longer than the longest write transaction
+CHANGES_GAP_TIMEOUT = float(os.environ.get('CHANGES_GAP_TIMEOUT', 10))
+CHANGES_PAGE_SIZE = 500
+
+# the permissions needed to see the changes of each table
+CHANGE_PERMISSIONS = {
+    'actors': ['get:actors'],
+    'movies': ['get:movies'],
+    'castings': ['get:actors', 'get:movies']
+}
+
+
+class TooManySubscribersError(Exception):
+    pass
+
+
+# the tables of ?tables= (default: all the tables the token can read)
+def change_tables(tables_arg, payload):
+    permissions = payload.get('permissions', [])
+    if not tables_arg:
+        tables = [
+            table for table, needed in CHANGE_PERMISSIONS.items()
+            if all(permission in permissions for permission in needed)]
+        if not tables:
+            check_permissions('get:actors', payload)
+        return tables
+    tables = tables_arg.split(',')
+    if any(table not in CHANGE_PERMISSIONS for table in tables):
+        abort(400)
+    for table in tables:
+        for permission in CHANGE_PERMISSIONS[table]:
+            check_permissions(permission, payload)
+    return tables
+
+
+# the Last-Event-ID header, or ?last_event_id=, None if neither is sent
+def get_last_event_id(header, arg):
+    value = header or arg
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def format_change(row):
+    return {
+        "id": row.id,
+        "table": row.table_name,
+        "operation": row.operation,
+        "row": row.row_key
+    }
+
+
+# the changes of tables after after_id (all the changes if None),
+# up to until_id
+def read_changes(after_id, tables=None, limit=CHANGES_PAGE_SIZE,
+                 session=None, until_id=None):
+    session = session or db.session
+    table = Change.__table__
+    selection = select(table).order_by(table.c.id).limit(limit)
+    if after_id is not None:
+        selection = selection.where(table.c.id > after_id)
+    if until_id is not None:
+        selection = selection.where(table.c.id <= until_id)
+    if tables is not None:
+        selection = selection.where(table.c.table_name.in_(tables))
+    return [format_change(row) for row in session.execute(selection)]
+
+
+def latest_change_id(session=None):
+    session = session or db.session
+    return session.execute(select(func.max(Change.id))).scalar() or 0
+
+
+# True if changes after last_event_id were already deleted
+def pruned_after(last_event_id, session=None):
+    session = session or db.session
+    oldest = session.execute(select(func.min(Change.id))).scalar()
+    return oldest is not None and last_event_id < oldest - 1
+
+
+# Server-Sent Events
+
+def sse_event(change):
+    return b'id: %d\ndata: %s\n\n' % (change['id'], dumps(change, True))
+
+
+def sse_retry():
+    return b'retry: %d\n\n' % CHANGES_RETRY_MS
+
+
+SSE_KEEPALIVE = b': keepalive\n\n'
+# the client has to reload, the changes it missed were deleted
+SSE_RESET = b'event: reset\ndata: {"message": "changes were pruned"}\n\n'
+# the last event of a stream whose token expired
+SSE_EXPIRED = b'event: expired\ndata: {"message": "token expired"}\n\n'
+
+
+'''
+Subscriber class
+    the events for one stream, deliver(change) is called by the listener
+    thread, a stream that falls CHANGES_BACKLOG events behind is marked
+    overflowed and ends
+    after is the last change the feed had delivered when it subscribed,
+    the stream reads the changes up to it from the table
+AsyncSubscriber class
+    the same for a stream of the ASGI app, the events are handed to its
+    event loop
+'''
+
+
+class Subscriber:
+    def __init__(self, tables, backlog=CHANGES_BACKLOG):
+        self.tables = set(tables)
+        self.events = queue.Queue(backlog)
+        self.overflowed = False
+        self.after = None
+
+    def deliver(self, change):
+        try:
+            self.events.put_nowait(change)
+        except queue.Full:
+            self.overflowed = True
+
+
+class AsyncSubscriber(Subscriber):
+    def __init__(self, tables, loop, backlog=CHANGES_BACKLOG):
+        self.tables = set(tables)
+        self.events = asyncio.Queue(backlog)
+        self.overflowed = False
+        self.after = None
+        self.loop = loop
+
+    def put(self, change):
+        try:
+            self.events.put_nowait(change)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def deliver(self, change):
+        try:
+            self.loop.call_soon_threadsafe(self.put, change)
+        except RuntimeError:
+            # its event loop is closed, the stream is dropped
+            self.overflowed = True
+
+
+'''
+ChangeFeed class
+    the listener of a worker, its thread is started by the first
+    subscribe of each process (like GroupCommitQueue)
+    it waits for a NOTIFY on postgres (or poll_interval seconds), reads
+    the changes after the last one it delivered and delivers them, in id
+    order, to the subscribers of their table
+    the writes don't commit in id order: at a missing id the feed stops
+    and reads again from there on the next wake up, until the change
+    commits or gap_timeout passes (then it is skipped for good)
+'''
+
+
+class ChangeFeed:
+    def __init__(self, app, poll_interval=CHANGES_POLL_INTERVAL,
+                 keepalive=CHANGES_KEEPALIVE,
+                 max_subscribers=CHANGES_MAX_SUBSCRIBERS,
+                 gap_timeout=CHANGES_GAP_TIMEOUT,
+                 max_thread_subscribers=CHANGES_FLASK_MAX_STREAMS):
+        self.app = app
+        self.poll_interval = poll_interval
+        self.keepalive = keepalive
+        self.max_subscribers = max_subscribers
+        # the streams of the Flask app (without an event loop)
+        self.max_thread_subscribers = max_thread_subscribers
+        self.gap_timeout = gap_timeout
+        self.subscribers = set()
+        self.last_id = None
+        # change id: when the feed first waited for the ids before it
+        self.gaps = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.started = threading.Event()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.started.clear()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        # the subscriber gets the changes after the ones the feed
+        # already read
+        self.started.wait()
+
+    def subscribe(self, tables, loop=None):
+        self.start()
+        if loop is None:
+            subscriber = Subscriber(tables)
+        else:
+            subscriber = AsyncSubscriber(tables, loop)
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                raise TooManySubscribersError(
+                    f'{len(self.subscribers)} streams are open')
+            if loop is None and self.thread_subscribers() >= \
+                    self.max_thread_subscribers:
+                raise TooManySubscribersError(
+                    f'{self.max_thread_subscribers} Flask streams are open')
+            subscriber.after = self.last_id
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def thread_subscribers(self):
+        return sum(
+            1 for subscriber in self.subscribers
+            if not isinstance(subscriber, AsyncSubscriber))
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    # a LISTEN connection, out of the pool, on postgres
+    def listen(self):
+        if db.engine.dialect.name != 'postgresql':
+            return None
+        connection = db.engine.raw_connection()
+        connection.detach()
+        listener = connection.connection
+        listener.autocommit = True
+        listener.cursor().execute('LISTEN ' + CHANGES_CHANNEL)
+        return listener
+
+    def wait(self, listener):
+        if listener is None:
+            time.sleep(self.poll_interval)
+            return None
+        try:
+            if selectors.select([listener], [], [], self.poll_interval)[0]:
+                listener.poll()
+                listener.notifies.clear()
+            return listener
+        except Exception as e:
+            # the connection is lost, it is opened again
+            print(e)
+            listener.close()
+            return None
+
+    # False if it stopped at a missing id
+    def deliver(self, change):
+        if change['id'] > self.last_id + 1:
+            since = self.gaps.setdefault(change['id'], time.monotonic())
+            if time.monotonic() - since < self.gap_timeout:
+                return False
+        self.gaps.pop(change['id'], None)
+        with self.lock:
+            for subscriber in self.subscribers:
+                if change['table'] in subscriber.tables:
+                    subscriber.deliver(change)
+            self.last_id = change['id']
+        return True
+
+    def publish(self):
+        while True:
+            changes = read_changes(self.last_id)
+            delivered = all(self.deliver(change) for change in changes)
+            # a stream that fell behind (or was never read) is dropped
+            with self.lock:
+                self.subscribers = {
+                    subscriber for subscriber in self.subscribers
+                    if not subscriber.overflowed}
+            if not delivered or len(changes) < CHANGES_PAGE_SIZE:
+                return
+
+    def run(self):
+        listener = None
+        while True:
+            try:
+                with self.app.app_context():
+                    try:
+                        if listener is None:
+                            listener = self.listen()
+                        if self.last_id is None:
+                            self.last_id = latest_change_id()
+                        else:
+                            self.publish()
+                    finally:
+                        db.session.remove()
+            except Exception as e:
+                print(e)
+            self.started.set()
+            listener = self.wait(listener)
+
+    def stats(self):
+        return {
+            'subscribers': len(self.subscribers),
+            'last_id': self.last_id
+        }
+
+
+# seconds until the next keepalive, or until expires (a timestamp)
+def wait_timeout(keepalive, expires):
+    if expires is None:
+        return keepalive
+    return max(0, min(keepalive, expires - time.time()))
+
+
+def expired(expires):
+    return expires is not None and time.time() >= expires
+
+
+'''
+stream(feed, subscriber, last_event_id, expires) generator method
+    the SSE body of GET /changes: the stored changes after last_event_id
+    (if the client resumes) up to the ones the feed delivered before the
+    subscribe, then the changes the feed delivers, with a keepalive
+    comment when the stream is idle
+    it ends with an expired event at expires (the exp of the token)
+    stream_async is the same for the ASGI app, async_session is a
+    sessionmaker of AsyncSession
+'''
+
+
+def stream(feed, subscriber, last_event_id, expires=None):
+    try:
+        yield sse_retry()
+        sent = last_event_id
+        if last_event_id is not None:
+            if pruned_after(last_event_id):
+                yield SSE_RESET
+            while True:
+                changes = read_changes(
+                    sent, subscriber.tables, until_id=subscriber.after)
+                for change in changes:
+                    yield sse_event(change)
+                    sent = change['id']
+                if len(changes) < CHANGES_PAGE_SIZE:
+                    break
+            # the stream doesn't keep a connection
+            db.session.remove()
+        while not subscriber.overflowed:
+            if expired(expires):
+                yield SSE_EXPIRED
+                return
+            try:
+                change = subscriber.events.get(
+                    timeout=wait_timeout(feed.keepalive, expires))
+            except queue.Empty:
+                if not expired(expires):
+                    yield SSE_KEEPALIVE
+                continue
+            if sent is not None and change['id'] <= sent:
+                continue
+            yield sse_event(change)
+            sent = change['id']
+    finally:
+        feed.unsubscribe(subscriber)
+
+
+async def stream_async(feed, subscriber, last_event_id, async_session,
+                       expires=None):
+    try:
+        yield sse_retry()
+        sent = last_event_id
+        if last_event_id is not None:
+            async with async_session() as session:
+                if await session.run_sync(
+                        lambda sync_session: pruned_after(
+                            last_event_id, sync_session)):
+                    yield SSE_RESET
+                while True:
+                    changes = await session.run_sync(
+                        lambda sync_session: read_changes(
+                            sent, subscriber.tables, session=sync_session,
+                            until_id=subscriber.after))
+                    for change in changes:
+                        yield sse_event(change)
+                        sent = change['id']
+                    if len(changes) < CHANGES_PAGE_SIZE:
+                        break
+        while not subscriber.overflowed:
+            if expired(expires):
+                yield SSE_EXPIRED
+                return
+            try:
+                change = await asyncio.wait_for(
+                    subscriber.events.get(),
+                    wait_timeout(feed.keepalive, expires))
+            except asyncio.TimeoutError:
+                if not expired(expires):
+                    yield SSE_KEEPALIVE
+                continue
+            if sent is not None and change['id'] <= sent:
+                continue
+            yield sse_event(change)
+            sent = change['id']
+    finally:
+        feed.unsubscribe(subscriber)
@@ -0,0 +1,91 @@
+import datetime
+import json
+import os
+from flask import current_app
+from flask.json import JSONEncoder
+from metrics import timed_phase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+JSON encoding of the API responses
+    JSON_ENCODER picks the encoder:
+        auto: orjson when it is installed (pip install orjson), else stdlib
+        orjson: orjson, fails at startup if it isn't installed
+        stdlib: the json module
+    both encode dates as ISO-8601 (YYYY-MM-DD)
+'''
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+
+
+def json_default(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def stdlib_dumps(data, sort_keys=False):
+    return json.dumps(
+        data, default=json_default, sort_keys=sort_keys,
+        separators=(',', ':')).encode()
+
+
+def orjson_dumps(data, sort_keys=False):
+    # orjson encodes dates as ISO-8601 itself
+    return orjson.dumps(
+        data, default=json_default,
+        option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+
+
+ENCODERS = {
+    'stdlib': stdlib_dumps,
+    'orjson': orjson_dumps
+}
+
+
+def get_encoder(name=JSON_ENCODER):
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name not in ENCODERS:
+        raise RuntimeError(f'unknown JSON_ENCODER {name}')
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_ENCODER is orjson but it is not installed')
+    return ENCODERS[name]
+
+
+encoder = get_encoder()
+
+
+# encodes data to JSON bytes with the configured encoder
+def dumps(data, sort_keys=False):
+    with timed_phase('json'):
+        return encoder(data, sort_keys)
+
+
+'''
+jsonify(data) method
+    Flask's jsonify for a single value, encoded with dumps
+    (keys sorted as JSON_SORT_KEYS says)
+'''
+
+
+def jsonify(data):
+    return current_app.response_class(
+        dumps(data, current_app.config['JSON_SORT_KEYS']) + b'\n',
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+# for the JSON Flask encodes itself (flask.json.dumps), i.e. in extensions
+class APIJSONEncoder(JSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime.date):
+            return o.isoformat()
+        return super().default(o)
+
+    def encode(self, o):
+        with timed_phase('json'):
+            return super().encode(o)
@@ -0,0 +1,176 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from models import db, create_row, create_rows
+from metrics import GROUP_COMMIT_BATCH_ROWS
+
+
+'''
+Group commit
+    with GROUP_COMMIT, POST /actors and POST /movies don't commit one by
+    one: their rows are queued and a background thread inserts them in
+    batches, one transaction (one commit, so one fsync) per batch, and
+    hands each waiting request its own new id (or its conflict)
+    a batch is flushed when it has GROUP_COMMIT_MAX_BATCH rows,
+    GROUP_COMMIT_MAX_WAIT_MS after its first row, or as soon as every
+    request of the worker waiting to insert is in it (a lone insert
+    doesn't wait)
+    at most GROUP_COMMIT_MAX_QUEUE rows wait, the next requests get a 503
+    the rows are batched across the concurrent requests of one worker, so
+    it needs threaded or ASGI workers (gunicorn -k gthread --threads N,
+    or uvicorn asgi:app), a sync worker has only one request at a time
+    and commits its rows directly (see create_item in app.py)
+'''
+GROUP_COMMIT = os.environ.get(
+    'GROUP_COMMIT', 'false').lower() in ('1', 'true', 'yes')
+GROUP_COMMIT_MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 100))
+GROUP_COMMIT_MAX_WAIT_MS = float(
+    os.environ.get('GROUP_COMMIT_MAX_WAIT_MS', 5))
+GROUP_COMMIT_MAX_QUEUE = int(os.environ.get('GROUP_COMMIT_MAX_QUEUE', 1000))
+# seconds a row waits in the queue before it is dropped (a 503, the row
+# isn't inserted), a row whose batch is being inserted waits for it
+GROUP_COMMIT_TIMEOUT = float(os.environ.get('GROUP_COMMIT_TIMEOUT', 30))
+
+
+class QueueFullError(Exception):
+    pass
+
+
+'''
+GroupCommitQueue class
+    create(model, values, unique_column) queues a row and waits for its
+    batch, it returns the new id, or None if unique_column already has
+    the value (like create_row)
+    a row still queued after timeout is cancelled, the flusher skips it,
+    and create raises FutureTimeoutError: the row is never inserted, so
+    the client can retry; once its batch is taken it waits for the result
+    the rows of a batch are inserted with create_rows, one transaction
+    per model, if it fails (i.e. a row with a NOT NULL column missing)
+    every row of the batch is inserted alone so only the bad rows fail
+    the flusher thread is started by the first create of each process
+    (threads don't survive the fork of a gunicorn worker)
+'''
+
+
+class GroupCommitQueue:
+    def __init__(self, app, max_batch=GROUP_COMMIT_MAX_BATCH,
+                 max_wait_ms=GROUP_COMMIT_MAX_WAIT_MS,
+                 max_queue=GROUP_COMMIT_MAX_QUEUE,
+                 timeout=GROUP_COMMIT_TIMEOUT):
+        self.app = app
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.timeout = timeout
+        self.queue = queue.Queue(max_queue)
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.rows = 0
+        # the create calls waiting for their row, queued or being flushed
+        self.producers = 0
+        # create_item warned that a sync worker doesn't batch
+        self.sync_warned = False
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def create(self, model, values, unique_column):
+        self.start()
+        future = Future()
+        with self.lock:
+            self.producers += 1
+        try:
+            self.queue.put_nowait((model, values, unique_column, future))
+            try:
+                return future.result(self.timeout)
+            except FutureTimeoutError:
+                if future.cancel():
+                    raise
+                # its batch is being inserted, that is the answer
+                return future.result()
+        except queue.Full:
+            raise QueueFullError(
+                f'{self.queue.maxsize} rows are already waiting')
+        finally:
+            with self.lock:
+                self.producers -= 1
+
+    # the next batch: the first row, and the rows queued until the batch
+    # is full, max_wait after the first one, or no other request is about
+    # to queue a row
+    # the rows cancelled by their create (see above) are skipped
+    def next_batch(self):
+        batch = []
+        while not batch:
+            self.take(self.queue.get(), batch)
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or self.producers <= len(batch):
+                break
+            try:
+                self.take(self.queue.get(timeout=timeout), batch)
+            except queue.Empty:
+                break
+        return batch
+
+    def take(self, pending, batch):
+        if pending[3].set_running_or_notify_cancel():
+            batch.append(pending)
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                with self.app.app_context():
+                    try:
+                        self.flush(batch)
+                    finally:
+                        db.session.remove()
+            except Exception as e:
+                # no request waits for ever on a broken batch
+                print(e)
+                for pending in batch:
+                    if not pending[3].done():
+                        pending[3].set_exception(e)
+
+    def flush(self, batch):
+        self.batches += 1
+        self.rows += len(batch)
+        GROUP_COMMIT_BATCH_ROWS.observe(len(batch))
+        models = {}
+        for pending in batch:
+            models.setdefault((pending[0], pending[2]), []).append(pending)
+        for (model, unique_column), pendings in models.items():
+            try:
+                ids = create_rows(
+                    model, [values for _, values, _, _ in pendings],
+                    unique_column)
+            except Exception as e:
+                print(e)
+                self.flush_one_by_one(pendings)
+                continue
+            for pending, new_id in zip(pendings, ids):
+                pending[3].set_result(new_id)
+
+    def flush_one_by_one(self, pendings):
+        for model, values, unique_column, future in pendings:
+            try:
+                future.set_result(create_row(model, values, unique_column))
+            except Exception as e:
+                future.set_exception(e)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'rows': self.rows,
+            'rows_per_batch': self.rows / self.batches if self.batches else 0,
+            'waiting': self.queue.qsize()
+        }
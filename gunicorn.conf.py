@@ -0,0 +1,8 @@
+import os
+from prometheus_client import multiprocess
+
+
+# drop the metrics of exited workers from the livesum gauges
+def child_exit(server, worker):
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(worker.pid)
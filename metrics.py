@@ -0,0 +1,147 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+
+
+'''
+Prometheus metrics
+    with gunicorn (several worker processes) set PROMETHEUS_MULTIPROC_DIR
+    to an empty directory, every worker writes its metrics there and
+    /metrics adds them up, so any worker can answer the scrape
+    (gunicorn.conf.py cleans up after the workers that exit)
+'''
+
+REQUESTS = Counter(
+    'http_requests_total', 'HTTP requests by route and status code',
+    ['route', 'method', 'status'])
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route',
+    ['route', 'method'])
+# time spent inside a request verifying its token (auth),
+# running SQL statements (sql) and encoding the JSON body (json)
+PHASE_LATENCY = Histogram(
+    'http_request_phase_duration_seconds',
+    'time spent in a phase of a request, by route',
+    ['route', 'phase'])
+
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    'db_pool_checkout_wait_seconds',
+    'time waited to check out a database connection',
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5, 10, 30))
+DB_POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts_total',
+    'database connection checkouts that timed out')
+DB_POOL_IN_USE = Gauge(
+    'db_pool_connections_in_use', 'database connections checked out',
+    multiprocess_mode='livesum')
+DB_POOL_CAPACITY = Gauge(
+    'db_pool_connections_capacity', 'pool size plus max overflow',
+    multiprocess_mode='livesum')
+
+# the lookups of the response cache (cache.py), result is hit or miss
+RESPONSE_CACHE_LOOKUPS = Counter(
+    'response_cache_lookups_total', 'response cache lookups', ['result'])
+RESPONSE_CACHE_INVALIDATIONS = Counter(
+    'response_cache_invalidations_total',
+    'response cache tag invalidations')
+# the lookups of the verified token cache (auth.py), result is hit or miss
+TOKEN_CACHE_LOOKUPS = Counter(
+    'token_cache_lookups_total', 'verified token cache lookups', ['result'])
+# the rows of each group commit batch (group_commit.py)
+GROUP_COMMIT_BATCH_ROWS = Histogram(
+    'group_commit_batch_rows', 'rows inserted per group commit batch',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+
+# Per request stats
+
+# adds X-DB-Queries and X-DB-Time (ms) headers to every response
+DB_DEBUG_HEADERS = os.environ.get(
+    'DB_DEBUG_HEADERS', 'false').lower() in ('1', 'true', 'yes')
+
+'''
+RequestStats class
+    the route of the current request, the time spent in each of its phases
+    and the number of SQL statements it ran
+    kept in a context variable so it follows the request in its thread
+    (Flask) or task (ASGI)
+'''
+
+
+class RequestStats:
+    def __init__(self, route):
+        # the name of the handler (i.e. get_actors), or 'unmatched'
+        self.route = route or 'unmatched'
+        self.start = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+
+    def debug_headers(self):
+        return {
+            'X-DB-Queries': str(self.queries),
+            'X-DB-Time': '%.3f' % (self.phases.get('sql', 0.0) * 1000)
+        }
+
+
+current_request = ContextVar('current_request', default=None)
+
+
+def start_request(route):
+    stats = RequestStats(route)
+    current_request.set(stats)
+    return stats
+
+
+def add_phase_time(phase, seconds):
+    stats = current_request.get()
+    if stats is not None:
+        stats.phases[phase] = stats.phases.get(phase, 0.0) + seconds
+
+
+def add_query(seconds):
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+    add_phase_time('sql', seconds)
+
+
+def current_route():
+    stats = current_request.get()
+    return stats.route if stats is not None else None
+
+
+@contextmanager
+def timed_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.perf_counter() - start)
+
+
+# records the current request once it is done, returns its stats
+def observe_request(method, status):
+    stats = current_request.get()
+    if stats is None:
+        return None
+    REQUESTS.labels(stats.route, method, str(status)).inc()
+    REQUEST_LATENCY.labels(stats.route, method).observe(
+        time.perf_counter() - stats.start)
+    for phase, seconds in stats.phases.items():
+        PHASE_LATENCY.labels(stats.route, phase).observe(seconds)
+    current_request.set(None)
+    return stats
+
+
+def render_metrics():
+    # returns the body and the content type of a /metrics response
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,34 @@
+"""add table_versions
+
+Revision ID: 3c9f1e7a2b4d
+Revises: 987d2deae089
+Create Date: 2026-10-18 10:12:41.220913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9f1e7a2b4d'
+down_revision = '987d2deae089'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table(
+        'table_versions',
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('table_name')
+    )
+    op.bulk_insert(table_versions, [
+        {'table_name': 'actors', 'version': 1},
+        {'table_name': 'movies', 'version': 1},
+        {'table_name': 'castings', 'version': 1}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,24 @@
+"""add castings movie_id index
+
+Revision ID: 5e2b7d9c4a13
+Revises: 8a4d6b0c1f27
+Create Date: 2026-10-18 15:12:40.519823
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2b7d9c4a13'
+down_revision = '8a4d6b0c1f27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_castings_movie_id', 'castings', ['movie_id'])
+
+
+def downgrade():
+    op.drop_index('ix_castings_movie_id', table_name='castings')
@@ -0,0 +1,37 @@
+"""add search indexes
+
+Revision ID: 8a4d6b0c1f27
+Revises: 3c9f1e7a2b4d
+Create Date: 2026-10-18 11:02:15.874306
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8a4d6b0c1f27'
+down_revision = '3c9f1e7a2b4d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index('ix_actors_age', 'actors', ['age'])
+    op.create_index('ix_actors_gender_age', 'actors', ['gender', 'age'])
+    op.create_index(
+        'ix_actors_name_trgm', 'actors', ['name'], postgresql_using='gin',
+        postgresql_ops={'name': 'gin_trgm_ops'})
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'])
+    op.create_index(
+        'ix_movies_title_trgm', 'movies', ['title'], postgresql_using='gin',
+        postgresql_ops={'title': 'gin_trgm_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_movies_title_trgm', table_name='movies')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_index('ix_actors_name_trgm', table_name='actors')
+    op.drop_index('ix_actors_gender_age', table_name='actors')
+    op.drop_index('ix_actors_age', table_name='actors')
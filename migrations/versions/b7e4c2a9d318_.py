@@ -0,0 +1,28 @@
+"""add actors and movies version columns
+
+Revision ID: b7e4c2a9d318
+Revises: 5e2b7d9c4a13
+Create Date: 2026-10-18 19:02:11.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4c2a9d318'
+down_revision = '5e2b7d9c4a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('movies', sa.Column(
+        'version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('movies', 'version')
+    op.drop_column('actors', 'version')
@@ -0,0 +1,36 @@
+"""add the changes table (GET /changes)
+
+Revision ID: d41f8a6e0c52
+Revises: b7e4c2a9d318
+Create Date: 2026-10-18 21:14:37.582093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41f8a6e0c52'
+down_revision = 'b7e4c2a9d318'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'changes',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('table_name', sa.String(), nullable=False),
+        sa.Column('operation', sa.String(), nullable=False),
+        sa.Column('row_key', sa.JSON(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        op.f('ix_changes_created_at'), 'changes', ['created_at'],
+        unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_changes_created_at'), table_name='changes')
+    op.drop_table('changes')
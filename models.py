@@ -1,19 +1,221 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from sqlalchemy import Column, String, Integer, Date, create_engine, ForeignKey
+from sqlalchemy import DateTime, JSON
+from sqlalchemy import text, event, DDL, Index, select, func
+from sqlalchemy import column, literal
+from sqlalchemy.sql.expression import Values
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool, NullPool
+from sqlalchemy.orm import sessionmaker
 from flask_migrate import Migrate
+from metrics import DB_POOL_CHECKOUT_WAIT, DB_POOL_TIMEOUTS
+from metrics import add_query, current_route
+from contextvars import ContextVar
+import datetime
+import json
+import logging
+import math
 import os
+import threading
+import time
+import weakref
 
 
 # Connect to the database
 database_path = os.environ['DATABASE_URL'].replace('postgres://', 'postgresql://')
 
-db = SQLAlchemy()
+
+# Read routing
+
+# the engine the reads of the current request go to (a read replica),
+# None for the primary, it is set by @reads_replica (replicas.py)
+read_bind = ContextVar('read_bind', default=None)
+
+
+# sends the statements to read_bind when it is set,
+# flushes (writes) always go to the primary
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        engine = read_bind.get()
+        if engine is not None and not self._flushing:
+            return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+
+# Connection pool settings
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+# seconds to wait for a free connection before failing the request
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+# seconds after which a connection is replaced, -1 keeps them forever
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+# test each connection on checkout, so a failover doesn't fail requests
+DB_POOL_PRE_PING = os.environ.get(
+    'DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# behind PgBouncer in transaction pooling mode: PgBouncer does the pooling
+DB_PGBOUNCER = os.environ.get(
+    'DB_PGBOUNCER', 'false').lower() in ('1', 'true', 'yes')
+
+
+'''
+PoolMetrics class
+    how long requests wait to check out a connection, and how many of
+    the connections of the instrumented pools are in use
+    saturation is in use / (pool size + max overflow), near 1 requests
+    start to wait (and time out after DB_POOL_TIMEOUT), with an unbounded
+    overflow (max_overflow=-1) the capacity is infinite and the
+    saturation 0
+'''
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pools = weakref.WeakSet()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe(self, wait, timed_out=False):
+        with self.lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+        DB_POOL_CHECKOUT_WAIT.observe(wait)
+        if timed_out:
+            DB_POOL_TIMEOUTS.inc()
+
+    def stats(self):
+        pools = list(self.pools)
+        in_use = sum(pool.checkedout() for pool in pools)
+        capacity = sum(pool.capacity() for pool in pools)
+        return {
+            'checkouts': self.checkouts,
+            'timeouts': self.timeouts,
+            'wait_seconds_total': self.wait_total,
+            'wait_seconds_max': self.wait_max,
+            'in_use': in_use,
+            'capacity': capacity,
+            'saturation': in_use / capacity if capacity else 0.0
+        }
+
+
+pool_metrics = PoolMetrics()
+
+
+# times every checkout of a connection from the pool
+class InstrumentedPool:
+    def __init__(self, *args, max_overflow=10, **kwargs):
+        super().__init__(*args, max_overflow=max_overflow, **kwargs)
+        # QueuePool doesn't expose it, a negative one is unbounded
+        self.max_overflow = max_overflow
+        pool_metrics.pools.add(self)
+
+    def capacity(self):
+        if self.max_overflow < 0:
+            return math.inf
+        return self.size() + self.max_overflow
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.observe(time.perf_counter() - start, True)
+            raise
+        pool_metrics.observe(time.perf_counter() - start)
+        return connection
+
+
+class InstrumentedQueuePool(InstrumentedPool, QueuePool):
+    pass
+
+
+class InstrumentedAsyncQueuePool(InstrumentedPool, AsyncAdaptedQueuePool):
+    pass
+
+
+'''
+engine_options(database_path, async_engine)
+    the create_engine options for the pool settings above
+    only postgres gets a pool, sqlite keeps its defaults
+    with DB_PGBOUNCER there is no pool on our side, and asyncpg doesn't
+    cache prepared statements (they don't survive across transactions)
+'''
+
+
+def engine_options(database_path, async_engine=False):
+    if make_url(database_path).get_backend_name() != 'postgresql':
+        return {}
+    if DB_PGBOUNCER:
+        options = {'poolclass': NullPool}
+        if async_engine:
+            options['connect_args'] = {
+                'statement_cache_size': 0,
+                'prepared_statement_cache_size': 0
+            }
+        return options
+    return {
+        'poolclass': InstrumentedAsyncQueuePool if async_engine
+        else InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+        'pool_pre_ping': DB_POOL_PRE_PING
+    }
+
+
+# SQL instrumentation
+
+# statements slower than this (in milliseconds) are logged, 0 disables it
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+
+slow_query_log = logging.getLogger('slow_queries')
+
+
+# the statements and time spent running them, for the request metrics,
+# and a JSON line for each slow statement with the route that ran it
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info['query_start'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    seconds = time.perf_counter() - conn.info.pop(
+        'query_start', time.perf_counter())
+    add_query(seconds)
+    if 0 < SLOW_QUERY_MS <= seconds * 1000:
+        slow_query_log.warning(json.dumps({
+            'event': 'slow_query',
+            'route': current_route(),
+            'duration_ms': round(seconds * 1000, 3),
+            'statement': statement,
+            'executemany': executemany
+        }))
 
 
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     migrate = Migrate(app, db)
     db.init_app(app)
@@ -24,14 +226,532 @@ def db_drop_and_create_all(db=SQLAlchemy()):
     db.create_all()
 
 
+# Table versions
+
+'''
+every write bumps the version of the tables it changes, in the same
+transaction, so readers (in any worker) can tell if a table changed
+without reading its rows, i.e. to answer conditional GETs
+'''
+
+
+class TableVersion(db.Model):
+    __tablename__ = "table_versions"
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# see record_write for postgres
+def bump_versions(*table_names):
+    table = TableVersion.__table__
+    for table_name in table_names:
+        result = db.session.execute(
+            table.update().where(table.c.table_name == table_name)
+            .values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            db.session.execute(
+                table.insert().values(table_name=table_name, version=1))
+
+
+def get_versions(*table_names, session=None):
+    session = session or db.session
+    table = TableVersion.__table__
+    rows = session.execute(
+        table.select().where(table.c.table_name.in_(table_names)))
+    versions = dict.fromkeys(table_names, 0)
+    versions.update({row.table_name: row.version for row in rows})
+    return versions
+
+
+# Change feed
+
+'''
+every write also adds a row per created, updated or deleted row to the
+changes table, in the same transaction, the changes are streamed to the
+clients of GET /changes (see changes.py) and their id is the SSE event id
+concurrent writes may commit their changes out of id order, a reader
+holds back at a missing id until it commits (or is given up on, see
+ChangeFeed.publish in changes.py)
+on postgres, the writes send a NOTIFY (delivered on commit) to wake up
+the listener of every worker
+the writes also delete the changes older than CHANGES_RETENTION_HOURS,
+once every CHANGES_PRUNE_INTERVAL seconds per worker (and on its first
+write), whether or not anyone streams them
+'''
+CHANGES_CHANNEL = 'changes'
+# hours the changes are kept, so a client can resume
+CHANGES_RETENTION_HOURS = float(
+    os.environ.get('CHANGES_RETENTION_HOURS', 24))
+# seconds between two deletes of the changes older than the retention
+CHANGES_PRUNE_INTERVAL = float(os.environ.get('CHANGES_PRUNE_INTERVAL', 600))
+# when this worker last deleted the old changes (monotonic)
+changes_pruning = {'at': None}
+changes_pruning_lock = threading.Lock()
+
+
+class Change(db.Model):
+    __tablename__ = "changes"
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String, nullable=False)
+    # created, updated or deleted
+    operation = Column(String, nullable=False)
+    # the key of the row, {"id": ...} or {"actor_id": ..., "movie_id": ...}
+    row_key = Column(JSON, nullable=False)
+    created_at = Column(
+        DateTime, nullable=False, default=datetime.datetime.utcnow,
+        index=True)
+
+
+# True (once) when the old changes are due to be deleted
+def prune_due():
+    now = time.monotonic()
+    with changes_pruning_lock:
+        last = changes_pruning['at']
+        if last is not None and now - last < CHANGES_PRUNE_INTERVAL:
+            return False
+        changes_pruning['at'] = now
+        return True
+
+
+def prune_statement():
+    table = Change.__table__
+    before = datetime.datetime.utcnow() - \
+        datetime.timedelta(hours=CHANGES_RETENTION_HOURS)
+    return table.delete().where(table.c.created_at < before)
+
+
+'''
+record_write(table_names, changes)
+    the bookkeeping of a write, in its transaction: bumps the versions of
+    table_names and records changes, a list of (table name, operation,
+    keys), and when it is due deletes the old changes
+    on postgres it is one statement, the upsert of the versions, the
+    insert (and delete) of the changes as CTEs, and the NOTIFY, so a
+    write costs one round trip more instead of three
+    the versions are upserted in table name order, and last, so their
+    row locks are only held until the commit that follows
+'''
+
+
+def record_write(table_names, changes):
+    now = datetime.datetime.utcnow()
+    rows = [
+        {'table_name': table_name, 'operation': operation, 'row_key': key,
+         'created_at': now}
+        for table_name, operation, keys in changes for key in keys]
+    prune = bool(rows) and prune_due()
+    if db.engine.dialect.name != 'postgresql':
+        bump_versions(*table_names)
+        if rows:
+            db.session.execute(Change.__table__.insert(), rows)
+        if prune:
+            db.session.execute(prune_statement())
+        return
+    versions = TableVersion.__table__
+    names = Values(column('table_name', String), name='names').data(
+        [(table_name,) for table_name in sorted(set(table_names))])
+    bumped = postgresql.insert(versions).from_select(
+        ['table_name', 'version'], select(names.c.table_name, literal(1))) \
+        .on_conflict_do_update(
+            index_elements=[versions.c.table_name],
+            set_={"version": versions.c.version + 1}) \
+        .returning(versions.c.table_name).cte('bumped')
+    # the CTEs only run if the statement refers to them
+    columns = [select(func.count()).select_from(bumped).scalar_subquery()]
+    if rows:
+        recorded = postgresql.insert(Change.__table__).values(rows) \
+            .returning(Change.__table__.c.id).cte('recorded')
+        payload = ','.join(sorted({change[0] for change in changes}))
+        columns += [
+            select(func.count()).select_from(recorded).scalar_subquery(),
+            func.pg_notify(CHANGES_CHANNEL, payload)]
+    if prune:
+        pruned = prune_statement().returning(Change.__table__.c.id) \
+            .cte('pruned')
+        columns.append(
+            select(func.count()).select_from(pruned).scalar_subquery())
+    db.session.execute(select(*columns))
+
+
+# Row counts
+
+'''
+exact counts are cached per table and cleared by our own inserts/deletes,
+COUNT_CACHE_TTL bounds how stale they get from writes in other workers
+on postgres, tables with more than COUNT_ESTIMATE_THRESHOLD rows
+(by pg_class.reltuples) get an estimated count instead of a full scan
+'''
+COUNT_CACHE_TTL = float(os.environ.get('COUNT_CACHE_TTL', 5))
+COUNT_ESTIMATE_THRESHOLD = int(
+    os.environ.get('COUNT_ESTIMATE_THRESHOLD', 100000))
+COUNT_STRATEGIES = ('auto', 'exact', 'estimated', 'none')
+
+row_counts = {}
+
+
+def invalidate_count(table_name):
+    row_counts.pop(table_name, None)
+
+
+def estimate_count(table_name, session):
+    if session.connection().dialect.name != 'postgresql':
+        return None
+    estimate = session.execute(
+        text("SELECT reltuples::bigint FROM pg_class "
+             "WHERE oid = to_regclass(:table_name)"),
+        {"table_name": table_name}).scalar()
+    # reltuples is -1 (or 0 on older versions) before the first ANALYZE
+    if estimate is None or estimate <= 0:
+        return None
+    return int(estimate)
+
+
+def cached_count(table_name):
+    cached = row_counts.get(table_name)
+    if cached is not None and time.monotonic() - cached[1] < COUNT_CACHE_TTL:
+        return cached[0]
+    return None
+
+
+def exact_count(model, session):
+    count = cached_count(model.__tablename__)
+    if count is None:
+        count = session.execute(
+            select(func.count()).select_from(model.__table__)).scalar()
+        row_counts[model.__tablename__] = (count, time.monotonic())
+    return count
+
+
+'''
+count_rows(model, strategy, selection, session)
+    strategy is one of COUNT_STRATEGIES:
+        auto: a cached exact count, or an estimate for huge tables
+        exact: a cached exact count
+        estimated: an estimate, falls back to exact if there is none
+        none: no count
+    selection is a filtered select to count instead of the whole table,
+    it is always counted exactly (and not cached)
+    session defaults to db.session
+    returns the count and which kind of count it is
+'''
+
+
+def count_rows(model, strategy='auto', selection=None, session=None):
+    session = session or db.session
+    if strategy == 'none':
+        return None, 'none'
+    if selection is not None:
+        count = session.execute(select(func.count()).select_from(
+            selection.order_by(None).subquery())).scalar()
+        return count, 'exact'
+    if strategy == 'auto':
+        count = cached_count(model.__tablename__)
+        if count is not None:
+            return count, 'exact'
+    if strategy in ('auto', 'estimated'):
+        estimate = estimate_count(model.__tablename__, session)
+        if estimate is not None and (
+                strategy == 'estimated' or
+                estimate >= COUNT_ESTIMATE_THRESHOLD):
+            return estimate, 'estimated'
+    return exact_count(model, session), 'exact'
+
+
+# Inserts
+
+'''
+create_row(model, values, unique_column)
+    inserts a row in one atomic statement
+    on postgres: INSERT ... ON CONFLICT (unique_column) DO NOTHING RETURNING id
+    elsewhere: a plain INSERT, a unique violation is detected after the fact
+    returns the new row id, or None if unique_column already has the value
+'''
+
+
+def create_row(model, values, unique_column):
+    table = model.__table__
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            statement = postgresql.insert(table).values(**values) \
+                .on_conflict_do_nothing(index_elements=[unique_column]) \
+                .returning(table.c.id)
+            new_id = db.session.execute(statement).scalar()
+        else:
+            result = db.session.execute(table.insert().values(**values))
+            new_id = result.inserted_primary_key[0]
+        if new_id is not None:
+            record_write(
+                [table.name], [(table.name, 'created', [{'id': new_id}])])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # only a duplicate is a conflict, other violations are raised
+        duplicate = db.session.query(table.c.id).filter(
+            unique_column == values[unique_column.key]).first()
+        if duplicate is None:
+            raise
+        return None
+    except Exception:
+        db.session.rollback()
+        raise
+    if new_id is not None:
+        invalidate_count(table.name)
+    return new_id
+
+
+'''
+create_rows(model, rows, unique_column, batch_size)
+    inserts rows in batches of batch_size inside one transaction
+    rows is an iterable of values dicts (None for rows to skip),
+    it is consumed one batch at a time
+    on postgres each batch is one multi-row
+    INSERT ... ON CONFLICT (unique_column) DO NOTHING RETURNING id
+    on sqlite each row is one INSERT ... ON CONFLICT DO NOTHING (no
+    savepoints: pysqlite doesn't BEGIN before a SAVEPOINT, so each
+    RELEASE would commit its row alone)
+    elsewhere each row is inserted in its own savepoint
+    returns a list with the new id for each row, or None if the row was
+    skipped or unique_column already has the value (or repeats in rows)
+'''
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 1000))
+
+
+def insert_batch(table, batch, unique_column, ids):
+    key = unique_column.key
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(table) \
+            .values([row for index, row in batch]) \
+            .on_conflict_do_nothing(index_elements=[unique_column]) \
+            .returning(table.c.id, table.c[key])
+        # RETURNING doesn't keep the VALUES order, match on the unique value
+        created = {
+            value: new_id
+            for new_id, value in db.session.execute(statement)}
+        for index, row in batch:
+            ids[index] = created.get(row[key])
+        return
+    if db.engine.dialect.name == 'sqlite':
+        for index, row in batch:
+            result = db.session.execute(
+                sqlite.insert(table).values(**row)
+                .on_conflict_do_nothing(index_elements=[unique_column]))
+            if result.rowcount:
+                ids[index] = result.inserted_primary_key[0]
+        return
+    for index, row in batch:
+        try:
+            with db.session.begin_nested():
+                result = db.session.execute(table.insert().values(**row))
+            ids[index] = result.inserted_primary_key[0]
+        except IntegrityError:
+            duplicate = db.session.query(table.c.id).filter(
+                unique_column == row[key]).first()
+            if duplicate is None:
+                raise
+
+
+def create_rows(model, rows, unique_column, batch_size=BULK_BATCH_SIZE):
+    table = model.__table__
+    key = unique_column.key
+    ids = []
+    seen = set()
+    batch = []
+    try:
+        for row in rows:
+            ids.append(None)
+            if row is None or row[key] in seen:
+                continue
+            seen.add(row[key])
+            batch.append((len(ids) - 1, row))
+            if len(batch) >= batch_size:
+                insert_batch(table, batch, unique_column, ids)
+                batch = []
+        if batch:
+            insert_batch(table, batch, unique_column, ids)
+        created = [{'id': new_id} for new_id in ids if new_id is not None]
+        if created:
+            record_write([table.name], [(table.name, 'created', created)])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_count(table.name)
+    return ids
+
+
+# Bulk updates and deletes
+
+class TooManyRowsError(Exception):
+    def __init__(self, count, max_rows):
+        super().__init__(f'{count} rows match, at most {max_rows} allowed')
+        self.count = count
+        self.max_rows = max_rows
+
+
+def chunks(items, size=BULK_BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def check_max_rows(count, max_rows):
+    if max_rows is not None and count > max_rows:
+        raise TooManyRowsError(count, max_rows)
+
+
+# counts at most max_rows + 1 rows matching where, before a set-based
+# write, so a request matching too many rows doesn't lock them for nothing
+def probe_max_rows(table, where, max_rows):
+    if max_rows is None:
+        return
+    probe = select(table.c.id).where(where).limit(max_rows + 1).subquery()
+    check_max_rows(
+        db.session.execute(select(func.count()).select_from(probe)).scalar(),
+        max_rows)
+
+
+# the ids of the rows matching where, by chunks of BULK_BATCH_SIZE
+def matching_ids(table, where):
+    ids = db.session.execute(
+        select(table.c.id).where(where).order_by(table.c.id)).scalars().all()
+    return ids, list(chunks(ids))
+
+
+'''
+update_rows(model, where, values, max_rows)
+    sets values on the rows matching where, in one transaction
+    on postgres: a LIMIT max_rows + 1 count of the matching rows, then
+    one UPDATE ... WHERE ... RETURNING
+    elsewhere: the matching ids are selected, then updated and read
+    back by id
+    returns the updated rows (all their columns) in id order
+    raises TooManyRowsError (and updates nothing) if more than
+    max_rows rows match
+'''
+
+
+def update_rows(model, where, values, max_rows=None):
+    table = model.__table__
+    # every update bumps the version of the row (see Actor.version)
+    if 'version' in table.c:
+        values = dict(values, version=table.c.version + 1)
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            probe_max_rows(table, where, max_rows)
+            rows = db.session.execute(
+                table.update().where(where).values(**values)
+                .returning(*table.c)).all()
+            check_max_rows(len(rows), max_rows)
+            rows.sort(key=lambda row: row.id)
+        else:
+            ids, batches = matching_ids(table, where)
+            check_max_rows(len(ids), max_rows)
+            rows = []
+            for batch in batches:
+                db.session.execute(table.update().where(
+                    table.c.id.in_(batch)).values(**values))
+                rows += db.session.execute(
+                    select(table).where(table.c.id.in_(batch))
+                    .order_by(table.c.id)).all()
+        if rows:
+            record_write([table.name], [
+                (table.name, 'updated', [{'id': row.id} for row in rows])])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return rows
+
+
+# the keys of the castings where casting_column is one of ids
+def casting_keys(casting_column, ids):
+    castings = Casting.__table__
+    return [dict(row) for row in db.session.execute(
+        select(castings.c.actor_id, castings.c.movie_id)
+        .where(casting_column.in_(ids))).mappings()]
+
+
+'''
+delete_rows(model, where, casting_column, max_rows)
+    deletes the rows matching where and their castings (casting_column
+    is the castings column referencing them), in one transaction
+    on postgres: a LIMIT max_rows + 1 count of the matching rows, the
+    castings (DELETE ... RETURNING their keys, for the change feed), then
+    one DELETE ... WHERE ... RETURNING id
+    elsewhere: the matching ids are selected, then their castings are
+    selected and deleted, and the rows deleted by id
+    returns the deleted ids in id order
+    raises TooManyRowsError (and deletes nothing) if more than
+    max_rows rows match
+'''
+
+
+def delete_rows(model, where, casting_column, max_rows=None):
+    table = model.__table__
+    castings = Casting.__table__
+    try:
+        if db.engine.dialect.name == 'postgresql':
+            probe_max_rows(table, where, max_rows)
+            links = [dict(row) for row in db.session.execute(
+                castings.delete().where(casting_column.in_(
+                    select(table.c.id).where(where)))
+                .returning(castings.c.actor_id, castings.c.movie_id))
+                .mappings()]
+            ids = sorted(db.session.execute(
+                table.delete().where(where).returning(table.c.id))
+                .scalars().all())
+            check_max_rows(len(ids), max_rows)
+        else:
+            ids, batches = matching_ids(table, where)
+            check_max_rows(len(ids), max_rows)
+            links = []
+            for batch in batches:
+                links += casting_keys(casting_column, batch)
+                db.session.execute(
+                    castings.delete().where(casting_column.in_(batch)))
+                db.session.execute(
+                    table.delete().where(table.c.id.in_(batch)))
+        if ids:
+            record_write([table.name, castings.name], [
+                (table.name, 'deleted', [{'id': row_id} for row_id in ids]),
+                (castings.name, 'deleted', links)])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if ids:
+        invalidate_count(table.name)
+    return ids
+
+
 # create database tables
 class Actor(db.Model):
     __tablename__ = "actors"
+    __table_args__ = (
+        # gender filters, alone or with an age range
+        Index('ix_actors_gender_age', 'gender', 'age'),
+        # trigram index for case insensitive name searches (postgres)
+        Index('ix_actors_name_trgm', 'name', postgresql_using='gin',
+              postgresql_ops={'name': 'gin_trgm_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False, unique=True)
-    age = Column(Integer, nullable=False)
+    age = Column(Integer, nullable=False, index=True)
     gender = Column(String, nullable=False)
+    # bumped by every write of the row, it is the ETag of the actor, and
+    # a PATCH/DELETE with If-Match only applies to the version it names
+    # (ORM writes bump it through version_id_col, update_rows does it
+    # in its UPDATE)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # not loaded by default, use selectinload(Actor.movies) to load
+    # the movies of many actors in one extra query
+    movies = db.relationship(
+        'Movie', secondary='castings', back_populates='actors',
+        order_by='Movie.id')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, name, age, gender):
         self.name = name
@@ -40,14 +760,27 @@ class Actor(db.Model):
 
     def insert(self):
         db.session.add(self)
+        # the id is needed by the change
+        db.session.flush()
+        record_write([self.__tablename__], [
+            (self.__tablename__, 'created', [{'id': self.id}])])
         db.session.commit()
+        invalidate_count(self.__tablename__)
 
     def update(self):
+        record_write([self.__tablename__], [
+            (self.__tablename__, 'updated', [{'id': self.id}])])
         db.session.commit()
 
     def delete(self):
+        # deleting the row also deletes its castings
+        links = casting_keys(Casting.__table__.c.actor_id, [self.id])
         db.session.delete(self)
+        record_write([self.__tablename__, Casting.__tablename__], [
+            (self.__tablename__, 'deleted', [{'id': self.id}]),
+            (Casting.__tablename__, 'deleted', links)])
         db.session.commit()
+        invalidate_count(self.__tablename__)
 
     def format(self):
         return {
@@ -57,13 +790,32 @@ class Actor(db.Model):
             "gender": self.gender
         }
 
+    def format_with_movies(self):
+        actor = self.format()
+        actor["movies"] = [movie.format() for movie in self.movies]
+        return actor
+
 
 class Movie(db.Model):
     __tablename__ = "movies"
+    __table_args__ = (
+        # trigram index for case insensitive title searches (postgres)
+        Index('ix_movies_title_trgm', 'title', postgresql_using='gin',
+              postgresql_ops={'title': 'gin_trgm_ops'}),
+    )
 
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False, unique=True)
-    release_date = Column(Date, nullable=False)
+    release_date = Column(Date, nullable=False, index=True)
+    # the version of the movie, like Actor.version
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # not loaded by default, use selectinload(Movie.actors) to load
+    # the actors of many movies in one extra query
+    actors = db.relationship(
+        'Actor', secondary='castings', back_populates='movies',
+        order_by='Actor.id')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __init__(self, title, release_date):
         self.title = title
@@ -71,30 +823,76 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        # the id is needed by the change
+        db.session.flush()
+        record_write([self.__tablename__], [
+            (self.__tablename__, 'created', [{'id': self.id}])])
         db.session.commit()
+        invalidate_count(self.__tablename__)
 
     def update(self):
+        record_write([self.__tablename__], [
+            (self.__tablename__, 'updated', [{'id': self.id}])])
         db.session.commit()
 
     def delete(self):
+        # deleting the row also deletes its castings
+        links = casting_keys(Casting.__table__.c.movie_id, [self.id])
         db.session.delete(self)
+        record_write([self.__tablename__, Casting.__tablename__], [
+            (self.__tablename__, 'deleted', [{'id': self.id}]),
+            (Casting.__tablename__, 'deleted', links)])
         db.session.commit()
+        invalidate_count(self.__tablename__)
 
     def format(self):
         return {
             "id": self.id,
             "title": self.title,
-            "release_date": self.release_date
+            "release_date": self.release_date.isoformat()
         }
 
+    def format_with_actors(self):
+        movie = self.format()
+        movie["actors"] = [actor.format() for actor in self.actors]
+        return movie
+
+
+# the trigram indexes need the pg_trgm extension
+event.listen(
+    db.metadata, 'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        dialect='postgresql'))
+
 
 # association table between the Actor and Movie models
 class Casting(db.Model):
     __tablename__ = "castings"
 
     actor_id = Column(Integer, ForeignKey('actors.id'), primary_key=True)
-    movie_id = Column(Integer, ForeignKey('movies.id'), primary_key=True)
+    # the primary key only covers lookups by actor, this one is for the
+    # casts of movies
+    movie_id = Column(
+        Integer, ForeignKey('movies.id'), primary_key=True, index=True)
 
     def __init__(self, actor_id, movie_id):
         self.actor_id = actor_id
         self.movie_id = movie_id
+
+    def insert(self):
+        db.session.add(self)
+        record_write([self.__tablename__], [
+            (self.__tablename__, 'created', [self.format()])])
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        record_write([self.__tablename__], [
+            (self.__tablename__, 'deleted', [self.format()])])
+        db.session.commit()
+
+    def format(self):
+        return {
+            "actor_id": self.actor_id,
+            "movie_id": self.movie_id
+        }
@@ -0,0 +1,227 @@
+import os
+import threading
+import time
+from functools import wraps
+from flask import g, make_response
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DBAPIError
+from cache import LocalBackend, RedisBackend, RESPONSE_CACHE_REDIS_URL
+from models import db, engine_options, read_bind
+
+
+'''
+Read replicas
+    DATABASE_READ_URLS is a comma separated list of read replicas of
+    DATABASE_URL, the GET handlers read from them (round robin) and
+    every write goes to the primary
+    a client that wrote in the last READ_YOUR_WRITES_SECONDS reads from
+    the primary, so it sees its own writes even if the replicas lag
+'''
+DATABASE_READ_URLS = [
+    url.strip().replace('postgres://', 'postgresql://')
+    for url in os.environ.get('DATABASE_READ_URLS', '').split(',')
+    if url.strip()]
+READ_YOUR_WRITES_SECONDS = float(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+# max number of clients remembered per worker (without redis)
+READ_YOUR_WRITES_CLIENTS = int(
+    os.environ.get('READ_YOUR_WRITES_CLIENTS', 10000))
+# seconds between two health checks of a replica
+REPLICA_CHECK_INTERVAL = float(os.environ.get('REPLICA_CHECK_INTERVAL', 5))
+
+# the errors of a replica that send its reads back to the primary
+REPLICA_ERRORS = (DBAPIError, OSError)
+
+
+def check(engine):
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        return True
+    except REPLICA_ERRORS as e:
+        print(e)
+        return False
+
+
+async def check_async(engine):
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
+        return True
+    except REPLICA_ERRORS as e:
+        print(e)
+        return False
+
+
+'''
+ReplicaSet class
+    the engines of the read replicas and their health
+    a replica is checked (SELECT 1) when it is picked and its last check
+    is older than check_interval, a replica that fails a check or a read
+    is skipped until a later check passes
+    choose() returns None when no replica is healthy, the reads
+    then go to the primary
+'''
+
+
+class ReplicaSet:
+    def __init__(self, engines, check_interval=REPLICA_CHECK_INTERVAL):
+        self.engines = list(engines)
+        self.check_interval = check_interval
+        self.healthy = [True] * len(self.engines)
+        # never checked, so each replica is checked the first time
+        self.checked = [None] * len(self.engines)
+        self.next = 0
+        self.failovers = 0
+        self.lock = threading.Lock()
+
+    # the replicas in round robin order, and if each one is due a check
+    def candidates(self):
+        with self.lock:
+            count = len(self.engines)
+            start = self.next
+            self.next = (self.next + 1) % count if count else 0
+            now = time.monotonic()
+            order = []
+            for offset in range(count):
+                index = (start + offset) % count
+                due = self.checked[index] is None or \
+                    now - self.checked[index] >= self.check_interval
+                # only one request checks a replica, the others
+                # go by its last check meanwhile
+                if due:
+                    self.checked[index] = now
+                order.append((index, due))
+            return order
+
+    def choose(self):
+        for index, due in self.candidates():
+            if due:
+                self.healthy[index] = check(self.engines[index])
+            if self.healthy[index]:
+                return self.engines[index]
+        return None
+
+    async def choose_async(self):
+        for index, due in self.candidates():
+            if due:
+                self.healthy[index] = await check_async(self.engines[index])
+            if self.healthy[index]:
+                return self.engines[index]
+        return None
+
+    # a read failed on engine, it is skipped until its next check
+    def mark_failed(self, engine):
+        with self.lock:
+            index = self.engines.index(engine)
+            self.healthy[index] = False
+            self.checked[index] = time.monotonic()
+            self.failovers += 1
+
+    def stats(self):
+        return {
+            'replicas': len(self.engines),
+            'healthy': sum(self.healthy),
+            'failovers': self.failovers
+        }
+
+
+'''
+RecentWrites class
+    the clients (by the sub of their token) that wrote in the last
+    window seconds, in a cache backend (redis when
+    RESPONSE_CACHE_REDIS_URL is set, so all the workers know them)
+'''
+
+
+class RecentWrites:
+    def __init__(self, backend, window=READ_YOUR_WRITES_SECONDS,
+                 enabled=True):
+        self.backend = backend
+        self.window = window
+        self.enabled = enabled and window > 0
+
+    @staticmethod
+    def key(payload):
+        sub = payload.get('sub')
+        return None if sub is None else 'writer:' + sub
+
+    def record(self, payload):
+        key = self.key(payload)
+        if self.enabled and key is not None:
+            self.backend.set(key, True, self.window)
+
+    def contains(self, payload):
+        key = self.key(payload)
+        if not self.enabled or key is None:
+            return False
+        return self.backend.get(key) is not None
+
+
+def make_writes_backend():
+    if RESPONSE_CACHE_REDIS_URL:
+        return RedisBackend(RESPONSE_CACHE_REDIS_URL, prefix='recent-writes:')
+    return LocalBackend(READ_YOUR_WRITES_CLIENTS)
+
+
+read_replicas = ReplicaSet([
+    create_engine(url, **engine_options(url)) for url in DATABASE_READ_URLS])
+recent_writes = RecentWrites(
+    make_writes_backend(), enabled=bool(DATABASE_READ_URLS))
+
+
+'''
+@reads_replica decorator method
+    to be used under @requires_auth (it gets the decoded payload) and
+    above @cached and @conditional, so they read from the same database
+    as the handler
+    runs the handler with its reads on a healthy replica, or on the
+    primary when the client wrote recently (without the response cache,
+    which may hold a response read from a lagging replica) or no
+    replica is healthy
+    a read that fails on the replica is run again on the primary
+'''
+
+
+def reads_replica(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        if not read_replicas.engines:
+            return f(payload, *args, **kwargs)
+        if recent_writes.contains(payload):
+            g.read_your_writes = True
+            return f(payload, *args, **kwargs)
+        engine = read_replicas.choose()
+        if engine is None:
+            return f(payload, *args, **kwargs)
+        token = read_bind.set(engine)
+        try:
+            return f(payload, *args, **kwargs)
+        except REPLICA_ERRORS as e:
+            print(e)
+            read_replicas.mark_failed(engine)
+            db.session.rollback()
+        finally:
+            read_bind.reset(token)
+        return f(payload, *args, **kwargs)
+
+    return wrapper
+
+
+'''
+@records_write decorator method
+    to be used under @requires_auth on the write handlers, it records
+    the client after a successful write, so its next reads go to
+    the primary
+'''
+
+
+def records_write(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        response = make_response(f(payload, *args, **kwargs))
+        if response.status_code < 400:
+            recent_writes.record(payload)
+        return response
+
+    return wrapper
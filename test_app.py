@@ -1,11 +1,71 @@
+import asyncio
 import os
 import sys
 import unittest
 import json
 import datetime
+import math
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from sqlalchemy import event, create_engine
+from prometheus_client import REGISTRY
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from flask_sqlalchemy import SQLAlchemy
 from app import create_app
-from models import setup_db, Actor, Movie, db
+from models import setup_db, Actor, Movie, Casting, Change, db
+from models import InstrumentedQueuePool, engine_options, pool_metrics
+import models
+from auth import AuthError, JWKSStore, TokenCache
+from cache import LocalBackend, ResponseCache, response_cache
+from encoding import ENCODERS, orjson
+from replicas import ReplicaSet, recent_writes
+import replicas
+from group_commit import GroupCommitQueue, QueueFullError
+from changes import ChangeFeed, change_tables, latest_change_id, read_changes
+from changes import Subscriber, stream, SSE_EXPIRED, SSE_KEEPALIVE
+from changes import TooManySubscribersError
+
+
+class ASGITestResponse:
+    """ the parts of a Flask test response the tests use """
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.data = response.content
+        self.mimetype = response.headers.get(
+            'content-type', '').split(';')[0]
+
+
+class ASGITestClient:
+    """ a Flask-like test client for the ASGI app (TEST_ASGI=1) """
+
+    def __init__(self, asgi_app):
+        from starlette.testclient import TestClient
+        self.client = TestClient(asgi_app)
+
+    def open(self, method, url, headers=None, json=None, data=None,
+             content_type=None):
+        headers = dict(headers or {})
+        if content_type is not None:
+            headers['Content-Type'] = content_type
+        return ASGITestResponse(self.client.request(
+            method, url, headers=headers, json=json, data=data))
+
+    def get(self, url, **kwargs):
+        return self.open('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.open('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.open('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.open('DELETE', url, **kwargs)
 
 
 class CastingAgencyTestCase(unittest.TestCase):
@@ -19,6 +79,15 @@ class CastingAgencyTestCase(unittest.TestCase):
 
         setup_db(self.app, self.database_path)
         db.create_all()
+        # every test starts with an empty response cache
+        response_cache.backend = LocalBackend()
+
+        # TEST_ASGI=1 runs the same tests against the ASGI app (asgi.py)
+        self.asgi_app = None
+        if os.environ.get('TEST_ASGI'):
+            from asgi import create_asgi_app
+            self.asgi_app = create_asgi_app(self.app)
+            self.client = lambda: ASGITestClient(self.asgi_app)
 
         self.casting_assistant_header = {
             'Authorization': "Bearer {}".format(
@@ -85,6 +154,34 @@ class CastingAgencyTestCase(unittest.TestCase):
         """ Executed after each test """
         pass
 
+    @contextmanager
+    def count_queries(self):
+        """ counts the SQL statements run inside the block """
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        engines = [db.engine]
+        if self.asgi_app is not None:
+            engines.append(self.asgi_app.state.engine.sync_engine)
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            for engine in engines:
+                event.remove(
+                    engine, 'before_cursor_execute', before_cursor_execute)
+
+    def assertMaxQueries(self, max_queries, url, method='get', **kwargs):
+        """ requests url and checks it ran at most max_queries statements """
+        with self.count_queries() as statements:
+            res = getattr(self.client(), method)(url, **kwargs)
+        self.assertLessEqual(
+            len(statements), max_queries, '\n'.join(statements))
+        return res
+
     '''
     Tests for Auth
     '''
@@ -179,12 +276,257 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data["actors_count"])
 
     def test_get_actors_bad_url(self):
-        res = self.client().get('/actors/2', headers=self.all_perms_header)
+        # GET /actors/2 is an actor, it can't be posted to
+        res = self.client().post('/actors/2', headers=self.all_perms_header)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 405)
         self.assertEqual(data['success'], False)
 
+    def test_get_actor(self):
+        actor = Actor.query.order_by(Actor.id).first()
+        movie_ids = [movie.id for movie in actor.movies]
+        res = self.client().get(
+            "/actors/%d?include=movies" % actor.id,
+            headers=self.casting_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['name'], actor.name)
+        self.assertEqual(
+            [movie['id'] for movie in data['actor']['movies']], movie_ids)
+
+    def test_get_actor_does_not_exist(self):
+        res = self.client().get(
+            "/actors/999999", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_by_ids(self):
+        ids = [actor.id for actor in Actor.query.order_by(Actor.id).all()]
+        url = "/actors?count=exact&ids=%d,999999,%d" % (ids[-1], ids[0])
+        res = self.assertMaxQueries(
+            3, url, headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        # found ids in id order, the missing one is left out
+        self.assertEqual(
+            [actor['id'] for actor in data['actors']], [ids[0], ids[-1]])
+        self.assertEqual(data['actors_count'], 2)
+
+    def test_get_actors_bad_ids(self):
+        res = self.client().get(
+            "/actors?ids=1,two", headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_fields(self):
+        res = self.client().get(
+            "/actors?fields=name&sort=-age&limit=1",
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['actors'][0]), {'id', 'name'})
+        # the cursor still carries the sort value
+        res = self.client().get(
+            "/actors?fields=name&sort=-age&limit=1&after=%s" %
+            data['next_cursor'], headers=self.all_perms_header)
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_actors_unknown_field(self):
+        res = self.client().get(
+            "/actors?fields=name,salary", headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_version_is_not_a_field(self):
+        res = self.client().get(
+            "/actors?fields=name,version", headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_actors_limit(self):
+        res = self.client().get(
+            "/actors?limit=1", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertTrue(data['next_cursor'])
+
+    def test_get_actors_after_cursor(self):
+        res = self.client().get(
+            "/actors?limit=1", headers=self.all_perms_header)
+        first_page = json.loads(res.data)
+        res = self.client().get(
+            "/actors?limit=1&after={}".format(first_page['next_cursor']),
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['actors']), 1)
+        self.assertGreater(
+            data['actors'][0]['id'], first_page['actors'][0]['id'])
+
+    def test_get_actors_invalid_cursor(self):
+        res = self.client().get(
+            "/actors?after=not-a-cursor", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_exact_count(self):
+        res = self.client().get(
+            "/actors?count=exact", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors_count'], Actor.query.count())
+        self.assertEqual(data['actors_count_type'], 'exact')
+
+    def test_get_movies_no_count(self):
+        res = self.client().get(
+            "/movies?count=none", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['movies_count'])
+        self.assertEqual(data['movies_count_type'], 'none')
+
+    def test_get_movies_invalid_count(self):
+        res = self.client().get(
+            "/movies?count=all", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_not_modified(self):
+        res = self.client().get("/actors", headers=self.all_perms_header)
+        etag = res.headers['ETag']
+        res = self.client().get("/actors", headers=dict(
+            self.all_perms_header, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+
+    def test_get_actors_etag_changes_after_write(self):
+        res = self.client().get("/actors", headers=self.all_perms_header)
+        etag = res.headers['ETag']
+        self.client().post(
+            "/actors", json={"name": "Etag Actor", "age": 40,
+                             "gender": "male"},
+            headers=self.all_perms_header)
+        res = self.client().get("/actors", headers=dict(
+            self.all_perms_header, **{'If-None-Match': etag}))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_get_actors_cached(self):
+        self.client().get("/actors", headers=self.all_perms_header)
+        hits = response_cache.stats()['hits']
+        res = self.client().get("/actors", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(response_cache.stats()['hits'], hits + 1)
+
+    def test_get_actors_cache_invalidated_by_post(self):
+        res = self.client().get(
+            "/actors?count=exact", headers=self.all_perms_header)
+        count = json.loads(res.data)['actors_count']
+        self.client().post(
+            "/actors", json={"name": "Cached Actor", "age": 40,
+                             "gender": "male"},
+            headers=self.all_perms_header)
+        res = self.client().get(
+            "/actors?count=exact", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['actors_count'], count + 1)
+
+    def test_metrics(self):
+        self.client().get("/actors?count=exact", headers=self.all_perms_header)
+        res = self.client().get("/metrics")
+        body = res.data.decode()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(
+            'http_requests_total{method="GET",route="get_actors",'
+            'status="200"}', body)
+        self.assertIn(
+            'http_request_phase_duration_seconds_count{'
+            'phase="sql",route="get_actors"}', body)
+
+    def test_get_actors_filter_gender_age(self):
+        res = self.client().get(
+            "/actors?gender=female&min_age=30&max_age=60",
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actors_count'], len(data['actors']))
+        for actor in data['actors']:
+            self.assertEqual(actor['gender'], 'female')
+            self.assertTrue(30 <= actor['age'] <= 60)
+
+    def test_get_actors_name_search(self):
+        res = self.client().get(
+            "/actors?name=SMI", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for actor in data['actors']:
+            self.assertIn('smi', actor['name'].lower())
+
+    def test_get_actors_sort_after_cursor(self):
+        res = self.client().get(
+            "/actors?sort=-age&limit=1", headers=self.all_perms_header)
+        first_page = json.loads(res.data)
+        res = self.client().get(
+            "/actors?sort=-age&limit=1&after={}".format(
+                first_page['next_cursor']),
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(
+            data['actors'][0]['age'], first_page['actors'][0]['age'])
+        self.assertNotEqual(
+            data['actors'][0]['id'], first_page['actors'][0]['id'])
+
+    def test_get_actors_bad_filter(self):
+        res = self.client().get(
+            "/actors?min_age=old", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_actors_bad_sort(self):
+        res = self.client().get(
+            "/actors?sort=password", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movies_release_date_range(self):
+        res = self.client().get(
+            "/movies?min_release_date=2010-1-1&max_release_date=2015-12-31",
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies_count'], len(data['movies']))
+
     def test_get_movies(self):
         res = self.client().get('/movies', headers=self.all_perms_header)
         data = json.loads(res.data)
@@ -194,13 +536,239 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(len(data['movies']))
         self.assertTrue(data["movies_count"])
 
+    def test_get_movie(self):
+        movie = Movie.query.order_by(Movie.id).first()
+        res = self.client().get(
+            "/movies/%d?fields=release_date" % movie.id,
+            headers=self.casting_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movie'], {
+            "id": movie.id,
+            "release_date": movie.release_date.isoformat()
+        })
+
+    def test_get_movies_by_ids_and_fields(self):
+        movie = Movie.query.order_by(Movie.id).first()
+        res = self.client().get(
+            "/movies?ids=%d&fields=title" % movie.id,
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            data['movies'], [{"id": movie.id, "title": movie.title}])
+
     def test_get_movies_bad_url(self):
-        res = self.client().get("/movies/3", headers=self.all_perms_header)
+        res = self.client().post("/movies/3", headers=self.all_perms_header)
         data = json.loads(res.data)
 
         self.assertEqual(res.status_code, 405)
         self.assertEqual(data['success'], False)
 
+    def test_export_actors(self):
+        res = self.client().get(
+            "/actors/export", headers=self.casting_assistant_header)
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), Actor.query.count())
+        self.assertIn('name', json.loads(lines[0]))
+
+    def test_export_movies_csv(self):
+        res = self.client().get(
+            "/movies/export?format=csv", headers=self.all_perms_header)
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/csv')
+        self.assertEqual(lines[0], 'id,title,release_date')
+        self.assertEqual(len(lines), Movie.query.count() + 1)
+
+    def test_export_movies_bad_format(self):
+        res = self.client().get(
+            "/movies/export?format=xml", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    '''
+    Tests for castings
+    '''
+
+    def test_post_casting(self):
+        self.client().delete(
+            "/movies/1/actors/3", headers=self.all_perms_header)
+        res = self.client().post(
+            "/movies/1/actors", json={"actor_id": 3},
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['created'], {"actor_id": 3, "movie_id": 1})
+
+    def test_post_casting_no_actor(self):
+        res = self.client().post(
+            "/movies/1/actors", json={"actor_id": 99},
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_get_movie_actors(self):
+        self.client().post(
+            "/movies/1/actors", json={"actor_id": 1},
+            headers=self.all_perms_header)
+        res = self.client().get(
+            "/movies/1/actors", headers=self.casting_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(1, [actor['id'] for actor in data['actors']])
+
+    def test_get_actor_movies(self):
+        self.client().post(
+            "/movies/1/actors", json={"actor_id": 1},
+            headers=self.all_perms_header)
+        res = self.client().get(
+            "/actors/1/movies", headers=self.casting_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(1, [movie['id'] for movie in data['movies']])
+
+    def test_get_movies_with_actors_query_count(self):
+        for actor_id in (1, 3):
+            self.client().post(
+                "/movies/1/actors", json={"actor_id": actor_id},
+                headers=self.all_perms_header)
+        # the table versions (for the ETag), the page and all of its casts
+        res = self.assertMaxQueries(
+            3, "/movies?include=actors&count=none&limit=100",
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(all('actors' in movie for movie in data['movies']))
+
+    def test_read_endpoints_query_count(self):
+        # the table versions, the count and the page
+        self.assertMaxQueries(
+            3, "/actors?count=exact&gender=male",
+            headers=self.all_perms_header)
+        # the table versions, the movie and its cast
+        self.assertMaxQueries(
+            3, "/movies/1/actors?query_count=1",
+            headers=self.all_perms_header)
+        self.assertMaxQueries(
+            3, "/actors/1/movies?query_count=1",
+            headers=self.all_perms_header)
+
+    def test_db_debug_headers(self):
+        self.app.config['DB_DEBUG_HEADERS'] = True
+        res = self.client().get(
+            "/actors?count=exact&debug_headers=1",
+            headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreaterEqual(int(res.headers['X-DB-Queries']), 2)
+        self.assertGreater(float(res.headers['X-DB-Time']), 0)
+
+    def test_slow_query_log(self):
+        slow_query_ms = models.SLOW_QUERY_MS
+        models.SLOW_QUERY_MS = 0.000001
+        try:
+            with self.assertLogs('slow_queries') as logs:
+                self.client().get(
+                    "/actors?count=exact",
+                    headers=self.all_perms_header)
+        finally:
+            models.SLOW_QUERY_MS = slow_query_ms
+        # the change feed threads of other tests log their queries too
+        entries = [json.loads(record.getMessage()) for record in logs.records]
+        entry = [entry for entry in entries if entry['route'] is not None][0]
+
+        self.assertEqual(entry['event'], 'slow_query')
+        self.assertEqual(entry['route'], 'get_actors')
+        self.assertIn('duration_ms', entry)
+
+    @contextmanager
+    def read_replica(self, create_tables=True):
+        """ serves the reads from a sqlite replica, yields its engine """
+        directory = tempfile.mkdtemp()
+        database_url = 'sqlite:///' + os.path.join(directory, 'replica.db')
+        engine = create_engine(database_url)
+        if create_tables:
+            db.metadata.create_all(engine)
+        previous = replicas.read_replicas, self.asgi_app
+        replica_set = replicas.read_replicas = ReplicaSet([engine])
+        recent_writes.enabled = True
+        if self.asgi_app is not None:
+            from asgi import create_asgi_app
+            self.asgi_app = create_asgi_app(
+                self.app, read_urls=[database_url])
+            replica_set = self.asgi_app.state.read_replicas
+        try:
+            yield engine, replica_set
+        finally:
+            replicas.read_replicas, self.asgi_app = previous
+            recent_writes.enabled = False
+            recent_writes.backend.entries.clear()
+            engine.dispose()
+
+    def test_read_replica_read_your_writes(self):
+        with self.read_replica() as (engine, replica_set):
+            with engine.begin() as connection:
+                connection.execute(Actor.__table__.insert().values(
+                    name="Replica Actor", age=40, gender="female"))
+            url = "/actors?limit=100"
+
+            # reads go to the replica
+            res = self.client().get(url, headers=self.all_perms_header)
+            names = [actor['name'] for actor in json.loads(res.data)['actors']]
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(names, ["Replica Actor"])
+
+            # right after a write, the writer reads from the primary
+            actor = {"name": "Primary Actor %s" % time.time(), "age": 30,
+                     "gender": "male"}
+            res = self.client().post(
+                "/actors", json=actor, headers=self.all_perms_header)
+            self.assertEqual(res.status_code, 200)
+            res = self.client().get(url, headers=self.all_perms_header)
+            names = [actor['name'] for actor in json.loads(res.data)['actors']]
+            self.assertIn(actor['name'], names)
+            self.assertNotIn("Replica Actor", names)
+
+            # and back to the replica once the window is over
+            recent_writes.backend.entries.clear()
+            res = self.client().get(url, headers=self.all_perms_header)
+            names = [actor['name'] for actor in json.loads(res.data)['actors']]
+            self.assertEqual(names, ["Replica Actor"])
+
+    def test_read_replica_failover(self):
+        # the replica has no tables, so its reads fail
+        with self.read_replica(create_tables=False) as (engine, replica_set):
+            res = self.client().get("/actors", headers=self.all_perms_header)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.data)['success'], True)
+            self.assertEqual(replica_set.stats()['healthy'], 0)
+            self.assertEqual(replica_set.stats()['failovers'], 1)
+
+    def test_delete_casting_does_not_exist(self):
+        res = self.client().delete(
+            "/movies/1/actors/99", headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
     '''
     Tests for POST endpoints
     '''
@@ -215,6 +783,18 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['created'])
 
+    def test_post_actor_already_exists(self):
+        actor = {"name": "Meryl Streep", "age": 71, "gender": "female"}
+        self.client().post(
+            "/actors", json=actor, headers=self.all_perms_header)
+        res = self.client().post(
+            "/actors", json=actor, headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message']['code'], "Conflict")
+
     def test_post_actor_bad_json(self):
         res = self.client().post(
             "/actors", json=self.invalid_actor_json,
@@ -234,6 +814,194 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['created'])
 
+    def test_post_actors_bulk(self):
+        actors = [
+            {"name": "Bulk Actor 1", "age": 30, "gender": "female"},
+            {"name": "Bulk Actor 1", "age": 30, "gender": "female"},
+            {"name": "Bulk Actor 2", "agw": 40}
+        ]
+        res = self.client().post(
+            "/actors/bulk", json=actors, headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(
+            [result['status'] for result in data['results']][1:],
+            ['conflict', 'invalid'])
+
+    def threaded_post(self, url, **kwargs):
+        """ posts like a request of a threaded worker """
+        if self.asgi_app is not None:
+            return self.client().post(url, **kwargs)
+        return self.app.test_client().post(
+            url, environ_overrides={'wsgi.multithread': True}, **kwargs)
+
+    def test_post_actor_group_commit(self):
+        write_queue = GroupCommitQueue(self.app)
+        self.app.extensions['group_commit'] = write_queue
+        actor = {"name": "Group Commit %s" % time.time(), "age": 40,
+                 "gender": "female"}
+        res = self.threaded_post(
+            "/actors", json=actor, headers=self.all_perms_header)
+        data = json.loads(res.data)
+        conflict = self.threaded_post(
+            "/actors", json=actor, headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Actor.query.get(data['created']).name, actor['name'])
+        self.assertEqual(conflict.status_code, 409)
+        self.assertEqual(write_queue.rows, 2)
+
+    def test_post_actor_group_commit_sync_worker(self):
+        write_queue = GroupCommitQueue(self.app)
+        self.app.extensions['group_commit'] = write_queue
+        actor = {"name": "Group Commit %s" % time.time(), "age": 40,
+                 "gender": "female"}
+        # the Flask test client is single threaded, like a sync worker
+        res = self.app.test_client().post(
+            "/actors", json=actor, headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(Actor.query.get(data['created']).name, actor['name'])
+        self.assertEqual(write_queue.rows, 0)
+        self.assertTrue(write_queue.sync_warned)
+
+    def test_group_commit_lone_row_does_not_wait(self):
+        write_queue = GroupCommitQueue(self.app, max_wait_ms=5000)
+        start = time.monotonic()
+        new_id = write_queue.create(
+            Actor, {"name": "Group Commit %s" % time.time(), "age": 30,
+                    "gender": "male"}, Actor.name)
+
+        self.assertIsNotNone(new_id)
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_group_commit_batches(self):
+        write_queue = GroupCommitQueue(self.app, max_wait_ms=200)
+        # no flusher until every row is queued
+        write_queue.pid = os.getpid()
+        write_queue.thread = threading.current_thread()
+        prefix = "Group Commit %s" % time.time()
+        rows = [{"name": "%s %d" % (prefix, n), "age": 30, "gender": "male"}
+                for n in range(4)]
+        rows.append(rows[0])
+        results = [None] * len(rows)
+
+        def create(index):
+            try:
+                results[index] = write_queue.create(
+                    Actor, rows[index], Actor.name)
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=create, args=(index,))
+                   for index in range(len(rows))]
+        for thread in threads:
+            thread.start()
+        while write_queue.queue.qsize() < len(rows):
+            time.sleep(0.01)
+        write_queue.thread = None
+        write_queue.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(write_queue.batches, 1)
+        self.assertEqual(
+            len(set(results[:4]) | {results[4]}), 5)
+        self.assertIn(None, [results[0], results[4]])
+        self.assertEqual(
+            Actor.query.filter(Actor.name.like(prefix + ' %')).count(), 4)
+
+    def test_group_commit_bad_row(self):
+        write_queue = GroupCommitQueue(self.app)
+        name = "Group Commit %s" % time.time()
+        bad, good = Future(), Future()
+        # the NOT NULL violation rolls back the whole batch (the good row
+        # too), then each row is retried alone
+        write_queue.flush([
+            (Actor, {"name": name + " 2", "age": 30, "gender": "male"},
+             Actor.name, good),
+            (Actor, {"name": name, "age": None, "gender": "male"},
+             Actor.name, bad)])
+
+        self.assertIsInstance(bad.exception(), Exception)
+        self.assertEqual(Actor.query.get(good.result()).name, name + " 2")
+
+    def test_group_commit_timeout_drops_queued_row(self):
+        write_queue = GroupCommitQueue(self.app, timeout=0.05)
+        # no flusher yet, the row stays queued
+        write_queue.pid = os.getpid()
+        write_queue.thread = threading.current_thread()
+        name = "Group Commit %s" % time.time()
+
+        with self.assertRaises(FutureTimeoutError):
+            write_queue.create(
+                Actor, {"name": name, "age": 30, "gender": "male"},
+                Actor.name)
+        write_queue.thread = None
+        write_queue.create(
+            Actor, {"name": name + " 2", "age": 30, "gender": "male"},
+            Actor.name)
+
+        self.assertIsNone(Actor.query.filter(Actor.name == name).first())
+        self.assertEqual(write_queue.rows, 1)
+
+    def test_group_commit_timeout_waits_for_running_batch(self):
+        class SlowQueue(GroupCommitQueue):
+            def flush(self, batch):
+                time.sleep(0.2)
+                super().flush(batch)
+
+        write_queue = SlowQueue(self.app, timeout=0.05)
+        name = "Group Commit %s" % time.time()
+        new_id = write_queue.create(
+            Actor, {"name": name, "age": 30, "gender": "male"}, Actor.name)
+
+        self.assertEqual(Actor.query.get(new_id).name, name)
+
+    def test_post_actor_group_commit_queue_full(self):
+        write_queue = GroupCommitQueue(self.app, max_queue=1)
+        # no flusher, the queue stays full
+        write_queue.pid = os.getpid()
+        write_queue.thread = threading.current_thread()
+        write_queue.queue.put_nowait(None)
+        self.app.extensions['group_commit'] = write_queue
+
+        with self.assertRaises(QueueFullError):
+            write_queue.create(Actor, self.new_actor, Actor.name)
+        res = self.threaded_post(
+            "/actors", json=self.new_actor, headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(json.loads(res.data)['message'], "service unavailable")
+
+    def test_post_movies_bulk_ndjson(self):
+        movies = "\n".join(json.dumps(movie) for movie in [
+            {"title": "Bulk Movie 1", "release_date": "2020-1-1"},
+            {"title": "Bulk Movie 2", "release_date": "not a date"}
+        ]) + "\nnot json\n"
+        res = self.client().post(
+            "/movies/bulk", data=movies,
+            content_type="application/x-ndjson",
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['results']), 3)
+        self.assertEqual(data['invalid'], 2)
+
+    def test_cannot_post_actors_bulk_CA(self):
+        res = self.client().post(
+            "/actors/bulk", json=[self.new_actor],
+            headers=self.casting_assistant_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(data['success'], False)
+
     def test_post_movie_no_data(self):
         res = self.client().post(
             '/movies', headers=self.all_perms_header)
@@ -259,6 +1027,97 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(actor.name, self.update_actor_json['name'])
         self.assertEqual(actor.gender, self.update_actor_json['gender'])
 
+    def test_update_actor_not_found(self):
+        res = self.client().patch(
+            '/actors/999999', json={"age": 30},
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    def test_update_actor_query_count(self):
+        actor_id = self.create_actors(1)[0]
+        # one UPDATE ... RETURNING and the table version on postgres,
+        # elsewhere the id is selected and the row read back
+        res = self.assertMaxQueries(
+            5, '/actors/%d' % actor_id, method='patch', json={"age": 33},
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['actor']['age'], 33)
+        self.assertEqual(data['actor']['gender'], 'male')
+
+    def test_update_actor_if_match(self):
+        actor_id = self.create_actors(1)[0]
+        res = self.client().get(
+            '/actors/%d' % actor_id, headers=self.all_perms_header)
+        etag = res.headers['ETag']
+        self.assertEqual(etag, '"1"')
+
+        # the version in If-Match is the current one
+        headers = dict(self.all_perms_header, **{'If-Match': etag})
+        res = self.client().patch(
+            '/actors/%d' % actor_id, json={"age": 41}, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"2"')
+
+        # a second write with the same version is stale
+        res = self.client().patch(
+            '/actors/%d' % actor_id, json={"age": 42}, headers=headers)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(data['message'], "precondition failed")
+        self.assertEqual(Actor.query.get(actor_id).age, 41)
+
+        res = self.client().delete('/actors/%d' % actor_id, headers=headers)
+        self.assertEqual(res.status_code, 412)
+        res = self.client().delete(
+            '/actors/%d' % actor_id,
+            headers=dict(self.all_perms_header, **{'If-Match': '"2"'}))
+        self.assertEqual(res.status_code, 200)
+
+    def test_get_actor_if_none_match(self):
+        actor_id = self.create_actors(1)[0]
+        res = self.client().get(
+            '/actors/%d' % actor_id,
+            headers=dict(self.all_perms_header, **{'If-None-Match': '"1"'}))
+
+        self.assertEqual(res.status_code, 304)
+
+    def test_bulk_update_bumps_versions(self):
+        ids = self.create_actors(2)
+        self.client().patch(
+            "/actors?ids=%d,%d" % tuple(ids), json={"age": 50},
+            headers=self.all_perms_header)
+
+        self.assertEqual(
+            [actor.version for actor in
+             Actor.query.filter(Actor.id.in_(ids))], [2, 2])
+
+    def test_update_actor_not_an_object(self):
+        res = self.client().patch(
+            '/actors/1', json=[1], headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_update_actor_invalid_field(self):
+        res = self.client().patch(
+            '/actors/1', json={"age": "old"}, headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertIsInstance(Actor.query.get(1).age, int)
+
+    def test_update_movie_invalid_date(self):
+        res = self.client().patch(
+            '/movies/1', json={"release_date": "not a date"},
+            headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 422)
+
     def test_update_actor_info_no_data(self):
         res = self.client().patch(
             '/actors/1', headers=self.all_perms_header)
@@ -289,10 +1148,145 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    def create_actors(self, count):
+        """ creates count new actors, returns their ids """
+        prefix = "Bulk Change %s" % time.time()
+        res = self.client().post("/actors/bulk", json=[
+            {"name": "%s %d" % (prefix, n), "age": 20 + n, "gender": "male"}
+            for n in range(count)], headers=self.all_perms_header)
+        return [result['id'] for result in json.loads(res.data)['results']]
+
+    def test_update_actors_bulk(self):
+        ids = self.create_actors(2)
+        res = self.client().patch(
+            "/actors?ids=%d,999999,%d" % (ids[1], ids[0]),
+            json={"gender": "female", "age": 40},
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 2)
+        self.assertEqual(data['not_found'], 1)
+        self.assertEqual(
+            [(result['id'], result['status']) for result in data['results']],
+            [(ids[1], 'updated'), (999999, 'not_found'),
+             (ids[0], 'updated')])
+        self.assertEqual(data['results'][0]['actor']['gender'], 'female')
+        self.assertEqual(
+            [(actor.gender, actor.age) for actor in
+             Actor.query.filter(Actor.id.in_(ids))],
+            [('female', 40), ('female', 40)])
+
+    def test_update_movies_bulk_by_filter(self):
+        movie = Movie.query.order_by(Movie.id).first()
+        movie_id, day = movie.id, movie.release_date.isoformat()
+        res = self.client().patch(
+            "/movies?min_release_date=%s&max_release_date=%s" % (day, day),
+            json={"release_date": day}, headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(movie_id, [result['id'] for result in data['results']])
+        self.assertEqual(data['not_found'], 0)
+
+    def test_update_actors_bulk_needs_a_filter(self):
+        res = self.client().patch(
+            "/actors", json={"gender": "female"},
+            headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_update_movies_bulk_empty_filter(self):
+        res = self.client().patch(
+            "/movies?title_prefix=", json={"release_date": "2020-1-1"},
+            headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_update_actors_bulk_ids_in_body(self):
+        ids = self.create_actors(2)
+        res = self.client().patch(
+            "/actors", json={"ids": [ids[1], 999999, ids[0]], "age": 41},
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [(result['id'], result['status']) for result in data['results']],
+            [(ids[1], 'updated'), (999999, 'not_found'),
+             (ids[0], 'updated')])
+        self.assertEqual(
+            [actor.age for actor in Actor.query.filter(Actor.id.in_(ids))],
+            [41, 41])
+
+    def test_update_actors_bulk_bad_body_ids(self):
+        for ids in ([], ["1"], 5):
+            res = self.client().patch(
+                "/actors", json={"ids": ids, "age": 41},
+                headers=self.all_perms_header)
+
+            self.assertEqual(res.status_code, 400, ids)
+
+    def test_update_actors_bulk_invalid_values(self):
+        res = self.client().patch(
+            "/actors?ids=1", json={"age": "old"},
+            headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 422)
+
+    def test_cannot_update_actors_bulk_CA(self):
+        res = self.client().patch(
+            "/actors?ids=1", json={"gender": "female"},
+            headers=self.casting_assistant_header)
+
+        self.assertEqual(res.status_code, 403)
+
     '''
     Tests for DELETE endpoints
     '''
 
+    def test_delete_actors_bulk(self):
+        ids = self.create_actors(2)
+        movie = Movie.query.order_by(Movie.id).first()
+        self.client().post(
+            "/movies/%d/actors" % movie.id, json={"actor_id": ids[0]},
+            headers=self.all_perms_header)
+        res = self.client().delete(
+            "/actors?ids=%d,%d,999999" % (ids[0], ids[1]),
+            headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual(
+            [result['status'] for result in data['results']],
+            ['deleted', 'deleted', 'not_found'])
+        self.assertEqual(Actor.query.filter(Actor.id.in_(ids)).count(), 0)
+        # the castings of the actors are gone too
+        self.assertEqual(Casting.query.filter(
+            Casting.actor_id.in_(ids)).count(), 0)
+
+    def test_delete_movies_bulk_needs_a_filter(self):
+        res = self.client().delete("/movies", headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_delete_actors_bulk_empty_filter(self):
+        res = self.client().delete(
+            "/actors?name=", headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_delete_actors_bulk_ids_in_body(self):
+        ids = self.create_actors(2)
+        res = self.client().delete(
+            "/actors", json={"ids": ids}, headers=self.all_perms_header)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 2)
+        self.assertEqual(Actor.query.filter(Actor.id.in_(ids)).count(), 0)
+
     def test_delete_actor(self):
         res = self.client().delete(
             "/actors/2", headers=self.all_perms_header)
@@ -327,6 +1321,443 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    '''
+    Tests for GET /changes
+    '''
+
+    def stream_changes(self, url, headers=None):
+        """ opens the change stream of url (on the Flask app) """
+        self.feed = ChangeFeed(self.app, poll_interval=0.05, keepalive=0.1)
+        self.app.extensions['changes'] = self.feed
+        return self.app.test_client().get(
+            url, headers=dict(self.casting_assistant_header, **(headers or {})),
+            buffered=False, environ_overrides={'wsgi.multithread': True})
+
+    def read_events(self, res, count):
+        """ reads count events of a change stream, skips the comments """
+        events = []
+        chunks = iter(res.response)
+        while len(events) < count:
+            chunk = next(chunks)
+            if chunk.startswith(b'id: '):
+                events.append(json.loads(chunk.split(b'data: ', 1)[1]))
+        return events
+
+    def test_changes_resume(self):
+        last_event_id = latest_change_id()
+        actor_id = self.create_actors(1)[0]
+        self.client().patch(
+            "/actors/%d" % actor_id, json={"age": 33},
+            headers=self.all_perms_header)
+        res = self.stream_changes(
+            "/changes?tables=actors", {"Last-Event-ID": str(last_event_id)})
+        events = self.read_events(res, 2)
+        res.close()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, "text/event-stream")
+        self.assertEqual(
+            [(event['table'], event['operation'], event['row'])
+             for event in events],
+            [("actors", "created", {"id": actor_id}),
+             ("actors", "updated", {"id": actor_id})])
+
+    def test_changes_live(self):
+        res = self.stream_changes("/changes")
+        movie = {"title": "Changes %s" % time.time(),
+                 "release_date": "2021-1-1"}
+        created = json.loads(self.client().post(
+            "/movies", json=movie, headers=self.all_perms_header).data)
+        events = self.read_events(res, 1)
+        res.close()
+
+        self.assertEqual(
+            events[0]['row'], {"id": created['created']})
+        self.assertEqual(events[0]['operation'], "created")
+        self.assertEqual(self.feed.stats()['subscribers'], 0)
+
+    def test_changes_unknown_table(self):
+        res = self.client().get(
+            "/changes?tables=directors", headers=self.all_perms_header,
+            **({} if self.asgi_app else
+               {"environ_overrides": {'wsgi.multithread': True}}))
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_changes_sync_worker(self):
+        # the Flask test client is single threaded, like a sync worker
+        res = self.app.test_client().get(
+            "/changes", headers=self.all_perms_header)
+
+        self.assertEqual(res.status_code, 503)
+
+    def test_changes_wait_for_missing_ids(self):
+        feed = ChangeFeed(self.app, gap_timeout=60)
+        feed.last_id = 10
+        subscriber = Subscriber(["actors"])
+        feed.subscribers.add(subscriber)
+
+        def change(change_id):
+            return {"id": change_id, "table": "actors",
+                    "operation": "created", "row": {"id": change_id}}
+
+        # 11 isn't committed yet, 12 waits for it
+        self.assertFalse(feed.deliver(change(12)))
+        self.assertTrue(feed.deliver(change(11)))
+        self.assertTrue(feed.deliver(change(12)))
+        # a missing id is skipped after gap_timeout
+        feed.gap_timeout = 0
+        self.assertTrue(feed.deliver(change(14)))
+        self.assertEqual(
+            [subscriber.events.get_nowait()['id'] for _ in range(3)],
+            [11, 12, 14])
+        self.assertEqual(feed.last_id, 14)
+
+    def test_changes_end_when_token_expires(self):
+        feed = ChangeFeed(self.app, keepalive=0.1)
+        subscriber = Subscriber(["actors"])
+        feed.subscribers.add(subscriber)
+        chunks = list(stream(feed, subscriber, None, time.time() + 0.2))
+
+        self.assertEqual(chunks[-1], SSE_EXPIRED)
+        self.assertIn(SSE_KEEPALIVE, chunks)
+        self.assertEqual(feed.stats()['subscribers'], 0)
+
+    def test_changes_flask_streams_are_capped(self):
+        feed = ChangeFeed(self.app, max_thread_subscribers=1)
+        loop = asyncio.new_event_loop()
+        try:
+            feed.subscribe(["actors"])
+            with self.assertRaises(TooManySubscribersError):
+                feed.subscribe(["actors"])
+            # the streams of the ASGI app don't hold a thread
+            feed.subscribe(["actors"], loop)
+        finally:
+            loop.close()
+
+        self.assertEqual(feed.stats()['subscribers'], 2)
+
+    def test_changes_pruned_without_subscriber(self):
+        old = Change(
+            table_name="actors", operation="created", row_key={"id": 0},
+            created_at=datetime.datetime.utcnow() -
+            datetime.timedelta(hours=models.CHANGES_RETENTION_HOURS + 1))
+        db.session.add(old)
+        db.session.commit()
+        old_id = old.id
+        models.changes_pruning['at'] = None
+        self.create_actors(1)
+
+        self.assertIsNone(Change.query.get(old_id))
+        self.assertIsNotNone(models.changes_pruning['at'])
+
+    def test_changes_delete_actor_deletes_its_castings(self):
+        ids = self.create_actors(2)
+        movie_ids = [movie.id for movie in
+                     Movie.query.order_by(Movie.id).limit(2)]
+        for actor_id, movie_id in zip(ids, movie_ids):
+            self.client().post(
+                "/movies/%d/actors" % movie_id, json={"actor_id": actor_id},
+                headers=self.all_perms_header)
+        last_id = latest_change_id()
+        # one by one, and in bulk
+        self.client().delete(
+            "/actors/%d" % ids[0], headers=self.all_perms_header)
+        self.client().delete(
+            "/actors?ids=%d" % ids[1], headers=self.all_perms_header)
+
+        self.assertEqual(
+            sorted((change['row']['movie_id'], change['operation'])
+                   for change in read_changes(last_id, ["castings"])),
+            [(movie_ids[0], "deleted"), (movie_ids[1], "deleted")])
+
+    def test_changes_orm_delete_movie_deletes_its_castings(self):
+        actor_id = self.create_actors(1)[0]
+        movie = Movie(title="Changes %s" % time.time(),
+                      release_date=datetime.date(2021, 1, 1))
+        movie.insert()
+        Casting(actor_id, movie.id).insert()
+        last_id = latest_change_id()
+        movie.delete()
+
+        self.assertEqual(
+            [change['row'] for change in read_changes(last_id, ["castings"])],
+            [{"actor_id": actor_id, "movie_id": movie.id}])
+
+    def test_changes_tables_need_permissions(self):
+        payload = {"permissions": ["get:actors"]}
+
+        self.assertEqual(change_tables(None, payload), ["actors"])
+        with self.assertRaises(AuthError):
+            change_tables("actors,castings", payload)
+
+
+class JWKSStoreTestCase(unittest.TestCase):
+    """ Tests for the JWKS key store, run against a local JWKS file """
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile(
+            'w', suffix='.json', delete=False)
+        self.jwks_file.close()
+        self.write_jwks('key-1')
+        self.store = JWKSStore(
+            'file://' + self.jwks_file.name, ttl=60, refetch_interval=60)
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def write_jwks(self, *kids):
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': kid, 'use': 'sig',
+                'n': 'n-' + kid, 'e': 'AQAB'
+            } for kid in kids]}, f)
+
+    def test_get_key(self):
+        key = self.store.get_key('key-1')
+
+        self.assertEqual(key['kid'], 'key-1')
+        self.assertEqual(key['n'], 'n-key-1')
+
+    def test_keys_are_cached(self):
+        self.store.get_key('key-1')
+        os.remove(self.jwks_file.name)
+        key = self.store.get_key('key-1')
+        self.write_jwks('key-1')
+
+        self.assertEqual(key['kid'], 'key-1')
+
+    def test_unknown_kid_refetches(self):
+        self.store.get_key('key-1')
+        self.store.last_refetch = None
+        self.write_jwks('key-1', 'key-2')
+        key = self.store.get_key('key-2')
+
+        self.assertEqual(key['kid'], 'key-2')
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.get_key('key-1')
+        self.write_jwks('key-1', 'key-2')
+
+        self.assertIsNone(self.store.get_key('key-2'))
+        self.assertIsNone(self.store.get_key('key-3'))
+
+    def test_stale_keys_refresh_in_background(self):
+        self.store.get_key('key-1')
+        self.store.fetched_at -= 61
+        self.write_jwks('key-1', 'key-2')
+        key = self.store.get_key('key-1')
+        for _ in range(50):
+            if 'key-2' in self.store.keys:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(key['kid'], 'key-1')
+        self.assertIn('key-2', self.store.keys)
+
+    def test_jwks_unavailable(self):
+        os.remove(self.jwks_file.name)
+        with self.assertRaises(AuthError) as context:
+            self.store.get_key('key-1')
+        self.write_jwks('key-1')
+
+        self.assertEqual(context.exception.status_code, 503)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """ Tests for the verified token cache """
+
+    def setUp(self):
+        self.cache = TokenCache(max_size=2)
+        self.payload = {'sub': 'user', 'exp': time.time() + 60}
+
+    def test_cache_hit(self):
+        self.cache.set('token', self.payload)
+
+        self.assertEqual(self.cache.get('token'), self.payload)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 0)
+
+    def test_cache_miss(self):
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_lookups_are_exported(self):
+        def lookups(result):
+            return REGISTRY.get_sample_value(
+                'token_cache_lookups_total', {'result': result}) or 0
+
+        hits, misses = lookups('hit'), lookups('miss')
+        self.cache.get('token')
+        self.cache.set('token', self.payload)
+        self.cache.get('token')
+
+        self.assertEqual(lookups('hit'), hits + 1)
+        self.assertEqual(lookups('miss'), misses + 1)
+
+    def test_expired_token_is_evicted(self):
+        self.cache.set('token', {'sub': 'user', 'exp': time.time() - 1})
+
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_token_without_exp_is_not_cached(self):
+        self.cache.set('token', {'sub': 'user'})
+
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_size_is_capped(self):
+        self.cache.set('token-1', self.payload)
+        self.cache.set('token-2', self.payload)
+        self.cache.get('token-1')
+        self.cache.set('token-3', self.payload)
+
+        self.assertEqual(self.cache.stats()['size'], 2)
+        self.assertIsNone(self.cache.get('token-2'))
+        self.assertEqual(self.cache.get('token-1'), self.payload)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """ Tests for the response cache """
+
+    def setUp(self):
+        # two caches sharing a backend, like two workers sharing redis
+        self.backend = LocalBackend(max_size=2)
+        self.cache = ResponseCache(self.backend, ttl=60)
+        self.other_cache = ResponseCache(self.backend, ttl=60)
+
+    def test_cache_hit(self):
+        key = self.cache.key(['/actors'], ['actors'])
+        self.cache.set(key, {'body': 'actors'})
+
+        self.assertEqual(self.cache.get(key), {'body': 'actors'})
+        self.assertEqual(self.cache.stats()['hit_rate'], 1.0)
+
+    def test_lookups_are_exported(self):
+        def lookups(result):
+            return REGISTRY.get_sample_value(
+                'response_cache_lookups_total', {'result': result}) or 0
+
+        hits, misses = lookups('hit'), lookups('miss')
+        key = self.cache.key(['/actors'], ['actors'])
+        self.cache.get(key)
+        self.cache.set(key, {'body': 'actors'})
+        self.cache.get(key)
+
+        self.assertEqual(lookups('hit'), hits + 1)
+        self.assertEqual(lookups('miss'), misses + 1)
+
+    def test_invalidate_tag(self):
+        key = self.cache.key(['/actors'], ['actors'])
+        movies_key = self.cache.key(['/movies'], ['movies'])
+        self.cache.set(key, {'body': 'actors'})
+        self.cache.set(movies_key, {'body': 'movies'})
+        self.cache.invalidate('actors')
+
+        self.assertIsNone(
+            self.cache.get(self.cache.key(['/actors'], ['actors'])))
+        self.assertEqual(
+            self.cache.get(self.cache.key(['/movies'], ['movies'])),
+            {'body': 'movies'})
+
+    def test_invalidation_is_shared(self):
+        key = self.cache.key(['/actors'], ['actors'])
+        self.cache.set(key, {'body': 'actors'})
+        self.other_cache.invalidate('actors')
+
+        self.assertIsNone(
+            self.cache.get(self.cache.key(['/actors'], ['actors'])))
+
+    def test_entries_expire(self):
+        self.cache.ttl = 0
+        key = self.cache.key(['/actors'], ['actors'])
+        self.cache.set(key, {'body': 'actors'})
+
+        self.assertIsNone(self.cache.get(key))
+
+    def test_size_is_capped(self):
+        for path in ('/a', '/b', '/c'):
+            self.cache.set(self.cache.key([path], []), {'body': path})
+
+        self.assertEqual(len(self.backend.entries), 2)
+        self.assertIsNone(self.cache.get(self.cache.key(['/a'], [])))
+
+
+class EncodingTestCase(unittest.TestCase):
+    """ Tests for the JSON encoders """
+
+    def encoders(self):
+        # orjson is optional
+        return [name for name in ENCODERS
+                if name != 'orjson' or orjson is not None]
+
+    def test_dates_are_iso(self):
+        data = {"title": "Tenet", "release_date": datetime.date(2020, 8, 12)}
+        for name in self.encoders():
+            self.assertEqual(
+                json.loads(ENCODERS[name](data)),
+                {"title": "Tenet", "release_date": "2020-08-12"}, name)
+
+    def test_sort_keys(self):
+        for name in self.encoders():
+            self.assertEqual(
+                ENCODERS[name]({"b": 1, "a": [1, None]}, True),
+                b'{"a":[1,null],"b":1}', name)
+
+    def test_unknown_type(self):
+        for name in self.encoders():
+            with self.assertRaises(TypeError):
+                ENCODERS[name]({"a": object()})
+
+
+class PoolMetricsTestCase(unittest.TestCase):
+    """ Tests for the connection pool settings and metrics """
+
+    def setUp(self):
+        self.engine = create_engine(
+            'sqlite://', poolclass=InstrumentedQueuePool,
+            pool_size=1, max_overflow=0, pool_timeout=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_checkout_is_counted(self):
+        checkouts = pool_metrics.stats()['checkouts']
+        with self.engine.connect():
+            stats = pool_metrics.stats()
+
+        self.assertEqual(stats['checkouts'], checkouts + 1)
+        self.assertGreaterEqual(stats['in_use'], 1)
+        self.assertGreater(stats['saturation'], 0)
+
+    def test_capacity(self):
+        pool = InstrumentedQueuePool(
+            lambda: None, pool_size=2, max_overflow=-1)
+        try:
+            self.assertEqual(self.engine.pool.capacity(), 1)
+            self.assertEqual(pool.capacity(), math.inf)
+            self.assertEqual(pool_metrics.stats()['saturation'], 0)
+        finally:
+            pool_metrics.pools.discard(pool)
+
+    def test_checkout_timeout_is_counted(self):
+        timeouts = pool_metrics.stats()['timeouts']
+        with self.engine.connect():
+            with self.assertRaises(PoolTimeoutError):
+                self.engine.connect()
+
+        stats = pool_metrics.stats()
+        self.assertEqual(stats['timeouts'], timeouts + 1)
+        self.assertGreaterEqual(stats['wait_seconds_max'], 0.05)
+
+    def test_engine_options(self):
+        options = engine_options('postgresql://localhost/CA')
+
+        self.assertIs(options['poolclass'], InstrumentedQueuePool)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(engine_options('sqlite:///CA.db'), {})
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()